@@ -0,0 +1,276 @@
+# 2023 (C) Crown Copyright, Met Office. All rights reserved.
+#
+# This file is part of Weather DataHub and is released under the
+# BSD 3-Clause license.
+# See LICENSE in the root of the repository for full licensing details.
+# (c) Met Office 2023
+
+import argparse
+import array
+import gc
+import json
+import os
+import platform
+import queue
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# Times the pure Python helpers of cda_download.py on synthetic orders of 10,000 to 200,000 files and
+# compares the results with a stored baseline so slow downs show up before they delay real downloads
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cda_download  # noqa: E402
+
+DEFAULT_SIZES = "10000,50000,200000"
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+RUNS = ["00", "06", "12", "18"]
+
+
+def make_orders(numOrders):
+    # The order looked up is the last one so every linear scan goes through the whole list
+    orders = []
+    for i in range(numOrders):
+        orders.append(
+            {
+                "orderId": "order_" + str(i),
+                "modelId": "mo-uk" if i % 2 else "mo-global",
+                "requiredLatestRuns": RUNS,
+            }
+        )
+    return {"orders": orders}
+
+
+def make_order_details(numFiles):
+    # The file table get_order_details returns
+    order = {"orderId": "order_bench", "fileIds": [], "fileSizes": array.array("q")}
+    for i in range(numFiles):
+        run = RUNS[i % len(RUNS)]
+        cda_download.add_order_file(
+            order, "agl_temperature_" + str(i % 70).zfill(2) + "_" + str(i // 280).zfill(3) + "_+" + run, 1000000 + i
+        )
+    return order
+
+
+def make_response_log(numFiles):
+    rows = []
+    for i in range(numFiles):
+        rows.append(
+            {
+                "order": "order_bench",
+                "duration": 1.25,
+                "time_to_first_byte": 0.12,
+                "fileSize": 1000000 + i,
+                "fileId": "agl_temperature_" + str(i),
+                "error": False,
+                "errMsg": "",
+                "file": "/data/downloaded/order_bench_00/agl_temperature_" + str(i) + ".grib2",
+                "currentTime": "12-00-00-000000",
+            }
+        )
+    return rows
+
+
+def make_tasks(fileIds, folder):
+    # Built the same way as the download tasks queued by cda_download.py
+    taskQueue = queue.PriorityQueue()
+    runContext = {
+        "baseUrl": cda_download.BASE_URL,
+        "requestHeaders": {"apikey": "bench"},
+        "orderName": "order_bench",
+        "guidFileNames": False,
+        "folder": folder,
+        "responseLog": [],
+        "downloadErrorLog": [],
+        "backdatedDate": "",
+        "dataSpec": cda_download.DEFAULT_DATA_SPEC,
+        "cycle": "2024-01-01:00",
+        "stamp": "2024-01-01:00",
+    }
+    for fileId in fileIds:
+        cda_download.queue_task(cda_download.DownloadTask(runContext, fileId), taskQueue)
+    return taskQueue
+
+
+def latest_run_gap(workFolder, gapHours):
+    # A fresh state store each time with the last run done gapHours before the latest, so every missed
+    # hourly run is worked out and inserted
+    stateFile = os.path.join(workFolder, "state-" + str(time.perf_counter_ns()) + ".db")
+    cda_download.open_state_store(stateFile)
+    latest = datetime(2024, 1, 1, 0)
+    last = latest - timedelta(hours=gapHours)
+    cda_download.stateConn.execute(
+        "INSERT INTO runs VALUES (?, ?, 'complete', 0)", ("order_bench", last.strftime("%Y-%m-%d:%H"))
+    )
+    start = time.perf_counter()
+    cda_download.get_latest_run("mo-uk", "order_bench", {"mo-uk": "00:" + latest.strftime("%Y-%m-%dT%H:%M:%SZ")})
+    elapsed = time.perf_counter() - start
+    cda_download.stateConn.close()
+    os.remove(stateFile)
+    return elapsed
+
+
+def best_of(repeat, function, *args):
+    # The garbage collector is off while timing, as in timeit, so its pauses do not land in random benchmarks
+    best = float("inf")
+    for i in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            function(*args)
+            best = min(best, time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return best
+
+
+def run_benchmarks(size, repeat, workFolder):
+    # Returns the best time of each benchmark in seconds
+    allOrders = make_orders(max(size // 100, 1))
+    lastOrder = allOrders["orders"][-1]["orderId"]
+    order = make_order_details(size)
+    responseLog = make_response_log(size)
+    failures = [cda_download.failure_record(task[2]) for task in make_tasks(
+        order["fileIds"][:size // 10], "/data/downloaded/order_bench_00"
+    ).queue]
+
+    # write_summary reads these from the module as cda_download.py sets them when it runs
+    cda_download.numThreads = 4
+    cda_download.verbose = False
+    cda_download.baseFolder = workFolder + "/"
+    cda_download.LATEST_FOLDER = "latest"
+
+    results = {}
+    results["get_files_by_run"] = best_of(repeat, cda_download.get_files_by_run, order, RUNS, 0)
+    results["get_latest_run"] = min(latest_run_gap(workFolder, size // 50) for i in range(repeat))
+    lookups = 100
+    results["run_wanted"] = best_of(
+        repeat, lambda: [cda_download.run_wanted(allOrders, lastOrder, "12") for i in range(lookups)]
+    )
+    results["order_exists"] = best_of(
+        repeat, lambda: [cda_download.order_exists(allOrders, lastOrder) for i in range(lookups)]
+    )
+    results["get_model_from_order"] = best_of(
+        repeat, lambda: [cda_download.get_model_from_order(allOrders, lastOrder) for i in range(lookups)]
+    )
+    fileIds = order["fileIds"]
+    results["queue_tasks"] = best_of(repeat, make_tasks, fileIds, "/data/downloaded/order_bench_00")
+    summaryFile = os.path.join(workFolder, "summary.txt")
+    results["write_summary"] = best_of(
+        repeat, cda_download.write_summary, responseLog, summaryFile, datetime.now(), "mo-global"
+    )
+    failureFile = os.path.join(workFolder, "failures.txt")
+    results["write_failures"] = best_of(repeat, cda_download.write_failures, failures, failureFile)
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Prints every result against the baseline - returns the number that are more than threshold percent slower
+    regressions = 0
+    print("benchmark".ljust(36) + "ms".rjust(12) + "baseline".rjust(12) + "change".rjust(10))
+    for name in sorted(results):
+        line = name.ljust(36) + ("%.3f" % (results[name] * 1000)).rjust(12)
+        if name in baseline:
+            change = (results[name] - baseline[name]) / baseline[name] * 100 if baseline[name] > 0 else 0
+            line = line + ("%.3f" % (baseline[name] * 1000)).rjust(12) + (str(round(change)) + "%").rjust(10)
+            if change > threshold:
+                line = line + "  REGRESSION"
+                regressions += 1
+        print(line)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pure Python helpers of cda_download.py on large synthetic orders."
+    )
+    parser.add_argument(
+        "-n",
+        "--sizes",
+        action="store",
+        dest="sizes",
+        default=DEFAULT_SIZES,
+        help="Comma separated numbers of files in the synthetic orders. Defaults to " + DEFAULT_SIZES + ".",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        action="store",
+        dest="repeat",
+        default=7,
+        type=int,
+        help="Number of times each benchmark is run - the best time is kept. Defaults to 7.",
+    )
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        action="store",
+        dest="baseline",
+        default=BASELINE_FILE,
+        help="The baseline results file. Defaults to baseline.json next to this program.",
+    )
+    parser.add_argument(
+        "-s",
+        "--save",
+        action="store_true",
+        dest="save",
+        default=False,
+        help="Save these results as the new baseline.",
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        action="store",
+        dest="threshold",
+        default=25,
+        type=float,
+        help="Percentage slow down counted as a regression. Defaults to 25.",
+    )
+
+    args = parser.parse_args()
+
+    try:
+        sizes = [int(size) for size in args.sizes.split(",")]
+    except ValueError:
+        print("ERROR: The sizes must be a comma separated list of numbers of files.")
+        sys.exit()
+    if args.repeat < 1:
+        print("ERROR: Each benchmark must be run at least once.")
+        sys.exit()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as baselineFile:
+            stored = json.load(baselineFile)
+        baseline = stored["results"]
+        print("Comparing with the baseline saved on " + stored["saved"] + " with Python " + stored["python"])
+    elif not args.save:
+        print("WARNING: No baseline found at " + args.baseline + " - run with --save to store one.")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workFolder:
+        for size in sizes:
+            for name, seconds in run_benchmarks(size, args.repeat, workFolder).items():
+                results[name + "/" + str(size)] = seconds
+
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.save:
+        with open(args.baseline, "w") as baselineFile:
+            json.dump(
+                {
+                    "saved": datetime.now().strftime("%Y-%m-%d %H:%M"),
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "results": results,
+                },
+                baselineFile,
+                indent=4,
+                sort_keys=True,
+            )
+        print("Baseline saved to " + args.baseline)
+    elif regressions > 0:
+        print("ERROR: " + str(regressions) + " benchmarks are more than " + str(args.threshold) + "% slower than the baseline.")
+        sys.exit(1)
@@ -6,19 +6,38 @@
 # (c) Met Office 2023
 
 import argparse
+import array
+import concurrent.futures
 import csv
+import errno
+import glob
+import hashlib
+import importlib.util
 import inspect
+import io
+import itertools
+import multiprocessing
 import os
 import queue
+import shutil
+import socket
+import sqlite3
+import struct
 import sys
+import tarfile
+import tempfile
 import threading
 import time
-import uuid
+import zlib
 from datetime import datetime, timedelta
+from urllib.parse import urljoin
 import requests
 import traceback
 import json
 from enum import Enum
+from cassette import CASSETTE_FILE, http_get, start_recording, start_replay
+from faults import DEBUG_FAULTS, faulty_get, parse_faults, start_faults
+from profiler import PROFILE_MODES, profile_phase, start_profile
 
 # Example code to download GRIB data files from the Met Office Weather DataHub via API calls
 
@@ -29,7 +48,76 @@ debugMode = False
 perfMode = False
 printUrl = False
 retryCount = 3
-workerThreadsWaiting = 0
+terminate = False
+heartbeats = {}
+heartbeatLock = threading.Lock()
+stallTimeout = 120
+maxStallRequeues = 3
+metadataWorkers = 4
+fileLayout = "flat"
+fileMapLock = threading.Lock()
+fileMaps = {}
+publishRuns = False
+outputSink = None
+partSize = 8 * 1024 * 1024
+uploadParallelism = 4
+archiveFormat = ""
+archiveCompression = "store"
+zstandard = None
+runArchives = {}
+archiveLock = threading.Lock()
+archivedSizes = {}
+ARCHIVE_SPOOL = 16 * 1024 * 1024
+cropBox = None
+cropFields = None
+cropPool = None
+cropFutures = []
+cropLock = threading.Lock()
+orderDeadlines = {}
+deadlineWorkers = 0
+deadlineState = None
+deadlineLock = threading.Lock()
+deadlineReport = []
+eventLock = threading.Lock()
+apiKeys = []
+apiKeyLock = threading.Lock()
+resolveWorkers = 0
+resolveRate = 0
+resolveQueue = None
+resolvedSlots = None
+resolveStats = {"resolved": 0, "direct": 0, "failed": 0, "seconds": 0.0}
+connectTimeout = 10
+readTimeout = 60
+minThroughput = 0
+minThroughputGrace = 10
+hedgePercentile = 0
+hedgeMinSamples = 20
+runTtfbs = []
+runThroughputs = []
+statsLock = threading.Lock()
+hedgeCounts = {"started": 0, "won": 0}
+leaseFile = ""
+leaseTime = 300
+workerId = ""
+leaseLocal = threading.local()
+heldLeases = {}
+heldLeasesLock = threading.Lock()
+preallocate = False
+writeBuffer = 8192
+fsyncBytes = 0
+bandwidthLimit = 0
+orderWeights = {}
+activeTransfers = {}
+bandwidthBuckets = {}
+bandwidthLock = threading.Lock()
+backfillBandwidthLimit = 0
+taskCounter = itertools.count()
+stateConn = None
+stateLock = threading.Lock()
+planMode = False
+pendingDone = []
+lastStateFlush = 0
+maxRunAttempts = 3
 
 
 def get_order_details(
@@ -51,7 +139,7 @@ def get_order_details(
             queryParams["runfilter"] = runsToDownload[0]
 
     try:
-        req = requests.get(url, headers=actualHeaders, verify=verifySSL, params=queryParams)
+        req = http_get(url, headers=actualHeaders, verify=verifySSL, params=queryParams, stream=True)
         req.raise_for_status()
     except Exception as exc:
         print("EXCEPTION: get_order_details failed first time")
@@ -59,7 +147,7 @@ def get_order_details(
         print(exc)
         time.sleep(5)
         try:
-            req = requests.get(url, headers=actualHeaders, verify=verifySSL, params=queryParams)
+            req = http_get(url, headers=actualHeaders, verify=verifySSL, params=queryParams, stream=True)
             req.raise_for_status()
         except Exception as exctwo:
             print("EXCEPTION: get_order_details failed second time")
@@ -83,7 +171,8 @@ def get_order_details(
         print("URL:", url)
         sys.exit(6)
     else:
-        details = req.json()
+        with req:
+            details = read_order_files(req, orderName)
 
     if perfMode:
         pmend = datetime.now()
@@ -101,6 +190,42 @@ def get_order_details(
     return details
 
 
+def add_order_file(order, fileId, fileSize):
+    order["fileIds"].append(sys.intern(fileId))
+    order["fileSizes"].append(-1 if fileSize is None else int(fileSize))
+
+
+def read_order_files(req, orderName):
+    # Only the fileId and fileSize of each file are kept, in a table of interned strings and an array of
+    # sizes (-1 where not given).  With ijson installed the table is built as the JSON arrives so the raw
+    # document, which for the largest orders runs to hundreds of MB once parsed, is never held
+    order = {"orderId": orderName, "fileIds": [], "fileSizes": array.array("q")}
+    try:
+        import ijson
+    except ImportError:
+        details = req.json()
+        for f in details["orderDetails"]["files"]:
+            add_order_file(order, f["fileId"], f.get("fileSize"))
+        return order
+
+    # Only one file's details are held at a time
+    req.raw.decode_content = True
+    for f in ijson.items(req.raw, "orderDetails.files.item"):
+        add_order_file(order, f["fileId"], f.get("fileSize"))
+    return order
+
+
+def order_file_list(order):
+    # The file table in the shape of the order details it came from, for --savefilelist
+    files = []
+    for fileId, fileSize in zip(order["fileIds"], order["fileSizes"]):
+        if fileSize < 0:
+            files.append({"fileId": fileId})
+        else:
+            files.append({"fileId": fileId, "fileSize": fileSize})
+    return {"orderDetails": {"order": {"orderId": order["orderId"]}, "files": files}}
+
+
 def get_order_file(
         baseUrl,
         requestHeaders,
@@ -110,24 +235,30 @@ def get_order_file(
         folder,
         start,
         backdatedDate,
-        dataSpec
+        dataSpec,
+        hedge=None,
+        signedUrl=""
 ):
-    # If file id is too long or random file names required generate a uuid for the file name
-
-    urlMod = ""
-    global debugMode
     global perfMode
-    global workerThreadsWaiting
     global terminate
 
 
-    if len(fileId) > 100 or guidFileNames:
-        local_filename = folder + "/" + str(uuid.uuid4()) + ".grib2"
+    if hedge is not None:
+        # A hedged request must end up with the same name as the request it duplicates
+        local_filename = hedge["filename"]
     else:
-        local_filename = folder + "/" + fileId + ".grib2"
+        local_filename = local_file_name(folder, fileId, guidFileNames)
+    heartbeat("request")
+    heartbeats[threading.current_thread().name]["filename"] = local_filename
 
     ttfb = 0
 
+    # Names are fixed by the fileId so a file already there needs no request at all
+    if fillGaps and hedge is None and outputSink.exists(local_filename):
+        if verbose:
+            print("File: ", local_filename, " has already been downloaded")
+        return [start, local_filename]
+
     if backdatedDate != "":
         if debugMode == True:
             print("DEBUG: We are in backdated Date mode for the date: " + backdatedDate)
@@ -137,32 +268,15 @@ def get_order_file(
 
     url = requests.utils.quote(baseUrl + "/orders/" + orderName + "/latest/" + fileId + "/data", safe=': /')
 
-    if debugMode == True:
-        urlMod = input(
-            "Order: "
-            + orderName
-            + " File:"
-            + fileId
-            + "\n"
-            + "Enter y to mimic a receive failure on file - 'go' to run to end> "
-        )
-        # If you put go all further runs will automatically go through
-        if urlMod == "go":
-            debugMode = False
-        if debugMode == True and urlMod == "y":
-            url = (
-                    baseUrl
-                    + "/orders/"
-                    + orderName
-                    + "/latest/"
-                    + fileId
-                    + urlMod
-                    + "/data"
-            )
-
     actualHeaders = {"Accept": "application/x-grib"}
     queryParams = {"dataSpec":dataSpec}
     actualHeaders.update(requestHeaders)
+    apiRequest = [url, actualHeaders, queryParams]
+    if signedUrl != "":
+        # Already resolved to the storage host - the signed URL carries everything it needs
+        url = signedUrl
+        actualHeaders = {"Accept": "application/x-grib"}
+        queryParams = None
 
     if perfMode:
         pmstart3 = datetime.now()
@@ -177,80 +291,1335 @@ def get_order_file(
 
     while True:
 
-        with requests.get(url, headers=actualHeaders, allow_redirects=True, stream=True, verify=verifySSL, params=queryParams) as r:
+        heartbeat("request")
+        apiKey = None
+        if signedUrl == "":
+            apiKey = acquire_api_key()
+            actualHeaders["apikey"] = apiKey["key"]
+        try:
+            with faulty_get(url, headers=actualHeaders, allow_redirects=True, stream=True, verify=verifySSL, params=queryParams, timeout=(connectTimeout, readTimeout)) as r:
 
-            if r.url.find("--") != -1:
-                if verbose:
-                    print("-- found in redirect: ", r.url)
-
-            if printUrl == True:
-                print("get_order_file: ", url)
-                if url != r.url:
-                    print("redirected to: ", r.url)
-
-            if perfMode:
-                pmend3 = datetime.now()
-                delta3 = round((pmend3 - pmstart3).total_seconds() * 1000)
-                if delta3 > int(perfTime) * 1000:
-                    print("PM ", url, " executed in ", str(delta3) + "ms")
-
-            if r.status_code != 200:
-                failCount += 1
-                print("ERROR: File download failed " + str(failCount) + " time(s).")
-                print("Headers: ", r.headers)
-                print("Text: ", r.text)
-                print("URL:", url)
-                print("Redirected URL:", r.url)
-
-                if not terminate:
+                if r.url.find("--") != -1:
                     if verbose:
-                        print("get_order_file: Not terminating")
-                    workerThreadsWaiting = workerThreadsWaiting + 1
-                    wait = backoff_time_calculator(failCount, failLimit)
-                    time.sleep(wait)
-                    workerThreadsWaiting = workerThreadsWaiting - 1
-                        
-                else: 
-                    print("get_order_file: Thread ",MyThreadName, " terminating as required by monitor")
-                    raise Exception("get_order_file: Thread ",MyThreadName, " terminating as required by monitor")
-
-                if failCount >= failLimit:
-                    raise Exception("HTTP Reason and Status: " + r.reason, r.status_code)
+                        print("-- found in redirect: ", r.url)
 
-                continue
+                if printUrl == True:
+                    print("get_order_file: ", url)
+                    if url != r.url:
+                        print("redirected to: ", r.url)
 
-            if r.status_code == 200:
-                if verbose:
-                    print("get_order_file: Status code 200 - writing file with content length ",len(r.content))
+                if perfMode:
+                    pmend3 = datetime.now()
+                    delta3 = round((pmend3 - pmstart3).total_seconds() * 1000)
+                    if delta3 > int(perfTime) * 1000:
+                        print("PM ", url, " executed in ", str(delta3) + "ms")
+
+                if r.status_code != 200 and signedUrl != "":
+                    # The signed URL may have expired - go back to the API for a new one
+                    if verbose:
+                        print("get_order_file: signed URL failed with ", r.status_code, " - requesting ", fileId, " from the API")
+                    signedUrl = ""
+                    url, actualHeaders, queryParams = apiRequest
+                    continue
+
+                if r.status_code != 200 and hedge is not None:
+                    # A duplicate request is not worth backing off for
+                    raise Exception("Hedged request failed: " + r.reason, r.status_code)
+
+                if r.status_code == 429 and len(apiKeys) > 1:
+                    # Rest this key and carry straight on with another one
+                    failCount += 1
+                    pause_api_key(apiKey, r.headers.get("Retry-After"), backoff_time_calculator(failCount, failLimit))
+                    if failCount >= failLimit:
+                        raise Exception("HTTP Reason and Status: " + r.reason, r.status_code)
+                    continue
+
+                if r.status_code != 200:
+                    failCount += 1
+                    print("ERROR: File download failed " + str(failCount) + " time(s).")
+                    print("Headers: ", r.headers)
+                    print("Text: ", r.text)
+                    print("URL:", url)
+                    print("Redirected URL:", r.url)
+
+                    if not terminate:
+                        if verbose:
+                            print("get_order_file: Not terminating")
+                        heartbeat("backoff")
+                        wait = backoff_time_calculator(failCount, failLimit)
+                        time.sleep(wait)
 
-                # Record time to first byte
-                ttfb = start + r.elapsed.total_seconds()
+                    else: 
+                        print("get_order_file: Thread ",MyThreadName, " terminating as required by monitor")
+                        raise Exception("get_order_file: Thread ",MyThreadName, " terminating as required by monitor")
+
+                    if failCount >= failLimit:
+                        raise Exception("HTTP Reason and Status: " + r.reason, r.status_code)
+
+                    continue
+
+                if r.status_code == 200:
+                    if verbose:
+                        print("get_order_file: Status code 200 - writing file with content length ",r.headers.get("Content-Length"))
+
+                    # Record time to first byte
+                    ttfb = start + r.elapsed.total_seconds()
+
+                    if hedge_lost():
+                        break
+
+                    if hedge is not None:
+                        heartbeat("transfer", r)
+                        if write_response_body(r, local_filename, orderName, backdatedDate != "", folder):
+                            hedge["ttfb"] = ttfb
+                        break
 
-                if os.path.exists(local_filename) == True:
-                    if fillGaps == True:
+                    # A finished file is replaced when the new one is published
+                    if fillGaps == True and outputSink.exists(local_filename):
                         if verbose:
                             print("File: ",local_filename," has already been downloaded")
                         break
-                    else:
-                        os.remove(local_filename)
 
-                with open(local_filename, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                    f.close()
+                    heartbeat("transfer", r)
+                    write_response_body(r, local_filename, orderName, backdatedDate != "", folder)
 
-                break
+                    break
+        finally:
+            if apiKey is not None:
+                release_api_key(apiKey)
 
     return [ttfb, local_filename]
 
+
+def local_file_name(folder, fileId, guidFileNames):
+    # Names depend only on the fileId so a file always lands in the same place and --fillgaps can find it.
+    # Over long ids (or when asked for) a hash of the id is used instead and recorded in the file map
+    digest = hashlib.sha256(fileId.encode()).hexdigest()
+    name = fileId
+    if len(fileId) > 100 or guidFileNames:
+        name = digest[:32]
+
+    if fileLayout == "hash":
+        folder = folder + "/" + digest[:2]
+    elif fileLayout == "param":
+        # The parameter is everything before the time step - ids without one are sharded by hash
+        parameter = fileId.rsplit("_", 1)[0] if "_" in fileId else digest[:2]
+        folder = folder + "/" + "".join(c if c.isalnum() or c in "-_." else "_" for c in parameter)
+    if fileLayout != "flat":
+        outputSink.make_folder(folder)
+
+    return folder + "/" + name + ".grib2"
+
+
+def record_file_map(folder, fileId, downloadedFile):
+    # Sidecar listing where each fileId was saved for consumers of hashed or sharded folders
+    relativeName = os.path.relpath(downloadedFile, folder)
+    if fileLayout == "flat" and relativeName == fileId + ".grib2":
+        return
+    # Kept wherever the files are, so it sits beside them in an object store too
+    mapFileName = folder + "/filemap.csv"
+    with fileMapLock:
+        recorded = fileMaps.get(folder)
+        if recorded is None:
+            # Files found by --fillgaps or resumed runs are already in the map
+            recorded = set()
+            text = outputSink.read_text(mapFileName)
+            if text is not None:
+                recorded = set(row[0] for row in csv.reader(io.StringIO(text, newline="")) if len(row) > 0)
+            fileMaps[folder] = recorded
+        if fileId in recorded:
+            return
+        recorded.add(fileId)
+        line = io.StringIO(newline="")
+        csv.writer(line).writerow([fileId, relativeName])
+        outputSink.append_text(mapFileName, line.getvalue())
+
+
+def file_checksum(fileName):
+    sha = hashlib.sha256()
+    with open(fileName, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def append_event(eventFile, event):
+    # One JSON object per line, written in a single call so consumers tailing the file never see half a line
+    line = json.dumps(event) + "\n"
+    with eventLock:
+        with open(eventFile, "a") as events:
+            events.write(line)
+
+
+def publish_run(stagingFolder, publishFolder, orderName, runLabel, fileIds, eventFile):
+    # Move a complete run from its staging folder to where consumers look for it, all at once.
+    # Returns False if files are still missing so it can be tried again after the retries
+    if not os.path.isdir(stagingFolder):
+        # Already published by another worker
+        return True
+    files = []
+    for fileId in fileIds:
+        fileName = local_file_name(stagingFolder, fileId, False)
+        if not os.path.exists(fileName):
+            return False
+        files.append([fileId, fileName])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(numThreads, 1)) as pool:
+        checksums = list(pool.map(file_checksum, [fileName for fileId, fileName in files]))
+    manifest = {
+        "order": orderName,
+        "run": runLabel,
+        "published": datetime.now().isoformat(timespec="seconds"),
+        "files": [
+            {
+                "fileId": fileId,
+                "path": os.path.relpath(fileName, stagingFolder),
+                "size": os.path.getsize(fileName),
+                "sha256": checksum,
+            }
+            for [fileId, fileName], checksum in zip(files, checksums)
+        ],
+    }
+    with open(stagingFolder + "/manifest.json.part", "w") as manifestFile:
+        json.dump(manifest, manifestFile, indent=2)
+    os.replace(stagingFolder + "/manifest.json.part", stagingFolder + "/manifest.json")
+
+    # Each publication is kept under its own name and the run's name is a symlink swapped over to it,
+    # so a run replacing an earlier one with the same name is never seen half written
+    runsFolder = os.path.join(os.path.dirname(publishFolder), ".runs")
+    os.makedirs(runsFolder, exist_ok=True)
+    versionFolder = runsFolder + "/" + os.path.basename(publishFolder) + "-" + datetime.now().strftime("%Y%m%d%H%M%S%f")
+    try:
+        os.rename(stagingFolder, versionFolder)
+    except FileNotFoundError:
+        return True
+    previous = None
+    if os.path.islink(publishFolder):
+        previous = os.path.join(os.path.dirname(publishFolder), os.readlink(publishFolder))
+    elif os.path.isdir(publishFolder):
+        # A folder written before publishing was turned on
+        previous = versionFolder + "-old"
+        os.rename(publishFolder, previous)
+    try:
+        linkName = publishFolder + ".link"
+        if os.path.islink(linkName):
+            os.remove(linkName)
+        os.symlink(os.path.relpath(versionFolder, os.path.dirname(publishFolder)), linkName)
+        os.replace(linkName, publishFolder)
+    except (OSError, NotImplementedError):
+        # No symlinks (e.g. Windows without the privilege) - fall back to renaming the folder itself
+        if os.path.islink(publishFolder):
+            os.remove(publishFolder)
+        os.rename(versionFolder, publishFolder)
+        versionFolder = publishFolder
+    if previous is not None and os.path.isdir(previous) and os.path.realpath(previous) != os.path.realpath(versionFolder):
+        shutil.rmtree(previous, ignore_errors=True)
+
+    append_event(
+        eventFile,
+        {
+            "event": "run_published",
+            "time": manifest["published"],
+            "order": orderName,
+            "run": runLabel,
+            "path": publishFolder,
+            "manifest": publishFolder + "/manifest.json",
+            "files": len(manifest["files"]),
+            "bytes": sum(entry["size"] for entry in manifest["files"]),
+        },
+    )
+    if verbose:
+        print("Published run " + runLabel + " of order " + orderName + " to " + publishFolder)
+    return True
+
+
+def check_grib2(fileName):
+    # Walks the GRIB2 messages in the file - returns None if it is sound, otherwise what is wrong
+    try:
+        size = os.path.getsize(fileName)
+        offset = 0
+        with open(fileName, "rb") as f:
+            while offset < size:
+                f.seek(offset)
+                header = f.read(16)
+                if len(header) < 16 or header[:4] != b"GRIB":
+                    return "no GRIB indicator at byte " + str(offset)
+                if header[7] != 2:
+                    return "GRIB edition " + str(header[7]) + " at byte " + str(offset)
+                length = struct.unpack(">Q", header[8:16])[0]
+                if length < 20 or offset + length > size:
+                    return "truncated - message at byte " + str(offset) + " is " + str(length) + " bytes but the file is " + str(size)
+                f.seek(offset + length - 4)
+                if f.read(4) != b"7777":
+                    return "no 7777 end marker for message at byte " + str(offset)
+                offset += length
+        if size == 0:
+            return "empty file"
+    except OSError as exc:
+        return "unreadable - " + str(exc)
+    return None
+
+
+def grib2_cycle(fileName):
+    # The reference time of the file's first message as YYYY-MM-DD:HH, read from section 1 without decoding it
+    with open(fileName, "rb") as f:
+        header = f.read(33)
+    if len(header) < 33 or header[20] != 1:
+        return None
+    year = struct.unpack(">H", header[28:30])[0]
+    return str(year).zfill(4) + "-" + str(header[30]).zfill(2) + "-" + str(header[31]).zfill(2) + ":" + str(header[32]).zfill(2)
+
+
+def verify_file(fileName):
+    # Runs in the verify process pool - what is wrong with the file, or None, and the model run a sound file holds
+    problem = check_grib2(fileName)
+    if problem is not None:
+        return [problem, None]
+    return [None, grib2_cycle(fileName)]
+
+
+def run_of_folder(name, orderNames):
+    # The order and run of a run folder's name, or None if it is not one.  Published runs are kept as
+    # .runs/{order}_{run}-{time}
+    if "-" in name and name.rsplit("-", 1)[1].isdigit():
+        name = name.rsplit("-", 1)[0]
+    for orderName in sorted(orderNames, key=len, reverse=True):
+        if name.startswith(orderName + "_"):
+            return [orderName, name[len(orderName) + 1:]]
+    return None
+
+
+def verify_tree(rootFolder, wantedRuns):
+    # Checks the GRIB2 files of the run folders that may be filled again across all the CPUs - wantedRuns gives
+    # the run folder names of each order, or None for all of them.  Returns what was found for each run folder,
+    # keyed on its real path: its order and run, its corrupt files and the model runs held by the sound ones
+    runFolders = {}
+    fileNames = []
+    fileRuns = []
+    for folder, subFolders, names in os.walk(rootFolder):
+        relative = os.path.relpath(folder, rootFolder)
+        if relative in [".", ".staging", ".runs"]:
+            # Only the run folders themselves, and the same runs being staged or published, are looked in
+            keep = [name for name in subFolders if relative == "." and name in [".staging", ".runs"]]
+            for name in subFolders:
+                orderRun = run_of_folder(name, wantedRuns)
+                if orderRun is None:
+                    continue
+                if wantedRuns[orderRun[0]] is not None and orderRun[1] not in wantedRuns[orderRun[0]]:
+                    continue
+                runFolder = os.path.realpath(os.path.join(folder, name))
+                runFolders[runFolder] = {"folder": runFolder, "order": orderRun[0], "run": orderRun[1], "bad": [], "cycles": set()}
+                keep.append(name)
+            subFolders[:] = keep
+            continue
+        parts = relative.split(os.sep)
+        runFolder = os.path.realpath(os.path.join(rootFolder, *parts[: 2 if parts[0] in [".staging", ".runs"] else 1]))
+        for name in names:
+            if name.endswith(".grib2"):
+                fileNames.append(os.path.join(folder, name))
+                fileRuns.append(runFolders[runFolder])
+    print("Verifying " + str(len(fileNames)) + " files in " + str(len(runFolders)) + " run folders under " + rootFolder)
+
+    badCount = 0
+    # Spawned rather than forked, as threads such as the lease renewer and the profiler may already be running
+    # and the state store is open
+    with concurrent.futures.ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn")) as pool:
+        for fileName, runFolder, [problem, cycle] in zip(fileNames, fileRuns, pool.map(verify_file, fileNames, chunksize=256)):
+            if problem == "empty file" and (cropBox is not None or cropFields is not None):
+                # Left empty by an earlier crop as nothing in it was wanted
+                continue
+            if problem is not None:
+                print("WARNING: " + fileName + " is corrupt (" + problem + ")")
+                runFolder["bad"].append(fileName)
+                badCount += 1
+            elif cycle is not None:
+                runFolder["cycles"].add(cycle)
+    print(str(badCount) + " corrupt files found")
+    return runFolders
+
+
+def expected_cycle(latestRun, run, runDate):
+    # The YYYY-MM-DD:HH of the model run fetched for a run hour - the one on the date asked for, otherwise the
+    # most recent with that hour.  latestRun is the model's latest run as held in myModelRuns
+    if runDate != "":
+        return runDate[:4] + "-" + runDate[4:6] + "-" + runDate[6:8] + ":" + run
+    if latestRun == "" or not run.isdigit():
+        return ""
+    latest = datetime.strptime(latestRun[3:13] + ":" + latestRun[:2], "%Y-%m-%d:%H")
+    cycle = latest.replace(hour=int(run))
+    if cycle > latest:
+        cycle -= timedelta(days=1)
+    return cycle.strftime("%Y-%m-%d:%H")
+
+
+def verified_run_current(verifiedFolders, folder, cycle):
+    # False when a checked run folder holds a different model run, as filling its gaps would mix two runs
+    cycles = set()
+    for verified in verifiedFolders:
+        cycles |= verified["cycles"]
+    if cycle == "" or len(cycles - {cycle}) == 0:
+        return True
+    print(
+        "WARNING: "
+        + folder
+        + " holds model run "
+        + ", ".join(sorted(cycles))
+        + " not "
+        + cycle
+        + " so it is not filled again - run without --verify to download the run afresh"
+    )
+    for verified in verifiedFolders:
+        for fileName in verified["bad"]:
+            print("WARNING: " + fileName + " is not downloaded again so is left in place")
+    return False
+
+
+def remove_refetched_files(verifiedFolders, folder, fileIds, guidFileNames):
+    # Deletes the corrupt files of a checked run folder that are about to be downloaded again into folder -
+    # files no longer in the order are left where they are
+    if len(verifiedFolders) == 0:
+        return
+    wanted = set(os.path.relpath(local_file_name(folder, fileId, guidFileNames), folder) for fileId in fileIds)
+    mapFileName = folder + "/filemap.csv"
+    if os.path.exists(mapFileName):
+        fileIdSet = set(fileIds)
+        with open(mapFileName, newline="") as mapFile:
+            for row in csv.reader(mapFile):
+                if len(row) > 1 and row[0] in fileIdSet:
+                    wanted.add(row[1])
+    for verified in verifiedFolders:
+        for fileName in verified["bad"]:
+            relativeName = os.path.relpath(fileName, verified["folder"])
+            if relativeName not in wanted:
+                print("WARNING: " + fileName + " is not downloaded again so is left in place")
+                continue
+            # Remove the copy in the folder being filled - a link to the published file when staging
+            if os.path.exists(os.path.join(folder, relativeName)):
+                os.remove(os.path.join(folder, relativeName))
+                if verbose:
+                    print("Deleted " + os.path.join(folder, relativeName) + " to download it again")
+
+
+def crop_grib2(fileName, bbox, fields):
+    # Runs in the crop process pool.  Keeps only the messages for the fields asked for, cut down to the
+    # grid points inside the box (south, west, north, east), and replaces the file with the result.  A file
+    # with nothing wanted in it is emptied rather than deleted, so --fillgaps does not fetch it again.
+    # Returns the sizes before and after and None, "empty" if it was emptied, or the reason it was left as it was
+    import eccodes
+    import numpy
+
+    sizeBefore = os.path.getsize(fileName)
+    if sizeBefore == 0:
+        # Emptied by an earlier crop
+        return [fileName, 0, 0, None]
+    if bbox is not None:
+        south, west, north, east = bbox
+    messages = 0
+    try:
+        with open(fileName, "rb") as src, open(fileName + ".crop", "wb") as dst:
+            while True:
+                gid = eccodes.codes_grib_new_from_file(src)
+                if gid is None:
+                    break
+                try:
+                    if fields is not None and eccodes.codes_get(gid, "shortName") not in fields:
+                        continue
+                    if bbox is None:
+                        eccodes.codes_write(gid, dst)
+                        messages += 1
+                        continue
+                    if eccodes.codes_get(gid, "gridType") != "regular_ll":
+                        raise ValueError("only regular_ll grids can be cropped, not " + eccodes.codes_get(gid, "gridType"))
+                    if eccodes.codes_get(gid, "iScansNegatively") or eccodes.codes_get(gid, "jPointsAreConsecutive"):
+                        raise ValueError("unsupported scanning mode")
+                    ni = eccodes.codes_get(gid, "Ni")
+                    nj = eccodes.codes_get(gid, "Nj")
+                    firstLat = eccodes.codes_get(gid, "latitudeOfFirstGridPointInDegrees")
+                    firstLon = eccodes.codes_get(gid, "longitudeOfFirstGridPointInDegrees")
+                    di = eccodes.codes_get(gid, "iDirectionIncrementInDegrees")
+                    dj = eccodes.codes_get(gid, "jDirectionIncrementInDegrees")
+                    if not eccodes.codes_get(gid, "jScansPositively"):
+                        dj = -dj
+
+                    lats = firstLat + dj * numpy.arange(nj)
+                    lons = numpy.mod(firstLon + di * numpy.arange(ni), 360)
+                    rows = numpy.flatnonzero((lats >= south) & (lats <= north))
+                    # Measured eastwards from the west edge, so a box crossing the meridian where the grid's
+                    # longitudes restart keeps its columns in order from west to east
+                    offsets = numpy.mod(lons - west, 360)
+                    span = 360 if east - west >= 360 else (east - west) % 360
+                    cols = numpy.flatnonzero(offsets <= span)
+                    cols = cols[numpy.argsort(offsets[cols], kind="stable")]
+                    if len(rows) == 0 or len(cols) == 0:
+                        continue
+
+                    values = eccodes.codes_get_values(gid).reshape(nj, ni)
+                    cropped = eccodes.codes_clone(gid)
+                    try:
+                        eccodes.codes_set(cropped, "Ni", len(cols))
+                        eccodes.codes_set(cropped, "Nj", len(rows))
+                        eccodes.codes_set(cropped, "latitudeOfFirstGridPointInDegrees", float(lats[rows[0]]))
+                        eccodes.codes_set(cropped, "latitudeOfLastGridPointInDegrees", float(lats[rows[-1]]))
+                        eccodes.codes_set(cropped, "longitudeOfFirstGridPointInDegrees", float(lons[cols[0]]))
+                        eccodes.codes_set(cropped, "longitudeOfLastGridPointInDegrees", float(lons[cols[-1]]))
+                        eccodes.codes_set_values(cropped, values[numpy.ix_(rows, cols)].ravel())
+                        eccodes.codes_write(cropped, dst)
+                        messages += 1
+                    finally:
+                        eccodes.codes_release(cropped)
+                finally:
+                    eccodes.codes_release(gid)
+        os.replace(fileName + ".crop", fileName)
+        if messages == 0:
+            return [fileName, sizeBefore, 0, "empty"]
+    except Exception as exc:
+        if os.path.exists(fileName + ".crop"):
+            os.remove(fileName + ".crop")
+        return [fileName, sizeBefore, sizeBefore, str(exc)]
+    return [fileName, sizeBefore, os.path.getsize(fileName), None]
+
+
+def queue_crop(fileName):
+    # Files are cropped in the process pool as they land while the workers carry on downloading
+    with cropLock:
+        cropFutures.append(cropPool.submit(crop_grib2, fileName, cropBox, cropFields))
+
+
+def wait_for_crops():
+    # Called before a run is summarised or published so nothing is read while it is being rewritten
+    with cropLock:
+        futures = cropFutures[:]
+        del cropFutures[:]
+    sizeBefore = 0
+    sizeAfter = 0
+    emptied = 0
+    for future in futures:
+        fileName, before, after, problem = future.result()
+        if problem == "empty":
+            emptied += 1
+            if verbose:
+                print("Emptied " + fileName + " as none of its messages are wanted")
+        elif problem is not None:
+            print("WARNING: " + fileName + " was not cropped - " + problem)
+        sizeBefore += before
+        sizeAfter += after
+    if verbose and len(futures) > 0:
+        print(
+            "Cropped "
+            + str(len(futures))
+            + " files from "
+            + str(round(sizeBefore / 1048576, 2))
+            + "MB to "
+            + str(round(sizeAfter / 1048576, 2))
+            + "MB, "
+            + str(emptied)
+            + " of them emptied as none of their messages are wanted"
+        )
+
+
+def reopen_bad_files(runFolders):
+    # The latest run state says these files were done - put their runs back to pending so they are fetched again
+    for runFolder in runFolders.values():
+        for fileName in runFolder["bad"]:
+            # Hashed names are looked up in the file map
+            fileId = os.path.basename(fileName)[: -len(".grib2")]
+            mapFileName = runFolder["folder"] + "/filemap.csv"
+            if os.path.exists(mapFileName):
+                relativeName = os.path.relpath(fileName, runFolder["folder"])
+                with open(mapFileName, newline="") as mapFile:
+                    for row in csv.reader(mapFile):
+                        if len(row) > 1 and row[1] == relativeName:
+                            fileId = row[0]
+
+            runParts = runFolder["run"].split("_")
+            pattern = "%:" + runParts[0]
+            if len(runParts) > 1:
+                pattern = runParts[1][:4] + "-" + runParts[1][4:6] + "-" + runParts[1][6:8] + ":" + runParts[0]
+            with stateLock:
+                row = stateConn.execute(
+                    "SELECT stamp FROM files WHERE orderName=? AND fileId=? AND stamp LIKE ? ORDER BY stamp DESC LIMIT 1",
+                    (runFolder["order"], fileId, pattern),
+                ).fetchone()
+                if row is not None:
+                    stateConn.execute(
+                        "DELETE FROM files WHERE orderName=? AND stamp=? AND fileId=?", (runFolder["order"], row[0], fileId)
+                    )
+                    stateConn.execute(
+                        "UPDATE runs SET status='pending', attempts=0 WHERE orderName=? AND stamp=?",
+                        (runFolder["order"], row[0]),
+                    )
+                    stateConn.commit()
+
+
+def seed_staging(publishFolder, stagingFolder):
+    # Start a republished run from the files already published (hard links, so nothing is copied) so
+    # that --fillgaps only fetches what is missing
+    if os.path.isdir(stagingFolder) or not os.path.isdir(publishFolder):
+        return
+    publishFolder = os.path.realpath(publishFolder)
+    for folder, subFolders, names in os.walk(publishFolder):
+        target = os.path.join(stagingFolder, os.path.relpath(folder, publishFolder))
+        os.makedirs(target, exist_ok=True)
+        for name in names:
+            if name == "manifest.json":
+                continue
+            try:
+                os.link(os.path.join(folder, name), os.path.join(target, name))
+            except OSError:
+                shutil.copy2(os.path.join(folder, name), os.path.join(target, name))
+
+
+def write_all(fd, data):
+    # os.write can return early so keep going until everything is written
+    view = memoryview(data)
+    while len(view) > 0:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def check_throughput(beat, throttled):
+    # Give up on a transfer that has been running for a while at less than the minimum rate
+    if minThroughput <= 0 or throttled:
+        return
+    elapsed = beat["progress"] - beat["since"]
+    if elapsed > minThroughputGrace and beat["bytes"] / elapsed < minThroughput:
+        raise requests.exceptions.Timeout(
+            "Transfer below minimum throughput: " + str(round(beat["bytes"] / elapsed / 1024)) + "KB/s"
+        )
+
+
+def response_chunks(r, orderName, backfill, beat, throttled):
+    # The body a chunk at a time, keeping the heartbeat, the minimum throughput and the bandwidth cap up to date
+    for chunk in r.iter_content(chunk_size=writeBuffer):
+        if hedge_lost():
+            raise Exception("Hedged transfer lost")
+        beat["progress"] = time.time()
+        beat["bytes"] += len(chunk)
+        check_throughput(beat, throttled)
+        if throttled:
+            throttle_bandwidth(orderName, len(chunk), backfill)
+        yield chunk
+
+
+def check_received(r, received):
+    # Content-Length is the encoded size so can only be checked when the body is not compressed
+    if "Content-Encoding" not in r.headers and int(r.headers.get("Content-Length", received)) != received:
+        raise Exception(
+            "Incomplete download: received " + str(received) + " of " + r.headers.get("Content-Length") + " bytes",
+            r.status_code,
+        )
+
+
+class LocalSink:
+    # Where downloaded files go.  Every sink has the same operations - exists and size of a finished file,
+    # write a body somewhere it cannot be mistaken for a finished file, then publish it under its name or
+    # discard it - so the download code never needs to know which one is in use.  This one is the folder
+    # under --location
+
+    def exists(self, fileName):
+        return os.path.exists(fileName)
+
+    def size(self, fileName):
+        return os.path.getsize(fileName)
+
+    def write(self, r, fileName, orderName, backfill, beat, throttled, folder):
+        # Written under a temporary name, which is returned.  A hedge has its own so the two never collide
+        tempFilename = fileName + (".hedge" if beat["role"] == "hedge" else ".part")
+        fd = os.open(tempFilename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if preallocate and "Content-Encoding" not in r.headers and hasattr(os, "posix_fallocate"):
+                expectedSize = int(r.headers.get("Content-Length", 0))
+                try:
+                    if expectedSize > 0:
+                        os.posix_fallocate(fd, 0, expectedSize)
+                except OSError as exc:
+                    if exc.errno == errno.ENOSPC:
+                        raise
+                    # Some filesystems (including some NFS servers) do not support it
+                    if verbose:
+                        print("LocalSink: preallocation not supported for ", fileName, exc)
+
+            buffer = bytearray()
+            written = 0
+            sinceSync = 0
+            for chunk in response_chunks(r, orderName, backfill, beat, throttled):
+                buffer += chunk
+                if len(buffer) >= writeBuffer:
+                    # Only write whole multiples of the buffer size so writes stay aligned
+                    whole = len(buffer) - (len(buffer) % writeBuffer)
+                    write_all(fd, buffer[:whole])
+                    del buffer[:whole]
+                    written += whole
+                    sinceSync += whole
+                    if preallocate and fsyncBytes > 0 and sinceSync >= fsyncBytes:
+                        os.fsync(fd)
+                        sinceSync = 0
+            if len(buffer) > 0:
+                write_all(fd, buffer)
+                written += len(buffer)
+            check_received(r, written)
+            if preallocate and fsyncBytes > 0:
+                os.fsync(fd)
+        except BaseException:
+            # Never leave a partial file behind
+            os.close(fd)
+            os.remove(tempFilename)
+            raise
+        os.close(fd)
+        return tempFilename
+
+    def publish(self, staged, fileName):
+        os.replace(staged, fileName)
+
+    def discard(self, staged):
+        os.remove(staged)
+
+    def make_folder(self, folder):
+        os.makedirs(folder, exist_ok=True)
+
+    def read_text(self, fileName):
+        # Small files kept beside the downloaded ones, such as the file map - None if there is none
+        if not os.path.exists(fileName):
+            return None
+        with open(fileName, newline="") as f:
+            return f.read()
+
+    def append_text(self, fileName, text):
+        os.makedirs(os.path.dirname(fileName), exist_ok=True)
+        with open(fileName, "a", newline="") as f:
+            f.write(text)
+
+    def flush(self):
+        # Text is appended straight to its file so there is nothing to write
+        pass
+
+
+class S3Sink:
+    # Files are streamed to an S3 compatible object store instead of the local folder, as objects named by
+    # the path the file would have had under --location
+
+    def __init__(self, client, bucket, prefix, clientError):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.clientError = clientError
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=numThreads * uploadParallelism)
+        self.texts = {}
+        self.unsavedTexts = set()
+        self.textLock = threading.Lock()
+
+    def key(self, fileName):
+        return self.prefix + os.path.relpath(fileName, baseFolder).replace(os.sep, "/")
+
+    def head(self, fileName):
+        # None only when there is no such object - failures such as bad credentials or an unreachable store
+        # are raised rather than taken to mean the file is missing
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(fileName))
+        except self.clientError as exc:
+            if exc.response.get("Error", {}).get("Code") in ["404", "NoSuchKey", "NotFound"]:
+                return None
+            raise
+
+    def exists(self, fileName):
+        return self.head(fileName) is not None
+
+    def size(self, fileName):
+        response = self.head(fileName)
+        if response is None:
+            raise FileNotFoundError("No object " + self.key(fileName) + " in bucket " + self.bucket)
+        return response["ContentLength"]
+
+    def upload_part(self, key, uploadId, partNumber, body):
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=key, UploadId=uploadId, PartNumber=partNumber, Body=body
+        )
+        return {"ETag": response["ETag"], "PartNumber": partNumber}
+
+    def write(self, r, fileName, orderName, backfill, beat, throttled, folder):
+        # Streams the body into a multipart upload, a part at a time, with up to --uploadparallelism parts
+        # of each file uploading at once.  The object only appears once the upload is completed by publish.
+        # Small files are held back and sent in a single request
+        staged = {"key": self.key(fileName), "uploadId": None, "parts": [], "buffer": bytearray()}
+        buffer = staged["buffer"]
+        parts = staged["parts"]
+        received = 0
+        try:
+            for chunk in response_chunks(r, orderName, backfill, beat, throttled):
+                buffer += chunk
+                received += len(chunk)
+                if len(buffer) >= partSize:
+                    if staged["uploadId"] is None:
+                        staged["uploadId"] = self.client.create_multipart_upload(
+                            Bucket=self.bucket, Key=staged["key"]
+                        )["UploadId"]
+                    parts.append(
+                        self.pool.submit(
+                            self.upload_part, staged["key"], staged["uploadId"], len(parts) + 1, bytes(buffer[:partSize])
+                        )
+                    )
+                    del buffer[:partSize]
+                    # Hold back rather than buffer more parts than are being uploaded
+                    if len(parts) > uploadParallelism:
+                        parts[-uploadParallelism - 1].result()
+            check_received(r, received)
+        except BaseException:
+            self.discard(staged)
+            raise
+        return staged
+
+    def publish(self, staged, fileName):
+        try:
+            if staged["uploadId"] is None:
+                self.client.put_object(Bucket=self.bucket, Key=staged["key"], Body=bytes(staged["buffer"]))
+                return
+            parts = staged["parts"]
+            if len(staged["buffer"]) > 0:
+                parts.append(
+                    self.pool.submit(
+                        self.upload_part, staged["key"], staged["uploadId"], len(parts) + 1, bytes(staged["buffer"])
+                    )
+                )
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=staged["key"],
+                UploadId=staged["uploadId"],
+                MultipartUpload={"Parts": [part.result() for part in parts]},
+            )
+        except BaseException:
+            self.discard(staged)
+            raise
+
+    def discard(self, staged):
+        # Nothing is left behind in the bucket for an unfinished file
+        if staged["uploadId"] is None:
+            return
+        for part in staged["parts"]:
+            part.cancel()
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=staged["key"], UploadId=staged["uploadId"])
+        except Exception as exc:
+            print("WARNING: Could not abort the upload of " + staged["key"] + ": " + str(exc))
+
+    def make_folder(self, folder):
+        # Object stores have no folders
+        pass
+
+    def read_text(self, fileName):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key(fileName))
+        except self.clientError as exc:
+            if exc.response.get("Error", {}).get("Code") in ["404", "NoSuchKey", "NotFound"]:
+                return None
+            raise
+        return response["Body"].read().decode("utf-8")
+
+    def append_text(self, fileName, text):
+        # Objects cannot be appended to, so the text is held here and the whole object written by flush
+        with self.textLock:
+            if fileName not in self.texts:
+                self.texts[fileName] = self.read_text(fileName) or ""
+            self.texts[fileName] += text
+            self.unsavedTexts.add(fileName)
+
+    def flush(self):
+        with self.textLock:
+            for fileName in sorted(self.unsavedTexts):
+                self.client.put_object(
+                    Bucket=self.bucket, Key=self.key(fileName), Body=self.texts[fileName].encode("utf-8"), ContentType="text/csv"
+                )
+            self.unsavedTexts.clear()
+
+
+def open_s3_sink(s3Url, endpoint):
+    # boto3 is only needed when an object store is used; credentials come from the usual AWS environment
+    # variables or files
+    try:
+        import boto3
+        from botocore.config import Config
+        from botocore.exceptions import ClientError
+    except ImportError:
+        print("ERROR: The boto3 package is needed to write to an object store - pip install boto3")
+        sys.exit()
+    if not s3Url.startswith("s3://"):
+        print("ERROR: The object store location must be given as s3://bucket/prefix")
+        sys.exit()
+    bucket, _, prefix = s3Url[len("s3://"):].partition("/")
+    if prefix != "" and not prefix.endswith("/"):
+        prefix = prefix + "/"
+    client = boto3.client(
+        "s3",
+        endpoint_url=endpoint or None,
+        config=Config(max_pool_connections=numThreads * (uploadParallelism + 1)),
+    )
+    return S3Sink(client, bucket, prefix, ClientError)
+
+
+def open_run_archive(folder):
+    # One archive per run folder, opened when the first file of the run arrives.  It is written under
+    # a .part name until the run is finished
+    folder = os.path.normpath(folder)
+    with archiveLock:
+        archive = runArchives.get(folder)
+        if archive is None:
+            if archiveFormat == "zip":
+                archivePath = folder + ".zip"
+            elif archiveCompression == "zstd":
+                archivePath = folder + ".tar.zst"
+            else:
+                archivePath = folder + ".tar"
+            if os.path.exists(archivePath + ".part"):
+                # Left by an interrupted download - kept rather than overwritten
+                keptPath = archivePath + "." + datetime.now().strftime("%Y%m%d-%H%M%S") + ".part"
+                os.replace(archivePath + ".part", keptPath)
+                print("WARNING: The unfinished archive from an interrupted download has been kept as " + keptPath)
+            archive = {
+                "folder": folder,
+                "path": archivePath,
+                "file": open(archivePath + ".part", "xb"),
+                "lock": threading.Lock(),
+                "members": [],
+            }
+            runArchives[folder] = archive
+    return archive
+
+
+def zstd_frame(pieces, size):
+    # Compresses the pieces (bytes or files) into a single zstd frame so each member can be read on its own
+    frame = tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL)
+    compressor = zstandard.ZstdCompressor(level=3, write_content_size=True)
+    with compressor.stream_writer(frame, size=size, closefd=False) as writer:
+        for piece in pieces:
+            if isinstance(piece, bytes):
+                writer.write(piece)
+            else:
+                shutil.copyfileobj(piece, writer, writeBuffer)
+    frame.seek(0)
+    return frame
+
+
+def dos_date_time(when):
+    stamp = time.localtime(when)
+    return (
+        (stamp.tm_hour << 11) | (stamp.tm_min << 5) | (stamp.tm_sec // 2),
+        ((stamp.tm_year - 1980) << 9) | (stamp.tm_mon << 5) | stamp.tm_mday,
+    )
+
+
+def add_archive_member(archive, memberName, body, size, crc):
+    # Anything slow (building headers, compressing) is done before the archive is locked so workers only
+    # queue to copy finished members onto the end of it
+    body.seek(0)
+    now = time.time()
+    method = 0
+    if archiveFormat == "tar":
+        info = tarfile.TarInfo(memberName)
+        info.size = size
+        info.mtime = int(now)
+        info.mode = 0o644
+        header = info.tobuf(format=tarfile.PAX_FORMAT)
+        padding = b"\0" * (-size % tarfile.BLOCKSIZE)
+        dataOffset = len(header)
+        if archiveCompression == "zstd":
+            body = zstd_frame([header, body, padding], len(header) + size + len(padding))
+            header = b""
+            padding = b""
+    else:
+        nameBytes = memberName.encode("utf-8")
+        if archiveCompression == "zstd":
+            method = 93
+            body = zstd_frame([body], size)
+        body.seek(0, os.SEEK_END)
+        compressedSize = body.tell()
+        body.seek(0)
+        dosTime, dosDate = dos_date_time(now)
+        # Sizes always go in the zip64 extra field so archives and members can be over 4GB
+        extra = struct.pack("<HHQQ", 1, 16, size, compressedSize)
+        header = struct.pack(
+            "<IHHHHHIIIHH",
+            0x04034B50,
+            63 if method == 93 else 45,
+            0x800,
+            method,
+            dosTime,
+            dosDate,
+            crc,
+            0xFFFFFFFF,
+            0xFFFFFFFF,
+            len(nameBytes),
+            len(extra),
+        ) + nameBytes + extra
+        padding = b""
+        dataOffset = len(header)
+
+    with archive["lock"]:
+        f = archive["file"]
+        offset = f.tell()
+        f.write(header)
+        shutil.copyfileobj(body, f, writeBuffer)
+        f.write(padding)
+        length = f.tell() - offset
+        # Data offsets are absolute except in a .tar.zst where they are within the member's frame
+        if archiveCompression != "zstd" or archiveFormat == "zip":
+            dataOffset = offset + dataOffset
+        archive["members"].append([memberName, offset, length, dataOffset, size, crc, method, now])
+
+
+def close_run_archive(archive):
+    # Ends the archive, writes its index of member offsets and gives it its final name
+    f = archive["file"]
+    with archive["lock"]:
+        if archiveFormat == "tar":
+            end = b"\0" * (2 * tarfile.BLOCKSIZE)
+            if archiveCompression == "zstd":
+                end = zstd_frame([end], len(end)).read()
+            f.write(end)
+        else:
+            directoryOffset = f.tell()
+            for memberName, offset, length, dataOffset, size, crc, method, when in archive["members"]:
+                nameBytes = memberName.encode("utf-8")
+                dosTime, dosDate = dos_date_time(when)
+                extra = struct.pack("<HHQQQ", 1, 24, size, offset + length - dataOffset, offset)
+                f.write(
+                    struct.pack(
+                        "<IHHHHHHIIIHHHHHII",
+                        0x02014B50,
+                        (3 << 8) | 63,
+                        63 if method == 93 else 45,
+                        0x800,
+                        method,
+                        dosTime,
+                        dosDate,
+                        crc,
+                        0xFFFFFFFF,
+                        0xFFFFFFFF,
+                        len(nameBytes),
+                        len(extra),
+                        0,
+                        0,
+                        0,
+                        0o100644 << 16,
+                        0xFFFFFFFF,
+                    )
+                    + nameBytes
+                    + extra
+                )
+            endOffset = f.tell()
+            count = len(archive["members"])
+            f.write(
+                struct.pack(
+                    "<IQHHIIQQQQ", 0x06064B50, 44, 63, 63, 0, 0, count, count, endOffset - directoryOffset, directoryOffset
+                )
+            )
+            f.write(struct.pack("<IIQI", 0x07064B50, 0, endOffset, 1))
+            f.write(struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0))
+        f.close()
+
+        with open(archive["path"] + ".index.csv", "w", newline="") as indexFile:
+            writer = csv.writer(indexFile)
+            writer.writerow(["member", "offset", "length", "dataoffset", "size", "crc32"])
+            for memberName, offset, length, dataOffset, size, crc, method, when in archive["members"]:
+                writer.writerow([memberName, offset, length, dataOffset, size, "%08x" % crc])
+        os.replace(archive["path"] + ".part", archive["path"])
+    return len(archive["members"])
+
+
+class ArchiveSink(LocalSink):
+    # The files of each run are added to one archive per run folder (see open_run_archive).  A body is
+    # spooled (in memory unless it is large) so a member is only added once it is complete and the CRC and
+    # size are known for its header.  The file map is a local file, in the folder the run would have had
+
+    def exists(self, fileName):
+        with archiveLock:
+            return fileName in archivedSizes
+
+    def size(self, fileName):
+        with archiveLock:
+            return archivedSizes[fileName]
+
+    def write(self, r, fileName, orderName, backfill, beat, throttled, folder):
+        archive = open_run_archive(folder)
+        body = tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL, dir=os.path.dirname(archive["path"]))
+        received = 0
+        crc = 0
+        try:
+            for chunk in response_chunks(r, orderName, backfill, beat, throttled):
+                body.write(chunk)
+                crc = zlib.crc32(chunk, crc)
+                received += len(chunk)
+            check_received(r, received)
+        except BaseException:
+            body.close()
+            raise
+        return {"archive": archive, "body": body, "size": received, "crc": crc}
+
+    def publish(self, staged, fileName):
+        archive = staged["archive"]
+        memberName = os.path.relpath(fileName, archive["folder"]).replace(os.sep, "/")
+        try:
+            add_archive_member(archive, memberName, staged["body"], staged["size"], staged["crc"])
+        finally:
+            staged["body"].close()
+        with archiveLock:
+            archivedSizes[fileName] = staged["size"]
+
+    def discard(self, staged):
+        staged["body"].close()
+
+    def make_folder(self, folder):
+        # Members are named by their path so no folders are needed
+        pass
+
+
+def write_response_body(r, local_filename, orderName, backfill, folder=""):
+    # Returns False if a hedged duplicate of this transfer finished first.  Only the winner's body is given
+    # its name; the loser's is discarded
+    throttled = bandwidthLimit > 0 or (backfill and backfillBandwidthLimit > 0)
+    beat = heartbeats[threading.current_thread().name]
+    try:
+        staged = outputSink.write(r, local_filename, orderName, backfill, beat, throttled, folder)
+    except BaseException:
+        if hedge_lost():
+            return False
+        raise
+    if not claim_hedge(beat):
+        outputSink.discard(staged)
+        return False
+    outputSink.publish(staged, local_filename)
+    beat["throughput"] = beat["bytes"] / max(time.time() - beat["since"], 0.001)
+    return True
+
+
+def take_bandwidth(bucketName, rate, numBytes, now):
+    # Token bucket allowed to go into debt - returns how long the caller must wait to pay it back
+    bucket = bandwidthBuckets.get(bucketName)
+    if bucket is None:
+        bucket = [rate, now]
+        bandwidthBuckets[bucketName] = bucket
+    # Allow at most one second of burst
+    bucket[0] = min(bucket[0] + (now - bucket[1]) * rate, rate)
+    bucket[1] = now
+    bucket[0] -= numBytes
+    if bucket[0] < 0:
+        return -bucket[0] / rate
+    return 0
+
+
+def throttle_bandwidth(orderName, numBytes, backfill):
+    # Shared by all workers - a global cap split between the orders currently transferring by weight
+    # with backfill transfers also held to their own cap
+    with bandwidthLock:
+        now = time.time()
+        wait = 0
+        if bandwidthLimit > 0:
+            wait = take_bandwidth("", bandwidthLimit, numBytes, now)
+            if len(orderWeights) > 0:
+                totalWeight = 0
+                for activeOrder in activeTransfers:
+                    totalWeight += orderWeights.get(activeOrder, 1)
+                if totalWeight > 0:
+                    share = bandwidthLimit * orderWeights.get(orderName, 1) / totalWeight
+                    wait = max(wait, take_bandwidth(orderName, share, numBytes, now))
+        if backfill and backfillBandwidthLimit > 0:
+            wait = max(wait, take_bandwidth(" backfill", backfillBandwidthLimit, numBytes, now))
+    if wait > 0:
+        time.sleep(wait)
+
+
+def start_transfer(orderName):
+    with bandwidthLock:
+        activeTransfers[orderName] = activeTransfers.get(orderName, 0) + 1
+
+
+def end_transfer(orderName):
+    with bandwidthLock:
+        activeTransfers[orderName] -= 1
+        if activeTransfers[orderName] == 0:
+            del activeTransfers[orderName]
+
+
+def expected_run_size(order, filesByRun, orderName):
+    # Use the file sizes in the order details if given, otherwise the average from the last summary
+    numFiles = 0
+    for run in filesByRun:
+        numFiles += len(filesByRun[run])
+
+    sizes = {}
+    for fileId, fileSize in zip(order["fileIds"], order["fileSizes"]):
+        if fileSize >= 0:
+            sizes[fileId] = fileSize
+    if len(sizes) > 0:
+        total = 0
+        for run in filesByRun:
+            for fileId in filesByRun[run]:
+                total += sizes.get(fileId, 0)
+        return total
+
+    summaries = glob.glob(baseFolder + RESULTS_FOLDER + "/summary-" + orderName + "-*.txt")
+    if len(summaries) == 0:
+        return 0
+    with open(max(summaries, key=os.path.getmtime), "r") as sumfile:
+        sumfile.readline()
+        totals = sumfile.readline().split()
+    # Total Files: N Total time taken: Xs Total Size: S Workers: W
+    try:
+        lastFiles = int(totals[2])
+        lastSize = int(totals[9])
+    except (IndexError, ValueError):
+        return 0
+    if lastFiles == 0:
+        return 0
+    return round(lastSize / lastFiles * numFiles)
+
+
+def check_disk_space(folder, expectedBytes):
+    free = shutil.disk_usage(folder).free
+    if verbose:
+        print("check_disk_space: expecting", expectedBytes, "bytes with", free, "bytes free in", folder)
+    return free > expectedBytes
+
+
+def read_summary_history(resultsFolder):
+    # Per file and per invocation figures from the results/ summaries of earlier runs
+    fileHistory = []
+    runHistory = []
+    for summaryFile in glob.glob(resultsFolder + "/summary-*.txt"):
+        with open(summaryFile, "r", newline="") as sumfile:
+            sumfile.readline()
+            totals = sumfile.readline().split()
+            if sumfile.readline() != "===== Detail Section =====\n":
+                continue
+            try:
+                # Total Files: N Total time taken: Xs Total Size: S Workers: W
+                runHistory.append([float(totals[6][:-1]), int(totals[9]), int(totals[11])])
+            except (IndexError, ValueError):
+                continue
+            for row in csv.DictReader(sumfile):
+                try:
+                    fileSize = int(row["fileSize"])
+                    duration = float(row["duration"])
+                    ttfb = float(row["time_to_first_byte"])
+                except (TypeError, ValueError):
+                    continue
+                # Retried files are recorded with no size or timings
+                if row["error"] == "False" and fileSize > 0:
+                    fileHistory.append([row["order"], fileSize, duration, ttfb])
+    return [fileHistory, runHistory]
+
+
+def fit_download_model(fileHistory, runHistory):
+    # Each file takes its time to first byte plus its size over the rate of a single stream,
+    # and all the streams together can go no faster than the best rate seen for a whole order
+    model = {"files": len(fileHistory), "orderMeanSize": {}}
+    if len(fileHistory) == 0 or len(runHistory) == 0:
+        return None
+
+    sizeSquares = 0
+    sizeTransfer = 0
+    totalTtfb = 0
+    totalSize = 0
+    orderSizes = {}
+    for order, fileSize, duration, ttfb in fileHistory:
+        sizeSquares += fileSize * fileSize
+        sizeTransfer += fileSize * max(duration - ttfb, 0)
+        totalTtfb += ttfb
+        totalSize += fileSize
+        orderSizes.setdefault(order, []).append(fileSize)
+
+    # Least squares fit through the origin of transfer time against file size
+    model["streamRate"] = sizeSquares / sizeTransfer if sizeTransfer > 0 else float("inf")
+    model["meanTtfb"] = totalTtfb / len(fileHistory)
+    model["meanSize"] = totalSize / len(fileHistory)
+    for order in orderSizes:
+        model["orderMeanSize"][order] = sum(orderSizes[order]) / len(orderSizes[order])
+
+    model["capRate"] = 0
+    for totalTime, runSize, workers in runHistory:
+        if totalTime > 0:
+            model["capRate"] = max(model["capRate"], runSize / totalTime)
+    if model["capRate"] == 0:
+        model["capRate"] = float("inf")
+
+    return model
+
+
+def estimate_download_time(model, numFiles, totalBytes, workers):
+    perStream = (numFiles * model["meanTtfb"] + totalBytes / model["streamRate"]) / workers
+    return max(perStream, totalBytes / model["capRate"])
+
+
+def recommend_workers(model, numFiles, totalBytes):
+    # The fewest workers that reach the aggregate limit - more just queue behind each other
+    if numFiles == 0 or totalBytes == 0:
+        return 1
+    streamTime = numFiles * model["meanTtfb"] + totalBytes / model["streamRate"]
+    if model["capRate"] == float("inf"):
+        return min(numFiles, 64)
+    workers = int(-(-streamTime * model["capRate"] // totalBytes))
+    return max(1, min(workers, numFiles, 64))
+
+
+def print_plan(planEntries, model, workers):
+    print("Download Plan")
+    print("=============")
+    totalFiles = 0
+    totalBytes = 0
+    for entry in planEntries:
+        totalFiles += entry["files"]
+        totalBytes += entry["bytes"]
+        print(
+            "Order: "
+            + entry["order"]
+            + " Runs: "
+            + ",".join(entry["runs"])
+            + " Files: "
+            + str(entry["files"])
+            + " Estimated size: "
+            + str(round(entry["bytes"] / 1024 / 1024, 1))
+            + "MB"
+            + ("" if entry["sized"] else " (from history)")
+        )
+    print("Total Files: " + str(totalFiles) + " Estimated size: " + str(round(totalBytes / 1024 / 1024, 1)) + "MB")
+
+    if model is None:
+        print("No results/ summaries found so no time estimate can be made.")
+        return
+
+    print(
+        "Fitted from "
+        + str(model["files"])
+        + " files: mean time to first byte "
+        + str(round(model["meanTtfb"], 2))
+        + "s, single stream "
+        + str(round(model["streamRate"] / 1024 / 1024, 2))
+        + "MB/s, best aggregate "
+        + str(round(model["capRate"] / 1024 / 1024, 2))
+        + "MB/s"
+    )
+    print(
+        "Estimated time with "
+        + str(workers)
+        + " workers: "
+        + str(round(estimate_download_time(model, totalFiles, totalBytes, workers), 1))
+        + "s"
+    )
+    recommended = recommend_workers(model, totalFiles, totalBytes)
+    print(
+        "Recommended workers: "
+        + str(recommended)
+        + " estimated time: "
+        + str(round(estimate_download_time(model, totalFiles, totalBytes, recommended), 1))
+        + "s"
+    )
+
+
 def get_files_by_run(order, runsToDownload, numFilesPerOrder):
     # Break down the files in to those needed for each run
     filesByRun = {}
     for run in runsToDownload:
         filesByRun[run] = []
         fc = 0
-        for f in order["orderDetails"]["files"]:
-            fileId = f["fileId"]
+        for fileId in order["fileIds"]:
             if "_+" + run in fileId:
                 filesByRun[run].append(fileId)
                 fc += 1
@@ -259,37 +1628,710 @@ def get_files_by_run(order, runsToDownload, numFilesPerOrder):
 
     return filesByRun
 
-def monitor_threads():
+def heartbeat(state, response=None):
+    # Each worker records what it is doing - progress within a transfer is updated by the
+    # worker alone in write_response_body so needs no lock
+    now = time.time()
+    with heartbeatLock:
+        beat = heartbeats.get(threading.current_thread().name)
+        if beat is None:
+            beat = {"abort": False, "fileId": "", "filename": "", "task": None, "hedge": None, "role": "original"}
+            heartbeats[threading.current_thread().name] = beat
+        beat["state"] = state
+        beat["since"] = now
+        beat["progress"] = now
+        beat["response"] = response
+        beat["bytes"] = 0
+        if beat["hedge"] is not None and response is not None:
+            beat["hedge"]["responses"][beat["role"]] = response
+
+
+def stalled_abort():
+    # True (once) if the monitor aborted this worker's transfer
+    with heartbeatLock:
+        beat = heartbeats[threading.current_thread().name]
+        aborted = beat["abort"]
+        beat["abort"] = False
+    return aborted
+
+
+def abort_response(response):
+    # Closing a response does not wake a thread blocked reading from it - shutting down the socket does.
+    # Bodies standing in for the connection (injected faults, replays) give the connection they wrap, if any
+    connection = getattr(response.raw, "connection", None)
+    if connection is not None and connection.sock is not None:
+        try:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+        except OSError as exc:
+            # Already closed at the other end, so nothing is left to wake
+            if exc.errno != errno.ENOTCONN:
+                print("WARNING: Could not shut down the connection of an aborted transfer: " + str(exc))
+    try:
+        response.close()
+    except Exception as exc:
+        print("WARNING: Could not close an aborted transfer: " + str(exc))
+
+
+def hedge_lost():
+    # True if this worker's transfer has a hedged duplicate that finished first
+    beat = heartbeats[threading.current_thread().name]
+    hedge = beat["hedge"]
+    return hedge is not None and hedge["winner"] not in [None, beat["role"]]
+
+
+def claim_hedge(beat):
+    # The first of a request and its hedge to finish keeps its file and cuts the other one off
+    hedge = beat["hedge"]
+    if hedge is None:
+        return True
+    with hedge["lock"]:
+        if hedge["winner"] is None:
+            hedge["winner"] = beat["role"]
+            if beat["role"] == "hedge":
+                hedgeCounts["won"] += 1
+            other = "original" if beat["role"] == "hedge" else "hedge"
+            if other in hedge["responses"]:
+                abort_response(hedge["responses"][other])
+        return hedge["winner"] == beat["role"]
+
+
+def percentile(values, pct):
+    # values must already be sorted
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+def start_hedges(beats, now):
+    # Duplicate requests that are slower than most of the run so far, as long as a worker is free to take them
+    with statsLock:
+        ttfbs = sorted(runTtfbs)
+        throughputs = sorted(runThroughputs)
+    if len(ttfbs) < hedgeMinSamples or len(throughputs) < hedgeMinSamples:
+        return
+    idle = len([beat for name, beat in beats if beat["state"] == "idle"])
+    ttfbLimit = percentile(ttfbs, hedgePercentile)
+    throughputLimit = percentile(throughputs, 100 - hedgePercentile)
+    throttled = bandwidthLimit > 0 or backfillBandwidthLimit > 0
+
+    for name, beat in beats:
+        if idle == 0:
+            break
+        with heartbeatLock:
+            if beat["hedge"] is not None or beat["task"] is None or beat["abort"]:
+                continue
+            elapsed = now - beat["since"]
+            if beat["state"] == "request":
+                slow = elapsed > ttfbLimit
+            elif beat["state"] == "transfer" and not throttled:
+                slow = elapsed > 1 and beat["bytes"] / elapsed < throughputLimit
+            else:
+                slow = False
+            if not slow:
+                continue
+            hedge = {
+                "lock": threading.Lock(),
+                "winner": None,
+                "filename": beat["filename"],
+                "responses": {},
+                "finished": threading.Event(),
+                "ttfb": 0,
+            }
+            if beat["response"] is not None:
+                hedge["responses"]["original"] = beat["response"]
+            beat["hedge"] = hedge
+            hedgeTask = copy_task(beat["task"])
+            hedgeTask.hedge = hedge
+        if verbose:
+            print("monitor_threads: hedging slow " + beat["state"] + " of " + beat["fileId"])
+        hedgeCounts["started"] += 1
+        queue_task(hedgeTask)
+        idle -= 1
+
+
+def run_hedge(downloadTask):
+    # Make the duplicate request - whatever happens the original is told it has finished
+    hedge = downloadTask.hedge
+    with heartbeatLock:
+        beat = heartbeats[threading.current_thread().name]
+        beat["hedge"] = hedge
+        beat["role"] = "hedge"
+        beat["fileId"] = downloadTask.fileId
+    try:
+        get_order_file(
+            downloadTask.context["baseUrl"],
+            downloadTask.context["requestHeaders"],
+            downloadTask.context["orderName"],
+            downloadTask.fileId,
+            downloadTask.context["guidFileNames"],
+            downloadTask.context["folder"],
+            time.time(),
+            downloadTask.context["backdatedDate"],
+            downloadTask.context["dataSpec"],
+            hedge,
+            downloadTask.signedUrl
+        )
+    except Exception as ex:
+        if verbose:
+            print("run_hedge: hedged request for " + downloadTask.fileId + " failed", ex.args)
+        if os.path.exists(hedge["filename"] + ".hedge"):
+            os.remove(hedge["filename"] + ".hedge")
+    finally:
+        stalled_abort()
+        heartbeat("idle")
+        with heartbeatLock:
+            beat["hedge"] = None
+            beat["role"] = "original"
+        hedge["finished"].set()
+
+
+def monitor_threads(stopEvent):
     global terminate
-    global taskQueue
 
-    while True:
-        if verbose: 
-            print("monitor_threads: Worker Threads waiting: ",workerThreadsWaiting," number Threads ",numThreads)
-        if workerThreadsWaiting == numThreads:
-            if verbose: 
-                print("monitor_threads: All workers in wait state - waiting 30 seconds")
-        # Hang back for 30 seconds in case things received
-            time.sleep(30)
-            if workerThreadsWaiting == numThreads:
+    allBackoffSince = None
+    # Hedging needs a quicker look at the workers than stall detection does
+    interval = 1 if hedgePercentile > 0 else 5
+    while not stopEvent.wait(interval):
+        now = time.time()
+        with heartbeatLock:
+            beats = list(heartbeats.items())
+
+        backoff = 0
+        for name, beat in beats:
+            if beat["state"] == "backoff":
+                backoff += 1
+            elif beat["state"] in ["request", "transfer"] and now - beat["progress"] > stallTimeout:
+                if beat["abort"]:
+                    continue
+                print(
+                    "WARNING: monitor_threads: "
+                    + name
+                    + " has made no progress on "
+                    + beat["fileId"]
+                    + " for "
+                    + str(round(now - beat["progress"]))
+                    + "s - aborting it to be requeued"
+                )
+                with heartbeatLock:
+                    beat["abort"] = True
+                if beat["response"] is not None:
+                    abort_response(beat["response"])
+
+        if hedgePercentile > 0:
+            start_hedges(beats, now)
+
+        if deadlineState is not None:
+            check_deadline(now)
+
+        if verbose and interval == 5:
+            print("monitor_threads: Workers in backoff: ", backoff, " number Threads ", len(beats))
+
+        # Only give up on the run when every worker has been backing off for a while
+        if len(beats) > 0 and backoff == len(beats):
+            if allBackoffSince is None:
+                allBackoffSince = now
+                if verbose:
+                    print("monitor_threads: All workers in wait state - waiting 30 seconds")
+            elif now - allBackoffSince >= 30:
                 terminate = True
-                print("monitor_threads: ERROR: All workers in wait state - cannot recover -terminating ")
-                # Close the thread
-                sys.exit(9)
+                print("monitor_threads: ERROR: All workers in wait state - cannot recover - aborting the run")
+                return
         else:
-            if verbose:
-                print("monitor_threads: Not all workers in wait state")
-        time.sleep(10)
+            allBackoffSince = None
+
+
+def add_workers(count):
+    for i in range(count):
+        t = threading.Thread(target=download_worker)
+        t.start()
+        taskThreads.append(t)
+
+
+def check_deadline(now):
+    # Projects when the order will finish from the files done so far and, if that is after its deadline,
+    # adds enough workers (up to --deadlineworkers) to bring it back in
+    with deadlineLock:
+        state = deadlineState
+        if state is None or state["closed"] or state["done"] == 0 or now - state["started"] < 10:
+            return
+        remaining = state["files"] - state["done"]
+        projected = now + remaining * (now - state["started"]) / state["done"]
+        state["projected"] = projected
+        workers = len(taskThreads)
+        # Give workers already added time to show in the rate before adding more
+        if projected <= state["deadline"] or now - state["lastAdded"] < 30 or remaining <= workers:
+            return
+        if state["deadline"] > now:
+            wanted = int(-(-workers * (projected - now) // (state["deadline"] - now)))
+        else:
+            wanted = workers + deadlineWorkers
+        extra = min(wanted - workers, deadlineWorkers - state["extra"], remaining - workers)
+        if extra < 1:
+            return
+        add_workers(extra)
+        state["extra"] += extra
+        state["lastAdded"] = now
+    print(
+        "WARNING: Order "
+        + state["order"]
+        + " is projected to finish at "
+        + datetime.fromtimestamp(projected).strftime("%H:%M:%S")
+        + ", after its deadline of "
+        + datetime.fromtimestamp(state["deadline"]).strftime("%H:%M:%S")
+        + " - adding "
+        + str(extra)
+        + " workers"
+    )
+
+
+def start_deadline(orderName, deadline, numFiles, expectedBytes, model):
+    # Starts tracking an order with a deadline.  With a history of earlier downloads the time it will take
+    # is estimated up front and more workers are added at once if it looks likely to be late
+    state = {
+        "order": orderName,
+        "deadline": deadline,
+        "started": time.time(),
+        "files": numFiles,
+        "done": 0,
+        "extra": 0,
+        "lastAdded": 0,
+        "closed": False,
+        "estimate": None,
+        "projected": None,
+    }
+    if model is not None and expectedBytes > 0:
+        extra = 0
+        while True:
+            finish = state["started"] + estimate_download_time(model, numFiles, expectedBytes, numThreads + extra)
+            if extra == 0:
+                state["estimate"] = finish
+            if finish <= deadline or extra >= deadlineWorkers or numThreads + extra >= numFiles:
+                break
+            extra += 1
+        if extra > 0:
+            for i in range(extra):
+                taskThreads.append(threading.Thread(target=download_worker))
+            state["extra"] = extra
+            state["lastAdded"] = state["started"]
+            print(
+                "WARNING: Order "
+                + orderName
+                + " is estimated to miss its deadline so starting with "
+                + str(extra)
+                + " extra workers"
+            )
+    return state
+
+
+def print_deadline_report(report, reportFile):
+    # The projection is the last one made while the order was downloading, the estimate the one from history
+    print("Deadline Report")
+    print("===============")
+    newFile = not os.path.exists(reportFile)
+    with open(reportFile, "a", newline="") as csvFile:
+        writer = csv.writer(csvFile)
+        if newFile:
+            writer.writerow(["order", "started", "deadline", "estimate", "projected", "finished", "met", "extraworkers"])
+        for state in report:
+            times = [state["started"], state["deadline"], state["estimate"], state["projected"], state["finished"]]
+            labels = ["" if t is None else datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S") for t in times]
+            met = state["finished"] <= state["deadline"]
+            print(
+                "Order: "
+                + state["order"]
+                + " Deadline: "
+                + labels[1][11:]
+                + " Estimated: "
+                + (labels[2][11:] or "no history")
+                + " Projected: "
+                + (labels[3][11:] or "-")
+                + " Finished: "
+                + labels[4][11:]
+                + (" met" if met else " MISSED by " + str(round(state["finished"] - state["deadline"])) + "s")
+                + " Extra workers: "
+                + str(state["extra"])
+            )
+            writer.writerow([state["order"]] + labels + [met, state["extra"]])
+
+
+def lease_connection():
+    # Each thread keeps its own connection to the shared lease database
+    conn = getattr(leaseLocal, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(leaseFile, timeout=60, isolation_level=None)
+        leaseLocal.conn = conn
+    return conn
+
+
+def init_lease_store():
+    # The rollback journal is used as WAL mode does not work over network filesystems
+    conn = lease_connection()
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS leases ("
+        "orderName TEXT, cycle TEXT, fileId TEXT, owner TEXT, expires REAL, status TEXT, "
+        "PRIMARY KEY (orderName, cycle, fileId))"
+    )
+
+
+def claim_file_lease(orderName, cycle, fileId):
+    # Returns "claimed", "done" or "busy" along with the expiry time of the current lease
+    conn = lease_connection()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT owner, expires, status FROM leases WHERE orderName=? AND cycle=? AND fileId=?",
+            (orderName, cycle, fileId),
+        ).fetchone()
+        if row is None:
+            conn.execute(
+                "INSERT INTO leases VALUES (?, ?, ?, ?, ?, 'leased')",
+                (orderName, cycle, fileId, workerId, now + leaseTime),
+            )
+            result = ["claimed", now + leaseTime]
+        elif row[2] == "done":
+            result = ["done", row[1]]
+        elif row[0] == workerId or row[1] < now:
+            # Expired leases belong to a worker that has crashed or given up so can be taken over
+            conn.execute(
+                "UPDATE leases SET owner=?, expires=?, status='leased' WHERE orderName=? AND cycle=? AND fileId=?",
+                (workerId, now + leaseTime, orderName, cycle, fileId),
+            )
+            result = ["claimed", now + leaseTime]
+        else:
+            result = ["busy", row[1]]
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    if result[0] == "claimed":
+        with heldLeasesLock:
+            heldLeases[(orderName, cycle, fileId)] = result[1]
+
+    return result
+
+
+def finish_file_lease(orderName, cycle, fileId, done):
+    # Mark the file as done or release the lease straight away so another node can retry it
+    with heldLeasesLock:
+        heldLeases.pop((orderName, cycle, fileId), None)
+
+    conn = lease_connection()
+    if done:
+        conn.execute(
+            "UPDATE leases SET status='done' WHERE orderName=? AND cycle=? AND fileId=? AND owner=?",
+            (orderName, cycle, fileId, workerId),
+        )
+    else:
+        conn.execute(
+            "UPDATE leases SET expires=0 WHERE orderName=? AND cycle=? AND fileId=? AND owner=?",
+            (orderName, cycle, fileId, workerId),
+        )
+
+
+def renew_leases():
+    # Keep the leases for in-progress transfers alive so long downloads are not reclaimed
+    while True:
+        time.sleep(max(leaseTime / 3, 1))
+        with heldLeasesLock:
+            keys = list(heldLeases.keys())
+        if len(keys) == 0:
+            continue
+        conn = lease_connection()
+        expires = time.time() + leaseTime
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for key in keys:
+                conn.execute(
+                    "UPDATE leases SET expires=? WHERE orderName=? AND cycle=? AND fileId=? AND owner=? AND status='leased'",
+                    (expires, key[0], key[1], key[2], workerId),
+                )
+            conn.execute("COMMIT")
+        except Exception as exc:
+            conn.execute("ROLLBACK")
+            print("WARNING: renew_leases failed to renew", len(keys), "leases:", exc)
+
+
+def parse_api_keys(apikey, keyRates):
+    # One or more comma separated keys, each optionally held to a number of requests a second
+    keys = [key.strip() for key in apikey.split(",") if key.strip() != ""]
+    rates = [float(rate) for rate in keyRates.split(",")] if keyRates != "" else [0]
+    if len(rates) == 1:
+        rates = rates * len(keys)
+    if len(rates) != len(keys):
+        raise ValueError("one rate is needed for each key")
+    if min(rates, default=0) < 0:
+        raise ValueError("rates cannot be negative")
+    now = time.time()
+    return [
+        {
+            "key": key,
+            "name": "..." + key[-4:],
+            "rate": rate,
+            "tokens": rate,
+            "stamp": now,
+            "pausedUntil": 0,
+            "inflight": 0,
+            "requests": 0,
+            "throttled": 0,
+        }
+        for key, rate in zip(keys, rates)
+    ]
+
+
+def acquire_api_key():
+    # Spread requests over the keys - a key resting after a 429 or short of its rate is passed over
+    while True:
+        with apiKeyLock:
+            now = time.time()
+            best = None
+            bestScore = None
+            earliest = None
+            for apiKey in apiKeys:
+                if apiKey["pausedUntil"] > now:
+                    if earliest is None or apiKey["pausedUntil"] < earliest:
+                        earliest = apiKey["pausedUntil"]
+                    continue
+                wait = 0
+                if apiKey["rate"] > 0:
+                    tokens = min(apiKey["tokens"] + (now - apiKey["stamp"]) * apiKey["rate"], apiKey["rate"])
+                    wait = max(0, (1 - tokens) / apiKey["rate"])
+                if best is None or (wait, apiKey["inflight"]) < bestScore:
+                    best = apiKey
+                    bestScore = (wait, apiKey["inflight"])
+            if best is not None:
+                wait = 0
+                if best["rate"] > 0:
+                    best["tokens"] = min(best["tokens"] + (now - best["stamp"]) * best["rate"], best["rate"]) - 1
+                    best["stamp"] = now
+                    if best["tokens"] < 0:
+                        wait = -best["tokens"] / best["rate"]
+                best["inflight"] += 1
+                best["requests"] += 1
+        if best is not None:
+            if wait > 0:
+                time.sleep(wait)
+            return best
+        # Every key is resting
+        if threading.current_thread().name in heartbeats:
+            heartbeat("backoff")
+        time.sleep(max(earliest - now, 0.1))
+
+
+def release_api_key(apiKey):
+    with apiKeyLock:
+        apiKey["inflight"] -= 1
+
+
+def pause_api_key(apiKey, retryAfter, defaultWait):
+    # Honour Retry-After when it is given in seconds
+    wait = defaultWait
+    if retryAfter is not None and retryAfter.isdigit():
+        wait = int(retryAfter)
+    with apiKeyLock:
+        apiKey["pausedUntil"] = max(apiKey["pausedUntil"], time.time() + wait)
+        apiKey["throttled"] += 1
+    if verbose:
+        print("API key " + apiKey["name"] + " rate limited - resting it for " + str(wait) + "s")
+
+
+class DownloadTask:
+    # One per file - everything the files of a run share is in the one context dict they all point to,
+    # so a large order costs a few small objects per file rather than a dict of a dozen keys each
+    __slots__ = ("context", "fileId", "signedUrl", "resolved", "requeues", "hedge")
+
+    def __init__(self, context, fileId):
+        self.context = context
+        self.fileId = fileId
+        self.signedUrl = ""
+        self.resolved = False
+        self.requeues = 0
+        self.hedge = None
+
+
+def copy_task(downloadTask):
+    copied = DownloadTask(downloadTask.context, downloadTask.fileId)
+    copied.signedUrl = downloadTask.signedUrl
+    copied.requeues = downloadTask.requeues
+    return copied
+
+
+def queue_task(downloadTask, targetQueue=None):
+    # Live runs go before backfill, and backfill works back from the most recent date
+    if downloadTask is None:
+        priority = (2, 0)
+    elif downloadTask.hedge is not None:
+        # A hedge is only worth making straight away
+        priority = (-1, 0)
+    elif downloadTask.context["backdatedDate"] == "":
+        priority = (0, 0)
+    else:
+        priority = (1, -int(downloadTask.context["backdatedDate"]))
+    if targetQueue is None:
+        targetQueue = taskQueue
+    targetQueue.put((priority, next(taskCounter), downloadTask))
+
+
+def resolve_file_url(downloadTask):
+    # Ask the API where the file is without following the redirect - the transfer stage fetches it
+    if resolveRate > 0:
+        with bandwidthLock:
+            wait = take_bandwidth(" resolve", resolveRate, 1, time.time())
+        if wait > 0:
+            time.sleep(wait)
+
+    fileId = downloadTask.fileId
+    if downloadTask.context["backdatedDate"] != "":
+        fileId = fileId.replace("+", downloadTask.context["backdatedDate"])
+    url = requests.utils.quote(
+        downloadTask.context["baseUrl"] + "/orders/" + downloadTask.context["orderName"] + "/latest/" + fileId + "/data", safe=': /'
+    )
+    actualHeaders = {"Accept": "application/x-grib"}
+    actualHeaders.update(downloadTask.context["requestHeaders"])
+
+    startTime = time.time()
+    outcome = "failed"
+    failCount = 0
+    while failCount < 5:
+        apiKey = acquire_api_key()
+        actualHeaders["apikey"] = apiKey["key"]
+        try:
+            with faulty_get(url, headers=actualHeaders, allow_redirects=False, stream=True, verify=verifySSL,
+                              params={"dataSpec": downloadTask.context["dataSpec"]}, timeout=(connectTimeout, readTimeout)) as r:
+                if r.status_code == 429 and len(apiKeys) > 1:
+                    failCount += 1
+                    pause_api_key(apiKey, r.headers.get("Retry-After"), backoff_time_calculator(failCount, 5))
+                    continue
+                if r.is_redirect:
+                    downloadTask.signedUrl = urljoin(r.url, r.headers["Location"])
+                    if verbose and downloadTask.signedUrl.find("--") != -1:
+                        print("-- found in redirect: ", downloadTask.signedUrl)
+                    outcome = "resolved"
+                    break
+                if r.status_code == 200:
+                    # Served without a redirect so there is nothing to resolve
+                    outcome = "direct"
+                    break
+                reason = r.status_code
+        except requests.exceptions.RequestException as exc:
+            reason = exc
+        finally:
+            release_api_key(apiKey)
+        failCount += 1
+        if terminate or failCount == 5:
+            break
+        if verbose:
+            print("resolve_file_url: ", fileId, " failed ", reason)
+        time.sleep(backoff_time_calculator(failCount, 5))
+
+    with statsLock:
+        resolveStats[outcome] += 1
+        resolveStats["seconds"] += time.time() - startTime
+
+
+def resolve_worker():
+    # Resolve stage - the transfer workers are kept supplied without letting signed URLs go stale in the queue
+    while True:
+        downloadTask = resolveQueue.get()[2]
+        if downloadTask is None:
+            break
+        try:
+            alreadyThere = fillGaps and outputSink.exists(
+                local_file_name(downloadTask.context["folder"], downloadTask.fileId, downloadTask.context["guidFileNames"])
+            )
+        except Exception:
+            # Left to the transfer worker, which reports whatever went wrong
+            alreadyThere = False
+        if not terminate and not alreadyThere:
+            resolve_file_url(downloadTask)
+        # Anything not resolved is requested from the API by the transfer worker as usual
+        resolvedSlots.acquire()
+        downloadTask.resolved = True
+        queue_task(downloadTask)
+        resolveQueue.task_done()
+
+
+def requeue_task(downloadTask):
+    # The task is only marked done once it is back on the queue so join() keeps waiting for it
+    queue_task(downloadTask)
+    taskQueue.task_done()
+
+
+def parse_backdated_dates(backdated):
+    # Accepts YYYYMMDD, a YYYYMMDD-YYYYMMDD range or a comma separated list of either
+    dates = []
+    for part in backdated.split(","):
+        for date in part.split("-"):
+            if len(date) != 8:
+                raise ValueError("Date " + date + " is not in YYYYMMDD form")
+        if "-" in part:
+            fromDate, toDate = part.split("-")
+            day = datetime.strptime(fromDate, "%Y%m%d")
+            lastDay = datetime.strptime(toDate, "%Y%m%d")
+            if day > lastDay:
+                raise ValueError("Range " + part + " ends before it starts")
+            while day <= lastDay:
+                dates.append(day.strftime("%Y%m%d"))
+                day = day + timedelta(days=1)
+        else:
+            datetime.strptime(part, "%Y%m%d")
+            dates.append(part)
+    return dates
 
 
 def download_worker():
     if verbose:
         print(threading.current_thread())
+    heartbeat("idle")
     if taskQueue: 
         while True:
-            downloadTask = taskQueue.get()
+            downloadTask = taskQueue.get()[2]
             if downloadTask is None:
                 break
+            if downloadTask.resolved:
+                downloadTask.resolved = False
+                resolvedSlots.release()
+
+            if downloadTask.hedge is not None:
+                run_hedge(downloadTask)
+                taskQueue.task_done()
+                continue
+
+            if terminate:
+                # The run has been aborted so just record what was not attempted
+                downloadTask.context["downloadErrorLog"].append(failure_record(downloadTask))
+                downloadTask.context["responseLog"].append(
+                    {
+                        "order": downloadTask.context["orderName"],
+                        "fileId": downloadTask.fileId,
+                        "error": True,
+                        "fileSize": 0,
+                        "errMsg": "Run aborted",
+                        "time_to_first_byte": 0,
+                        "duration": 0,
+                        "file": "",
+                        "currentTime": datetime.now().strftime("%H-%M-%S-%f"),
+                    }
+                )
+                taskQueue.task_done()
+                continue
+
+            if leaseFile != "":
+                lease = claim_file_lease(
+                    downloadTask.context["orderName"], downloadTask.context["cycle"], downloadTask.fileId
+                )
+                if lease[0] == "done":
+                    if verbose:
+                        print("File: " + downloadTask.fileId + " already downloaded by another worker")
+                    if downloadTask.context["stamp"] != "":
+                        mark_file_done(downloadTask.context["orderName"], downloadTask.context["stamp"], downloadTask.fileId)
+                    taskQueue.task_done()
+                    continue
+                if lease[0] == "busy":
+                    # Another node holds the lease - check again when it is due to expire
+                    delay = min(max(lease[1] - time.time(), 1), 30)
+                    threading.Timer(delay, requeue_task, [downloadTask]).start()
+                    continue
 
             current_time = datetime.now().strftime("%H-%M-%S-%f")
 
@@ -298,49 +2340,90 @@ def download_worker():
             error = False
             timeToFirstByte = 0
             startTime = time.time()
+            stalled = False
+            with heartbeatLock:
+                beat = heartbeats[threading.current_thread().name]
+                beat["fileId"] = downloadTask.fileId
+                beat["task"] = downloadTask
+                beat["hedge"] = None
+                beat.pop("throughput", None)
+            start_transfer(downloadTask.context["orderName"])
             try:
                 downloadResp = get_order_file(
-                    downloadTask["baseUrl"],
-                    downloadTask["requestHeaders"],
-                    downloadTask["orderName"],
-                    downloadTask["fileId"],
-                    downloadTask["guidFileNames"],
-                    downloadTask["folder"],
+                    downloadTask.context["baseUrl"],
+                    downloadTask.context["requestHeaders"],
+                    downloadTask.context["orderName"],
+                    downloadTask.fileId,
+                    downloadTask.context["guidFileNames"],
+                    downloadTask.context["folder"],
                     startTime,
-                    downloadTask["backdatedDate"],
-                    downloadTask["dataSpec"]
+                    downloadTask.context["backdatedDate"],
+                    downloadTask.context["dataSpec"],
+                    signedUrl=downloadTask.signedUrl
                 )
                 timeToFirstByte = round((downloadResp[0] - startTime), 2)
                 downloadedFile = downloadResp[1]
-                fileSize = os.path.getsize(downloadedFile)
+                fileSize = outputSink.size(downloadedFile)
 
             except Exception as ex:
                 error = True
                 errMsg = ex.args
+                # A read timeout or dropped connection is treated like a stall the monitor caught
+                stalled = isinstance(ex, (requests.exceptions.Timeout, requests.exceptions.ConnectionError))
+
+            end_transfer(downloadTask.context["orderName"])
+            heartbeat("idle")
+
+            with heartbeatLock:
+                hedge = beat["hedge"]
+                beat["task"] = None
+            if hedge is not None and (error or hedge["winner"] == "hedge"):
+                # Whichever of the two finished first decides the outcome
+                hedge["finished"].wait()
+                if hedge["winner"] == "hedge":
+                    if error:
+                        timeToFirstByte = round((hedge["ttfb"] - startTime), 2)
+                    error = False
+                    stalled = False
+                    errMsg = ""
+                    downloadedFile = hedge["filename"]
+                    fileSize = outputSink.size(downloadedFile)
+                    stalled_abort()
+            elif not error and "throughput" in beat:
+                with statsLock:
+                    runTtfbs.append(timeToFirstByte)
+                    runThroughputs.append(beat.pop("throughput"))
+
+            if stalled_abort() or (error and stalled):
+                stalled = True
+            if error and stalled and not terminate:
+                downloadTask.requeues = downloadTask.requeues + 1
+                if downloadTask.requeues <= maxStallRequeues:
+                    requeue_task(downloadTask)
+                    continue
+                errMsg = ("Stalled " + str(downloadTask.requeues) + " times",)
+
+            if not error and cropPool is not None:
+                queue_crop(downloadedFile)
+
+            if deadlineState is not None:
+                with deadlineLock:
+                    deadlineState["done"] += 1
 
             completeTime = time.time()
             completeDuration = round((completeTime - startTime), 2)
 
-            if error:
-                downloadTask["downloadErrorLog"].append(
-                    {
-                        "URL": downloadTask["baseUrl"]
-                               + "/orders/"
-                               + downloadTask["orderName"]
-                               + "/latest/"
-                               + downloadTask["fileId"]
-                               + "/data",
-                        "fileid": downloadTask["fileId"],
-                        "currentTime": current_time,
-                        "ordername": downloadTask["orderName"],
-                        "folder": downloadTask["folder"],
-                        "dataSpec": downloadTask["dataSpec"]
-                    }
+            if leaseFile != "":
+                finish_file_lease(
+                    downloadTask.context["orderName"], downloadTask.context["cycle"], downloadTask.fileId, not error
                 )
-                downloadTask["responseLog"].append(
+
+            if error:
+                downloadTask.context["downloadErrorLog"].append(failure_record(downloadTask))
+                downloadTask.context["responseLog"].append(
                     {
-                        "order": downloadTask["orderName"],
-                        "fileId": downloadTask["fileId"],
+                        "order": downloadTask.context["orderName"],
+                        "fileId": downloadTask.fileId,
                         "error": error,
                         "fileSize": fileSize,
                         "errMsg": errMsg,
@@ -353,16 +2436,19 @@ def download_worker():
                 if verbose:
                     print(
                         "File: "
-                        + downloadTask["fileId"]
+                        + downloadTask.fileId
                         + " failed "
                         + format(errMsg)
                         + "\n"
                     )
             else:
-                downloadTask["responseLog"].append(
+                record_file_map(downloadTask.context["folder"], downloadTask.fileId, downloadedFile)
+                if downloadTask.context["stamp"] != "":
+                    mark_file_done(downloadTask.context["orderName"], downloadTask.context["stamp"], downloadTask.fileId)
+                downloadTask.context["responseLog"].append(
                     {
-                        "order": downloadTask["orderName"],
-                        "fileId": downloadTask["fileId"],
+                        "order": downloadTask.context["orderName"],
+                        "fileId": downloadTask.fileId,
                         "error": error,
                         "fileSize": fileSize,
                         "errMsg": errMsg,
@@ -375,6 +2461,27 @@ def download_worker():
 
             taskQueue.task_done()
 
+    with heartbeatLock:
+        del heartbeats[threading.current_thread().name]
+
+
+def failure_record(downloadTask):
+    return {
+        "URL": downloadTask.context["baseUrl"]
+               + "/orders/"
+               + downloadTask.context["orderName"]
+               + "/latest/"
+               + downloadTask.fileId
+               + "/data",
+        "fileid": downloadTask.fileId,
+        "currentTime": datetime.now().strftime("%H-%M-%S-%f"),
+        "ordername": downloadTask.context["orderName"],
+        "folder": downloadTask.context["folder"],
+        "dataSpec": downloadTask.context["dataSpec"],
+        "backdatedDate": downloadTask.context["backdatedDate"],
+        "stamp": downloadTask.context["stamp"]
+    }
+
 
 def write_failures(downloadErrorLog, fileName):
     if len(downloadErrorLog) == 0:
@@ -387,7 +2494,7 @@ def write_failures(downloadErrorLog, fileName):
     failurefile.close()
 
 
-def write_summary(responseLog, fileName, sstartTime):
+def write_summary(responseLog, fileName, sstartTime, modelName):
     endTime = datetime.now()
 
     if len(responseLog) == 0:
@@ -418,6 +2525,8 @@ def write_summary(responseLog, fileName, sstartTime):
             + str(fileSizeTotal)
             + " Workers: "
             + str(numThreads)
+            + " Model: "
+            + modelName.replace(" ", "-")
             + "\n"
         )
         csvfile.write("===== Detail Section =====\n")
@@ -453,6 +2562,80 @@ def write_summary(responseLog, fileName, sstartTime):
             )
 
 
+def select_order_runs(myOrders, orderName, orderRuns, myModelList, myModelRuns, backdatedDates):
+    # Work out which runs (and dates) of an order to queue - returns None if there are none
+    finalRuns = []
+    modelToGet = ""
+    if orderRuns == "":
+        runsToDownload = ["00", "06", "12", "18"]
+        runsToQueue = [[run, "", date] for date in backdatedDates for run in runsToDownload]
+        finalRuns = runsToDownload
+    else:
+        if orderRuns == "latest":
+            modelToGet = get_model_from_order(myOrders, orderName)
+            if modelToGet not in myModelList:
+                print(
+                    "ERROR: No idea what model: "
+                    + modelToGet
+                    + " is so terminating!"
+                )
+                sys.exit(7)
+            runStamps = get_latest_run(modelToGet, orderName, myModelRuns)
+            if len(runStamps) == 0:
+                if verbose:
+                    print(
+                        "We have done this latest run "
+                        + myModelRuns[modelToGet][:2]
+                        + " already!"
+                    )
+                return None
+            # Do I want these runs?
+            finalRuns = []
+            runsToQueue = []
+            for runStamp in runStamps:
+                checkRun = runStamp[-2:]
+                if run_wanted(myOrders, orderName, checkRun):
+                    if verbose:
+                        print("This run " + runStamp + " is wanted.")
+                    runsToQueue.append([checkRun, runStamp, ""])
+                    if checkRun not in finalRuns:
+                        finalRuns.append(checkRun)
+                else:
+                    if verbose:
+                        print("This run " + runStamp + " is not wanted")
+                    if not planMode:
+                        skip_run(orderName, runStamp)
+
+            runsToDownload = finalRuns
+
+        else:
+            runsToDownload = orderRuns.split(",")
+            finalRuns = []
+            # Ensure only runs wanted are asked for
+            for checkRun in runsToDownload:
+                if run_wanted(myOrders, orderName, checkRun):
+                    finalRuns.append(checkRun)
+                else:
+                    print(
+                        "WARNING: The run "
+                        + checkRun
+                        + " has been asked for but doesn't appear in the order "
+                        + orderName
+                    )
+            runsToDownload = finalRuns
+            runsToQueue = [[run, "", date] for date in backdatedDates for run in runsToDownload]
+
+    if len(finalRuns) == 0:
+        print(
+            "WARNING: No runs for order "
+            + orderName
+            + "were found.  Don't expect any data."
+        )
+        return None
+
+    return [runsToDownload, runsToQueue, modelToGet]
+
+
 def get_my_orders(baseUrl, requestHeaders):
     if perfMode:
         print("PM ", inspect.stack()[0][3], " started")
@@ -467,7 +2650,7 @@ def get_my_orders(baseUrl, requestHeaders):
     failCount = 0
     while True:
         try:
-            ordr = requests.get(ordurl, headers=ordHeaders, verify=verifySSL)
+            ordr = http_get(ordurl, headers=ordHeaders, verify=verifySSL)
             ordr.raise_for_status()
         except Exception as exc:
             print("EXCEPTION: get_my_orders failed " + str(failCount + 1) + " time(s)")
@@ -520,7 +2703,54 @@ def get_my_orders(baseUrl, requestHeaders):
     return orddetails
 
 
+def open_state_store(fileName):
+    global stateConn
+    stateConn = sqlite3.connect(fileName, timeout=60, check_same_thread=False)
+    stateConn.execute(
+        "CREATE TABLE IF NOT EXISTS runs ("
+        "orderName TEXT, stamp TEXT, status TEXT, attempts INTEGER, PRIMARY KEY (orderName, stamp))"
+    )
+    stateConn.execute(
+        "CREATE TABLE IF NOT EXISTS files ("
+        "orderName TEXT, stamp TEXT, fileId TEXT, PRIMARY KEY (orderName, stamp, fileId))"
+    )
+    stateConn.execute(
+        "CREATE TABLE IF NOT EXISTS published (model TEXT, modelRun TEXT, seen REAL, PRIMARY KEY (model, modelRun))"
+    )
+    stateConn.commit()
+
+
+def run_published_at(model, modelRun):
+    # The first time the run was seen published.  With --runs latest this is kept in the state store so a
+    # run resumed by a later call keeps its original deadline
+    now = time.time()
+    if stateConn is None:
+        return now
+    with stateLock:
+        stateConn.execute("INSERT OR IGNORE INTO published VALUES (?, ?, ?)", (model, modelRun, now))
+        seen = stateConn.execute(
+            "SELECT seen FROM published WHERE model=? AND modelRun=?", (model, modelRun)
+        ).fetchone()[0]
+        stateConn.commit()
+    return seen
+
+
+def migrate_latest_file(orderName):
+    # Carry over the stamp from the old latest/{order}.txt file the first time an order is seen
+    latestFile = baseFolder + LATEST_FOLDER + "/" + orderName + ".txt"
+    if not os.path.exists(latestFile):
+        return
+    row = stateConn.execute("SELECT COUNT(*) FROM runs WHERE orderName=?", (orderName,)).fetchone()
+    if row[0] > 0:
+        return
+    rf = open(latestFile, "r")
+    laststamp = rf.read()[:13]
+    rf.close()
+    stateConn.execute("INSERT INTO runs VALUES (?, ?, 'complete', 0)", (orderName, laststamp))
+
+
 def get_latest_run(modelID, orderName, modelRuns):
+    # Returns the YYYY-MM-DD:HH stamps of every run not yet completely downloaded for the order
     latestRun = modelRuns[modelID][:2]
     latestDate = modelRuns[modelID][3:]
     stamp = latestDate[:10] + ":" + latestRun
@@ -528,45 +2758,169 @@ def get_latest_run(modelID, orderName, modelRuns):
     # Determine increment to add to get missed runs
     if "uk" in modelID:
         runIncrement = 1
-        maxRuns = 24
     else:
         runIncrement = 6
-        maxRuns = 4
-
-    if not os.path.exists(baseFolder + LATEST_FOLDER + "/" + orderName + ".txt"):
-        # File not there - so write it and return latest run
-        # No attempt to get backdated runs
-        rf = open(baseFolder + LATEST_FOLDER + "/" + orderName + ".txt", "w")
-        rf.write(stamp)
-        rf.close()
-    else:
-        # Open the file and retrieve the last run
-        rf = open(baseFolder + LATEST_FOLDER + "/" + orderName + ".txt", "r")
-        laststamp = rf.read()
-        rf.close()
-        # Check to see if the latest is later than the last run
-        if stamp > laststamp:
-            # This is the place where we write the updated latest file - now moved to end of cycle
 
+    with stateLock:
+        migrate_latest_file(orderName)
+        row = stateConn.execute("SELECT MAX(stamp) FROM runs WHERE orderName=?", (orderName,)).fetchone()
+        if row[0] is None:
+            # First time for this order - no attempt to get backdated runs
+            stateConn.execute("INSERT INTO runs VALUES (?, ?, 'pending', 0)", (orderName, stamp))
+        elif stamp > row[0]:
             # Now work out what runs we've missed
             stampDate = datetime.strptime(stamp, "%Y-%m-%d:%H")
-            laststampDate = datetime.strptime(laststamp[:13], "%Y-%m-%d:%H")
-            latestRun = ""
-            # Need to check we aren't asking for too many dates
+            laststampDate = datetime.strptime(row[0], "%Y-%m-%d:%H")
             while laststampDate < stampDate:
                 laststampDate = laststampDate + timedelta(hours=runIncrement)
-                newHour = laststampDate.strftime("%H")
-                if latestRun == "":
-                    latestRun = newHour
-                else:
-                    latestRun = latestRun + "," + newHour
-            # OK if it was a long time ago this could have led to too many runs
-            latestRun = latestRun[((-1) * maxRuns * 3) + 1:]
+                stateConn.execute(
+                    "INSERT OR IGNORE INTO runs VALUES (?, ?, 'pending', 0)",
+                    (orderName, laststampDate.strftime("%Y-%m-%d:%H")),
+                )
+        pending = stateConn.execute(
+            "SELECT stamp FROM runs WHERE orderName=? AND status='pending' ORDER BY stamp",
+            (orderName,),
+        ).fetchall()
+        # A plan must not change what the next real download will do
+        if planMode:
+            stateConn.rollback()
+        else:
+            stateConn.commit()
+
+    return [p[0] for p in pending]
+
+
+def get_done_files(orderName, stamp):
+    with stateLock:
+        rows = stateConn.execute(
+            "SELECT fileId FROM files WHERE orderName=? AND stamp=?", (orderName, stamp)
+        ).fetchall()
+    return set(r[0] for r in rows)
+
+
+def mark_file_done(orderName, stamp, fileId):
+    # Completions are committed in small batches rather than one transaction per file
+    global lastStateFlush
+    with stateLock:
+        pendingDone.append((orderName, stamp, fileId))
+        if len(pendingDone) >= 50 or time.time() - lastStateFlush > 1:
+            stateConn.executemany("INSERT OR IGNORE INTO files VALUES (?, ?, ?)", pendingDone)
+            stateConn.commit()
+            pendingDone.clear()
+            lastStateFlush = time.time()
+
+
+def flush_state():
+    with stateLock:
+        if len(pendingDone) > 0:
+            stateConn.executemany("INSERT OR IGNORE INTO files VALUES (?, ?, ?)", pendingDone)
+            stateConn.commit()
+            pendingDone.clear()
+
+
+def skip_run(orderName, stamp):
+    with stateLock:
+        stateConn.execute(
+            "UPDATE runs SET status='skipped' WHERE orderName=? AND stamp=?", (orderName, stamp)
+        )
+        stateConn.commit()
+
+
+def finish_run(orderName, stamp, fileIds, countAttempt):
+    # Marks the run complete once every file is done, or abandons it after too many attempts
+    flush_state()
+    doneFiles = get_done_files(orderName, stamp)
+    missing = 0
+    for fileId in fileIds:
+        if fileId not in doneFiles:
+            missing += 1
+
+    with stateLock:
+        if countAttempt:
+            stateConn.execute(
+                "UPDATE runs SET attempts=attempts+1 WHERE orderName=? AND stamp=?", (orderName, stamp)
+            )
+        attempts = stateConn.execute(
+            "SELECT attempts FROM runs WHERE orderName=? AND stamp=?", (orderName, stamp)
+        ).fetchone()[0]
+        if missing == 0:
+            status = "complete"
+        elif attempts >= maxRunAttempts:
+            status = "abandoned"
+        else:
+            status = "pending"
+        stateConn.execute(
+            "UPDATE runs SET status=? WHERE orderName=? AND stamp=?", (status, orderName, stamp)
+        )
+        stateConn.commit()
+
+    return [status, missing]
+
+
+def get_model_run(baseUrl, runHeaders, model):
+    requrl = baseUrl + "/runs/" + model + "?sort=RUNDATETIME"
+
+    for loop in range(retryCount):
+        if perfMode:
+            print("PM ", inspect.stack()[0][3], " model=", model, " started ")
+            pmstart2 = datetime.now()
+
+        try:
+            reqr = http_get(requrl, headers=runHeaders, verify=verifySSL)
+            reqr.raise_for_status()
+        except Exception as exc:
+            print("EXCEPTION: get_model_runs failed first time")
+            print(traceback.format_exc())
+            print(exc)
+            time.sleep(5)
+            try:
+                reqr = http_get(requrl, headers=runHeaders, verify=verifySSL)
+                reqr.raise_for_status()
+            except Exception as exctwo:
+                print("EXCEPTION: get_model_runs failed second time")
+                print(exctwo)
+                #                   raise SystemError(exctwo)
+                sys.exit(9)
+
+        if perfMode:
+            pmend2 = datetime.now()
+            delta2 = round((pmend2 - pmstart2).total_seconds() * 1000)
+            print(
+                "PM ",
+                inspect.stack()[0][3],
+                " model=",
+                model,
+                " executed in ",
+                str(delta2),
+                "ms",
+                "API URL:",
+                requrl,
+            )
 
-        else:
-            latestRun = "done" + ":" + latestRun
+        if printUrl == True:
+            print("get_model_runs: ", requrl)
+            if requrl != reqr.url:
+                print("redirected to: ", reqr.url)
+
+        if reqr.status_code != 200:
+            print(
+                "ERROR:  Unable to get latest run for model: "
+                + model
+                + " status code: ",
+                reqr.status_code,
+            )
+            if loop != (retryCount - 1):
+                time.sleep(10)
+                continue
+            else:
+                print("ERROR:  Ran out of retries to get latest run for model: ")
+                break
+
+        rundetails = reqr.json()
+        rawlatest = rundetails["completeRuns"]
+        return rawlatest[0]["run"] + ":" + rawlatest[0]["runDateTime"]
 
-    return latestRun
+    return None
 
 
 def get_model_runs(baseUrl, requestHeaders, modelList):
@@ -579,70 +2933,11 @@ def get_model_runs(baseUrl, requestHeaders, modelList):
     runHeaders = {"Accept": "application/json"}
     runHeaders.update(requestHeaders)
 
-    for model in modelList:
-        requrl = baseUrl + "/runs/" + model + "?sort=RUNDATETIME"
-
-        for loop in range(retryCount):
-            if perfMode:
-                print("PM ", inspect.stack()[0][3], " model=", model, " started ")
-                pmstart2 = datetime.now()
-
-            try:
-                reqr = requests.get(requrl, headers=runHeaders, verify=verifySSL)
-                reqr.raise_for_status()
-            except Exception as exc:
-                print("EXCEPTION: get_model_runs failed first time")
-                print(traceback.format_exc())
-                print(exc)
-                time.sleep(5)
-                try:
-                    reqr = requests.get(requrl, headers=runHeaders, verify=verifySSL)
-                    reqr.raise_for_status()
-                except Exception as exctwo:
-                    print("EXCEPTION: get_model_runs failed second time")
-                    print(exctwo)
-                    #                   raise SystemError(exctwo)
-                    sys.exit(9)
-
-            if perfMode:
-                pmend2 = datetime.now()
-                delta2 = round((pmend2 - pmstart2).total_seconds() * 1000)
-                print(
-                    "PM ",
-                    inspect.stack()[0][3],
-                    " model=",
-                    model,
-                    " executed in ",
-                    str(delta2),
-                    "ms",
-                    "API URL:",
-                    requrl,
-                )
-
-            if printUrl == True:
-                print("get_model_runs: ", requrl)
-                if requrl != reqr.url:
-                    print("redirected to: ", reqr.url)
-
-            if reqr.status_code != 200:
-                print(
-                    "ERROR:  Unable to get latest run for model: "
-                    + model
-                    + " status code: ",
-                    reqr.status_code,
-                )
-                if loop != (retryCount - 1):
-                    time.sleep(10)
-                    continue
-                else:
-                    print("ERROR:  Ran out of retries to get latest run for model: ")
-                    break
-
-            rundetails = reqr.json()
-            rawlatest = rundetails["completeRuns"]
-            modelRuns[model] = rawlatest[0]["run"] + ":" + rawlatest[0]["runDateTime"]
-            break
-        # endFor=True
+    # The models are looked up at the same time
+    with concurrent.futures.ThreadPoolExecutor(max_workers=metadataWorkers) as pool:
+        for model, latest in zip(modelList, pool.map(lambda model: get_model_run(baseUrl, runHeaders, model), modelList)):
+            if latest is not None:
+                modelRuns[model] = latest
 
     if perfMode:
         pmend = datetime.now()
@@ -764,128 +3059,519 @@ if __name__ == "__main__":
         help="Add the YYYYMMDDhhmm_RR to the download folder.",
     )
     parser.add_argument(
-        "-l",
-        "--location",
+        "-l",
+        "--location",
+        action="store",
+        dest="location",
+        default="",
+        help="The base folder to store files",
+    )
+    parser.add_argument(
+        "-m",
+        "--modellist",
+        action="store",
+        dest="modellist",
+        default=MODEL_LIST,
+        help="Pass the ist of models to support.",
+    )
+    parser.add_argument(
+        "-a",
+        "--retry",
+        action="store_true",
+        dest="retry",
+        default=False,
+        help="Retry again the failures automatically.",
+    )
+    parser.add_argument(
+        "-p",
+        "--retryperiod",
+        action="store",
+        dest="retryperiod",
+        default="30",
+        help="Retry delay in seconds.",
+    )
+    parser.add_argument(
+        "-t",
+        "--perftime",
+        action="store",
+        dest="perftime",
+        default="10",
+        help="When in performance testing mode file delivery time over which it should be reported - default 10s.",
+    )
+    parser.add_argument(
+        "-x",
+        "--printurl",
+        action="store_true",
+        dest="printurl",
+        default=False,
+        help="Print all accessed URLs and redirects",
+    )
+    parser.add_argument(
+        "-z",
+        "--debug",
+        action="store_true",
+        dest="debugmode",
+        default=False,
+        help="Switch to debug mode - fails some file requests as --faults " + DEBUG_FAULTS + " does.",
+    )
+    parser.add_argument(
+        "-y",
+        "--perfmode",
+        action="store_true",
+        dest="perfmode",
+        default=False,
+        help="Switch on performance monitor.",
+    )
+    parser.add_argument(
+        "-k",
+        "--apikey",
+        action="store",
+        dest="apikey",
+        default="",
+        help="REQUIRED: Your WDH API Credentials. Several keys can be given separated by commas.",
+    )
+    parser.add_argument(
+        "-kr",
+        "--keyrates",
+        action="store",
+        dest="keyRates",
+        default="",
+        help="Maximum requests per second for each API key, separated by commas, or one value for all. Defaults to no limit.",
+    )
+    parser.add_argument(
+        "-b",
+        "--backdated",
+        action="store",
+        dest="backdateddate",
+        default="",
+        help="OPTIONAL: Date in YYYYMMDD, range YYYYMMDD-YYYYMMDD or comma separated list of them to explicitly attempt to get files from.",
+    )
+    parser.add_argument(
+        "-f",
+        "--savefilelist",
+        action="store_true",
+        dest="savefilelist",
+        default=False,
+        help="Save the filelist in a file called ordername_{date_time}.json.",
+    )
+    parser.add_argument(
+        "-q",
+        "--verifyssloff",
+        action="store_false",
+        dest="verifyssl",
+        default=True,
+        help="Turn off the verification of SSL on requests.get.",
+    )
+    parser.add_argument(
+        "-g",
+        "--fillgaps",
+        action="store_true",
+        dest="fillgaps",
+        default=False,
+        help="Optional: Only download the gaps in files if selected"
+    )
+
+    parser.add_argument(
+        "-ds",
+        "--dataspec",
+        action="store",
+        dest="dataSpec",
+        default=DEFAULT_DATA_SPEC,
+        help="The version of the data that needs retrieving. Defaults to 1.0.0",
+    )
+
+    parser.add_argument(
+        "-fds",
+        "--folderdataspec",
+        action="store_true",
+        dest="folderDataSpec",
+        default=False,
+        help="Splits downloaded data and other output files into versioned folders"
+    )
+
+    parser.add_argument(
+        "-pa",
+        "--preallocate",
+        action="store_true",
+        dest="preallocate",
+        default=False,
+        help="Preallocate each file from its Content-Length and check disk space before each order.",
+    )
+
+    parser.add_argument(
+        "-wb",
+        "--writebuffer",
+        action="store",
+        dest="writeBuffer",
+        default=8192,
+        type=int,
+        help="Size in bytes of each write to disk. Defaults to 8192.",
+    )
+
+    parser.add_argument(
+        "-fs",
+        "--fsyncevery",
+        action="store",
+        dest="fsyncEvery",
+        default=0,
+        type=int,
+        help="With --preallocate flush files to disk after every N MB written and at the end. Defaults to 0 (never).",
+    )
+
+    parser.add_argument(
+        "-mb",
+        "--maxbandwidth",
+        action="store",
+        dest="maxBandwidth",
+        default=0,
+        type=float,
+        help="Maximum download rate in MB/s shared by all workers. Defaults to 0 (unlimited).",
+    )
+
+    parser.add_argument(
+        "-ow",
+        "--orderweights",
+        action="store",
+        dest="orderWeights",
+        default="",
+        help="OPTIONAL: Comma separated order:weight list used to share --maxbandwidth between orders.",
+    )
+
+    parser.add_argument(
+        "-bb",
+        "--backfillbandwidth",
+        action="store",
+        dest="backfillBandwidth",
+        default=0,
+        type=float,
+        help="Maximum download rate in MB/s for backdated and catch-up runs. Defaults to 0 (unlimited).",
+    )
+
+    parser.add_argument(
+        "-pl",
+        "--plan",
+        action="store_true",
+        dest="planMode",
+        default=False,
+        help="Work out the files that would be downloaded and estimate the size and time taken without downloading.",
+    )
+
+    parser.add_argument(
+        "-cd",
+        "--coordinate",
+        action="store",
+        dest="leaseFile",
+        default="",
+        help="OPTIONAL: Shared SQLite lease file used to split the files of a run across several hosts.",
+    )
+
+    parser.add_argument(
+        "-lt",
+        "--leasetime",
+        action="store",
+        dest="leaseTime",
+        default=300,
+        type=int,
+        help="Seconds a file lease is held before another worker may reclaim it. Defaults to 300.",
+    )
+
+    parser.add_argument(
+        "-wi",
+        "--workerid",
+        action="store",
+        dest="workerId",
+        default="",
+        help="Name of this worker in the lease file. Defaults to hostname:pid.",
+    )
+
+    parser.add_argument(
+        "-st",
+        "--stalltimeout",
+        action="store",
+        dest="stallTimeout",
+        default=120,
+        type=int,
+        help="Seconds a request or transfer may make no progress before it is aborted and requeued. Defaults to 120.",
+    )
+
+    parser.add_argument(
+        "-ct",
+        "--connecttimeout",
+        action="store",
+        dest="connectTimeout",
+        default=10,
+        type=float,
+        help="Seconds allowed to connect to the server. Defaults to 10.",
+    )
+
+    parser.add_argument(
+        "-rt",
+        "--readtimeout",
+        action="store",
+        dest="readTimeout",
+        default=60,
+        type=float,
+        help="Seconds allowed between bytes received. Defaults to 60.",
+    )
+
+    parser.add_argument(
+        "-mt",
+        "--minthroughput",
+        action="store",
+        dest="minThroughput",
+        default=0,
+        type=float,
+        help="Requeue a download running at less than this many KB/s. Defaults to 0 (off).",
+    )
+
+    parser.add_argument(
+        "-hp",
+        "--hedgepercentile",
+        action="store",
+        dest="hedgePercentile",
+        default=0,
+        type=float,
+        help="Duplicate a request whose time to first byte or throughput is worse than this percentile of the order so far. Defaults to 0 (off).",
+    )
+
+    parser.add_argument(
+        "-rw",
+        "--resolveworkers",
+        action="store",
+        dest="resolveWorkers",
+        default=0,
+        type=int,
+        help="Number of threads resolving file requests to storage URLs ahead of the download workers. Defaults to 0 (off).",
+    )
+
+    parser.add_argument(
+        "-rr",
+        "--resolverate",
+        action="store",
+        dest="resolveRate",
+        default=0,
+        type=float,
+        help="Maximum API requests per second made by the resolve threads. Defaults to 0 (no limit).",
+    )
+
+    parser.add_argument(
+        "-ly",
+        "--layout",
+        action="store",
+        dest="fileLayout",
+        default="flat",
+        choices=["flat", "hash", "param"],
+        help="Files all in the run folder (flat) or spread over sub folders by hash prefix (hash) or by parameter (param). Defaults to flat.",
+    )
+
+    parser.add_argument(
+        "-pb",
+        "--publish",
+        action="store_true",
+        dest="publishRuns",
+        default=False,
+        help="Download each run into a staging folder and publish it with a manifest when complete.",
+    )
+
+    parser.add_argument(
+        "-vf",
+        "--verify",
+        action="store_true",
+        dest="verify",
+        default=False,
+        help="Check the downloaded GRIB2 files of the runs being downloaded first, and download the corrupt ones again.",
+    )
+
+    parser.add_argument(
+        "-s3",
+        "--s3url",
+        action="store",
+        dest="s3Url",
+        default="",
+        help="Stream the files to an S3 compatible object store, given as s3://bucket/prefix, instead of --location.",
+    )
+
+    parser.add_argument(
+        "-se",
+        "--s3endpoint",
+        action="store",
+        dest="s3Endpoint",
+        default="",
+        help="Endpoint URL of the object store when it is not AWS S3, for example http://localhost:9000 for MinIO.",
+    )
+
+    parser.add_argument(
+        "-ps",
+        "--partsize",
+        action="store",
+        dest="partSize",
+        default=8,
+        type=int,
+        help="Size in MB of each part of an object store upload. Defaults to 8.",
+    )
+
+    parser.add_argument(
+        "-up",
+        "--uploadparallelism",
         action="store",
-        dest="location",
-        default="",
-        help="The base folder to store files",
+        dest="uploadParallelism",
+        default=4,
+        type=int,
+        help="Number of parts of each file uploaded at once. Defaults to 4.",
     )
+
     parser.add_argument(
-        "-m",
-        "--modellist",
+        "-ar",
+        "--archive",
         action="store",
-        dest="modellist",
-        default=MODEL_LIST,
-        help="Pass the ist of models to support.",
+        dest="archiveFormat",
+        default="",
+        choices=["tar", "zip"],
+        help="Stream the files of each run into a single tar or zip archive instead of separate files.",
     )
+
     parser.add_argument(
-        "-a",
-        "--retry",
-        action="store_true",
-        dest="retry",
-        default=False,
-        help="Retry again the failures automatically.",
+        "-az",
+        "--archivecompression",
+        action="store",
+        dest="archiveCompression",
+        default="store",
+        choices=["store", "zstd"],
+        help="Store archive members as they are or compress each with zstd. Defaults to store.",
     )
+
     parser.add_argument(
-        "-p",
-        "--retryperiod",
+        "-bx",
+        "--bbox",
         action="store",
-        dest="retryperiod",
-        default="30",
-        help="Retry delay in seconds.",
+        dest="cropBox",
+        default="",
+        help="Crop each GRIB2 file to the box south,west,north,east in degrees as it is downloaded.",
     )
+
     parser.add_argument(
-        "-t",
-        "--perftime",
+        "-fl",
+        "--fields",
         action="store",
-        dest="perftime",
-        default="10",
-        help="When in performance testing mode file delivery time over which it should be reported - default 10s.",
+        dest="cropFields",
+        default="",
+        help="Keep only the GRIB2 messages for these comma separated shortNames, for example t,u,v.",
     )
+
     parser.add_argument(
-        "-x",
-        "--printurl",
-        action="store_true",
-        dest="printurl",
-        default=False,
-        help="Print all accessed URLs and redirects",
+        "-cw",
+        "--cropworkers",
+        action="store",
+        dest="cropWorkers",
+        default=0,
+        type=int,
+        help="Number of processes cropping files. Defaults to the number of CPUs.",
     )
+
     parser.add_argument(
-        "-z",
-        "--debug",
-        action="store_true",
-        dest="debugmode",
-        default=False,
-        help="Switch to debug mode.",
+        "-dl",
+        "--deadlines",
+        action="store",
+        dest="deadlines",
+        default="",
+        help="OPTIONAL: Comma separated order:minutes list of how soon after its run is published each order is needed.",
     )
+
     parser.add_argument(
-        "-y",
-        "--perfmode",
-        action="store_true",
-        dest="perfmode",
-        default=False,
-        help="Switch on performance monitor.",
+        "-dw",
+        "--deadlineworkers",
+        action="store",
+        dest="deadlineWorkers",
+        default=-1,
+        type=int,
+        help="Most workers that can be added to an order at risk of missing its deadline. Defaults to --workers.",
     )
+
     parser.add_argument(
-        "-k",
-        "--apikey",
+        "-pf",
+        "--profile",
         action="store",
-        dest="apikey",
+        dest="profile",
         default="",
-        help="REQUIRED: Your WDH API Credentials.",
+        choices=PROFILE_MODES,
+        help="OPTIONAL: Profile the program - cpu, wall or mem - writing the report to the results folder.",
     )
+
     parser.add_argument(
-        "-b",
-        "--backdated",
+        "-fi",
+        "--faults",
         action="store",
-        dest="backdateddate",
+        dest="faults",
         default="",
-        help="OPTIONAL: Date in YYYYMMDD to explicitly attempt to get files from.",
+        help="OPTIONAL: Fail file requests on purpose, given as fault=probability for 429, 5xx, reset, slow, truncate and redirect.",
     )
+
     parser.add_argument(
-        "-f",
-        "--savefilelist",
-        action="store_true",
-        dest="savefilelist",
-        default=False,
-        help="Save the filelist in a file called ordername_{date_time}.json.",
+        "-fd",
+        "--faultdelay",
+        action="store",
+        dest="faultDelay",
+        default=10,
+        type=float,
+        help="Seconds added before the first byte of a slow fault. Defaults to 10.",
     )
+
     parser.add_argument(
-        "-q",
-        "--verifyssloff",
-        action="store_false",
-        dest="verifyssl",
-        default=True,
-        help="Turn off the verification of SSL on requests.get.",
+        "-fe",
+        "--faultseed",
+        action="store",
+        dest="faultSeed",
+        default=None,
+        type=int,
+        help="OPTIONAL: Seed for the faults so a run can be repeated with the same ones.",
     )
+
     parser.add_argument(
-        "-g",
-        "--fillgaps",
+        "-rc",
+        "--record",
+        action="store",
+        dest="record",
+        default="",
+        help="OPTIONAL: Record every request and answer, with its timings, into this cassette folder.",
+    )
+
+    parser.add_argument(
+        "-rh",
+        "--recordhashes",
         action="store_true",
-        dest="fillgaps",
+        dest="recordHashes",
         default=False,
-        help="Optional: Only download the gaps in files if selected"
+        help="With --record keep only the size, hash and timings of each file rather than the file itself.",
     )
 
     parser.add_argument(
-        "-ds",
-        "--dataspec",
+        "-rp",
+        "--replay",
         action="store",
-        dest="dataSpec",
-        default=DEFAULT_DATA_SPEC,
-        help="The version of the data that needs retrieving. Defaults to 1.0.0",
+        dest="replay",
+        default="",
+        help="OPTIONAL: Answer every request from this cassette folder instead of the service.",
     )
 
     parser.add_argument(
-        "-fds",
-        "--folderdataspec",
-        action="store_true",
-        dest="folderDataSpec",
-        default=False,
-        help="Splits downloaded data and other output files into versioned folders"
+        "-rl",
+        "--replaylatency",
+        action="store",
+        dest="replayLatency",
+        default=1,
+        type=float,
+        help="Multiplies the recorded times when replaying - 0 answers straight away. Defaults to 1.",
     )
 
+    parser.add_argument(
+        "-mw",
+        "--metadataworkers",
+        action="store",
+        dest="metadataWorkers",
+        default=4,
+        type=int,
+        help="Number of model run and order details requests made at the same time. Defaults to 4.",
+    )
 
     args = parser.parse_args()
 
@@ -905,18 +3591,69 @@ if __name__ == "__main__":
     apikey = args.apikey
     backdatedDate = args.backdateddate
     saveFileList = args.savefilelist
+    planMode = args.planMode
     verifySSL = args.verifyssl
     fillGaps = args.fillgaps
     dataSpec = args.dataSpec
     folderDataSpec = args.folderDataSpec
+    preallocate = args.preallocate
+    writeBuffer = args.writeBuffer
+    fsyncBytes = args.fsyncEvery * 1024 * 1024
+    bandwidthLimit = args.maxBandwidth * 1024 * 1024
+    backfillBandwidthLimit = args.backfillBandwidth * 1024 * 1024
+    leaseFile = args.leaseFile
+    leaseTime = args.leaseTime
+    workerId = args.workerId
+    stallTimeout = args.stallTimeout
+    connectTimeout = args.connectTimeout
+    readTimeout = args.readTimeout
+    minThroughput = args.minThroughput * 1024
+    hedgePercentile = args.hedgePercentile
+    metadataWorkers = args.metadataWorkers
+    fileLayout = args.fileLayout
+    publishRuns = args.publishRuns
+    partSize = args.partSize * 1024 * 1024
+    uploadParallelism = args.uploadParallelism
+    archiveFormat = args.archiveFormat
+    archiveCompression = args.archiveCompression
+    resolveWorkers = args.resolveWorkers
+    resolveRate = args.resolveRate
 
     printUrl = args.printurl
 
     thereWereErrors = False
 
-    if debugMode == True:
-        print("WARNING: As we are in debug mode setting workers to one.")
-        numThreads = 1
+    faultSpec = args.faults
+    if faultSpec == "" and debugMode:
+        faultSpec = DEBUG_FAULTS
+    if faultSpec != "":
+        try:
+            faultProbabilities = parse_faults(faultSpec)
+        except ValueError as exc:
+            print("ERROR: The faults must be given as fault=probability,fault=probability - " + str(exc))
+            sys.exit()
+        if args.faultDelay < 0:
+            print("ERROR: The fault delay cannot be negative.")
+            sys.exit()
+        print("WARNING: Injecting faults into file requests - " + faultSpec)
+        start_faults(faultProbabilities, args.faultDelay, args.faultSeed)
+
+    if args.record != "" and args.replay != "":
+        print("ERROR: A run can be recorded or replayed but not both.")
+        sys.exit()
+    if args.replay != "":
+        if not os.path.exists(os.path.join(args.replay, CASSETTE_FILE)):
+            print("ERROR: There is no recording in " + args.replay)
+            sys.exit()
+        if args.replayLatency < 0:
+            print("ERROR: The replay latency cannot be negative.")
+            sys.exit()
+        print("WARNING: Replaying the requests recorded in " + args.replay + " - the service is not used.")
+        start_replay(args.replay, args.replayLatency)
+    elif args.record != "":
+        start_recording(args.record, not args.recordHashes)
+    if args.recordHashes and args.record == "":
+        print("WARNING: --recordhashes only applies with --record so is ignored.")
 
     # Check for backdatedDate and latest - incompatible
 
@@ -926,6 +3663,14 @@ if __name__ == "__main__":
         )
         sys.exit()
 
+    backdatedDates = [""]
+    if backdatedDate != "":
+        try:
+            backdatedDates = parse_backdated_dates(backdatedDate)
+        except ValueError as error:
+            print("ERROR: Backdated dates must be YYYYMMDD or YYYYMMDD-YYYYMMDD:", error)
+            sys.exit()
+
     if args.ordersToDownload == "":
         print("ERROR: You must pass an orders list to download.")
         sys.exit()
@@ -940,7 +3685,16 @@ if __name__ == "__main__":
         print("ERROR: API credentials must be supplied.")
         sys.exit()
     else:
-        requestHeaders = {"apikey": apikey}
+        try:
+            apiKeys = parse_api_keys(apikey, args.keyRates)
+        except ValueError as error:
+            print("ERROR: API key rates must be numbers of 0 or more with one for each key or one for all:", error)
+            sys.exit()
+        if len(apiKeys) == 0:
+            print("ERROR: API credentials must be supplied.")
+            sys.exit()
+        # Order and run lookups use the first key - file requests are spread over them all
+        requestHeaders = {"apikey": apiKeys[0]["key"]}
 
     if baseFolder != "":
         try:
@@ -956,6 +3710,147 @@ if __name__ == "__main__":
     os.makedirs(baseFolder + LATEST_FOLDER, exist_ok=True)
     os.makedirs(baseFolder + RESULTS_FOLDER, exist_ok=True)
     os.makedirs(baseFolder + FAILURES_FOLDER, exist_ok=True)
+    if args.profile != "":
+        start_profile(
+            args.profile, baseFolder + RESULTS_FOLDER + "/profile-" + datetime.now().strftime("%d-%b-%Y-%H-%M-%S")
+        )
+    if orderRuns == "latest":
+        open_state_store(baseFolder + LATEST_FOLDER + "/state.db")
+
+    outputSink = LocalSink()
+    if args.s3Url != "":
+        if args.partSize < 5 or uploadParallelism < 1:
+            print("ERROR: Object store parts must be at least 5MB and at least one must upload at a time.")
+            sys.exit()
+        if publishRuns or args.verify:
+            print("ERROR: --publish and --verify work on the local folder so cannot be used with --s3url.")
+            sys.exit()
+        if preallocate or fsyncBytes > 0:
+            print("WARNING: --preallocate and --fsyncevery do not apply to an object store so are ignored.")
+        if hedgePercentile > 0:
+            print("WARNING: Hedging is not supported when writing to an object store so is turned off.")
+            hedgePercentile = 0
+        outputSink = open_s3_sink(args.s3Url, args.s3Endpoint)
+
+    if archiveFormat != "":
+        if args.s3Url != "" or publishRuns or args.verify or fillGaps:
+            print("ERROR: --archive writes whole runs so cannot be used with --s3url, --publish, --verify or --fillgaps.")
+            sys.exit()
+        # Files would be recorded as done while they are only in an unfinished archive, so an interrupted
+        # download would never fetch them again
+        if orderRuns == "latest" or leaseFile != "":
+            print("ERROR: --archive cannot be used with --runs latest or --coordinate.")
+            sys.exit()
+        if archiveCompression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                print("ERROR: The zstandard package is needed for zstd archives - pip install zstandard")
+                sys.exit()
+        if preallocate or fsyncBytes > 0:
+            print("WARNING: --preallocate and --fsyncevery do not apply to archives so are ignored.")
+        if hedgePercentile > 0:
+            print("WARNING: Hedging is not supported when writing archives so is turned off.")
+            hedgePercentile = 0
+        outputSink = ArchiveSink()
+    elif archiveCompression != "store":
+        print("WARNING: --archivecompression only applies with --archive so is ignored.")
+
+    if args.cropBox != "" or args.cropFields != "":
+        if args.s3Url != "" or archiveFormat != "":
+            print("ERROR: --bbox and --fields rewrite the files on disk so cannot be used with --s3url or --archive.")
+            sys.exit()
+        if importlib.util.find_spec("eccodes") is None or importlib.util.find_spec("numpy") is None:
+            print("ERROR: The eccodes and numpy packages are needed to crop GRIB2 files - pip install eccodes numpy")
+            sys.exit()
+        if args.cropBox != "":
+            try:
+                cropBox = [float(edge) for edge in args.cropBox.split(",")]
+            except ValueError:
+                cropBox = []
+            if len(cropBox) != 4 or not -90 <= cropBox[0] < cropBox[2] <= 90:
+                print("ERROR: The box must be given as south,west,north,east in degrees with south below north.")
+                sys.exit()
+        if args.cropFields != "":
+            cropFields = args.cropFields.split(",")
+        if args.cropWorkers < 0:
+            print("ERROR: The number of crop workers cannot be negative.")
+            sys.exit()
+        # Spawned rather than forked as the download threads are already running when the first file lands
+        cropPool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.cropWorkers or None, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    if args.verify:
+        # The run folders are checked once the orders are known - only the missing files are downloaded
+        fillGaps = True
+        if folderdate:
+            print("WARNING: With --folderdate every call downloads into new folders so --verify has nothing to check.")
+
+    if writeBuffer < 1:
+        print("ERROR: The write buffer must be at least one byte.")
+        sys.exit()
+
+    if stallTimeout < 1:
+        print("ERROR: The stall timeout must be at least one second.")
+        sys.exit()
+
+    if resolveWorkers < 0 or resolveRate < 0:
+        print("ERROR: The resolve workers and resolve rate cannot be negative.")
+        sys.exit()
+
+    if metadataWorkers < 1:
+        print("ERROR: There must be at least one metadata worker.")
+        sys.exit()
+
+    if connectTimeout <= 0 or readTimeout <= 0:
+        print("ERROR: The connect and read timeouts must be greater than zero.")
+        sys.exit()
+
+    if hedgePercentile != 0 and not 50 <= hedgePercentile < 100:
+        print("ERROR: The hedge percentile must be at least 50 and less than 100.")
+        sys.exit()
+
+    if hedgePercentile > 0 and numThreads < 2:
+        print("WARNING: Hedging needs more than one worker so is turned off.")
+        hedgePercentile = 0
+
+    if args.deadlines != "":
+        try:
+            for orderDeadline in args.deadlines.lower().split(","):
+                deadlineOrder, minutes = orderDeadline.split(":")
+                orderDeadlines[deadlineOrder] = float(minutes)
+        except ValueError:
+            print("ERROR: Deadlines must be given as order:minutes,order:minutes")
+            sys.exit()
+    deadlineWorkers = numThreads if args.deadlineWorkers < 0 else args.deadlineWorkers
+
+    if args.orderWeights != "":
+        try:
+            for orderWeight in args.orderWeights.lower().split(","):
+                weightOrder, weight = orderWeight.split(":")
+                orderWeights[weightOrder] = float(weight)
+        except ValueError:
+            print("ERROR: Order weights must be given as order:weight,order:weight")
+            sys.exit()
+        if min(orderWeights.values()) <= 0:
+            print("ERROR: Order weights must be greater than 0.")
+            sys.exit()
+        if bandwidthLimit == 0:
+            print("WARNING: Order weights only apply when --maxbandwidth is set.")
+
+    if leaseFile != "":
+        if workerId == "":
+            workerId = socket.gethostname() + ":" + str(os.getpid())
+        try:
+            init_lease_store()
+        except sqlite3.Error as error:
+            print("ERROR: Lease file", leaseFile, "cannot be opened:", error)
+            sys.exit()
+        leaseThread = threading.Thread(target=renew_leases, daemon=True)
+        leaseThread.start()
+        if verbose:
+            print("Coordinating downloads as worker " + workerId + " using " + leaseFile)
 
     if verbose:
         print("Download Orders")
@@ -992,23 +3887,47 @@ if __name__ == "__main__":
         sys.exit()
 
     myModelRuns = get_model_runs(baseUrl, requestHeaders, myModelList)
+    profile_phase("model runs")
+
+    verifiedRuns = {}
+    if args.verify and not folderdate:
+        # Only the folders of the runs this call downloads are checked, as only they are filled again
+        if orderRuns == "latest":
+            verifyRuns = dict.fromkeys(ordersToDownload)
+        else:
+            runNames = ["00", "06", "12", "18"] if orderRuns == "" else orderRuns.split(",")
+            runSuffixes = ["_" + date for date in backdatedDates] if len(backdatedDates) > 1 else [""]
+            verifyRuns = {orderName: set(run + suffix for run in runNames for suffix in runSuffixes) for orderName in ordersToDownload}
+        verifiedRuns = verify_tree(baseFolder + ROOT_FOLDER, verifyRuns)
+        if orderRuns == "latest":
+            reopen_bad_files(verifiedRuns)
 
     retryManifest = []
+    pendingPublish = []
+    eventFile = baseFolder + ROOT_FOLDER + "/events.jsonl"
 
     # Total number of files downloaded
 
     totalFiles = 0
-    finalRuns = []
+    incompleteRuns = []
+    planEntries = []
+    planModel = None
+    deadlineModel = None
+    if planMode:
+        history = read_summary_history(baseFolder + RESULTS_FOLDER)
+        planModel = fit_download_model(history[0], history[1])
+    elif len(orderDeadlines) > 0:
+        history = read_summary_history(baseFolder + RESULTS_FOLDER)
+        deadlineModel = fit_download_model(history[0], history[1])
     myTimeStamp = datetime.now().strftime("%d-%b-%Y-%H-%M-%S")
+    if leaseFile != "":
+        # Several hosts write to the same results folder so keep their summaries apart
+        myTimeStamp = myTimeStamp + "-" + workerId.replace(":", "-")
 
-    # Process selected orders, generating tasks for the worker to actually download the file.
+    # Choose the runs of every order first so all their details can be fetched at once, in the
+    # background, rather than each order waiting for its details after the previous one finishes
+    orderSelections = {}
     for orderName in ordersToDownload:
-        initTime = datetime.now()
-
-        responseLog = []
-        downloadErrorLog = []
-        if verbose:
-            print("Processing: " + orderName)
         if not order_exists(myOrders, orderName):
             print(
                 "ERROR: You've asked for an order called: "
@@ -1016,81 +3935,65 @@ if __name__ == "__main__":
                 + " which doesn't appear in the list of active orders."
             )
             continue
-        if orderRuns == "":
-            runsToDownload = ["00", "06", "12", "18"]
-        else:
-            if orderRuns == "latest":
-                modelToGet = get_model_from_order(myOrders, orderName)
-                if modelToGet not in myModelList:
-                    print(
-                        "ERROR: No idea what model: "
-                        + modelToGet
-                        + " is so terminating!"
-                    )
-                    sys.exit(7)
-                runsToDownload = get_latest_run(modelToGet, orderName, myModelRuns)
-                if runsToDownload[:4] == "done":
-                    if verbose:
-                        print(
-                            "We have done this latest run "
-                            + runsToDownload[5:]
-                            + " already!"
-                        )
-                    continue
-                # Do I want these runs?
-                finalRuns = []
-                runsToCheck = runsToDownload.split(",")
-                for checkRun in runsToCheck:
-                    runWanted = run_wanted(myOrders, orderName, checkRun)
-                    if runWanted and verbose:
-                        print("This run " + checkRun + " is wanted.")
-                        finalRuns.append(checkRun)
-                    else:
-                        if verbose:
-                            print("This run " + checkRun + " is not wanted")
-                        continue
-
-                runsToDownload = finalRuns
+        selection = select_order_runs(myOrders, orderName, orderRuns, myModelList, myModelRuns, backdatedDates)
+        if selection is not None:
+            orderSelections[orderName] = selection
+
+    # Orders with the earliest deadline go first - those without one follow in the order given
+    orderDeadlineAt = {}
+    for orderName in orderSelections:
+        if orderName in orderDeadlines:
+            deadlineModelName = get_model_from_order(myOrders, orderName)
+            published = run_published_at(deadlineModelName, myModelRuns.get(deadlineModelName, ""))
+            orderDeadlineAt[orderName] = published + orderDeadlines[orderName] * 60
+    ordersToDownload = sorted(ordersToDownload, key=lambda name: orderDeadlineAt.get(name, float("inf")))
+
+    detailsPool = concurrent.futures.ThreadPoolExecutor(max_workers=metadataWorkers)
+    orderFutures = {}
+    for orderName in [name for name in ordersToDownload if name in orderSelections]:
+        orderFutures[orderName] = detailsPool.submit(
+            get_order_details,
+            baseUrl, requestHeaders, orderName, useEnhancedApi, orderSelections[orderName][0], dataSpec
+        )
 
-            else:
-                runsToDownload = orderRuns.split(",")
-                finalRuns = []
-                # Ensure only runs wanted are asked for
-                for checkRun in runsToDownload:
-                    if run_wanted(myOrders, orderName, checkRun):
-                        finalRuns.append(checkRun)
-                    else:
-                        print(
-                            "WARNING: The run "
-                            + checkRun
-                            + " has been asked for but doesn't appear in the order "
-                            + orderName
-                        )
-                runsToDownload = finalRuns
+    # Process selected orders, generating tasks for the worker to actually download the file.
+    for orderName in ordersToDownload:
+        initTime = datetime.now()
 
-        if len(finalRuns) == 0:
-            print(
-                "WARNING: No runs for order "
-                + orderName
-                + "were found.  Don't expect any data."
-            )
+        responseLog = []
+        downloadErrorLog = []
+        orderPublish = []
+        if verbose:
+            print("Processing: " + orderName)
+        if orderName not in orderFutures:
             continue
-
-        order = get_order_details(
-            baseUrl, requestHeaders, orderName, useEnhancedApi, runsToDownload, dataSpec
-        )
+        runsToDownload, runsToQueue, modelToGet = orderSelections[orderName]
+        order = orderFutures.pop(orderName).result()
         if order != None:
             # Create queue and threads for processing downloads
-            taskQueue = queue.Queue()
+            taskQueue = queue.PriorityQueue()
 
             taskThreads = []
             terminate = False
+            # Hedging compares transfers with the rest of the same order
+            runTtfbs = []
+            runThroughputs = []
+            hedgeCounts = {"started": 0, "won": 0}
+            resolveStats = {"resolved": 0, "direct": 0, "failed": 0, "seconds": 0.0}
   
             for i in range(numThreads):
                 t = threading.Thread(target=download_worker)
                 taskThreads.append(t)
+
+            resolveThreads = []
+            if resolveWorkers > 0:
+                resolveQueue = queue.PriorityQueue()
+                resolvedSlots = threading.Semaphore(numThreads * 2)
+                for i in range(resolveWorkers):
+                    resolveThreads.append(threading.Thread(target=resolve_worker))
                 
-            daemonThread = threading.Thread(target=monitor_threads, daemon=True)
+            monitorStop = threading.Event()
+            daemonThread = threading.Thread(target=monitor_threads, args=(monitorStop,), daemon=True)
             # End of set up threads
 
             ordersfound = True
@@ -1098,6 +4001,41 @@ if __name__ == "__main__":
             # Break down the files in to those needed for each run
             filesByRun = get_files_by_run(order, runsToDownload, numFilesPerOrder)
 
+            if planMode:
+                planFiles = 0
+                for run, runStamp, runDate in runsToQueue:
+                    planFiles += len(filesByRun[run])
+                planBytes = 0
+                planSized = min(order["fileSizes"], default=0) >= 0
+                if planSized:
+                    for run, runStamp, runDate in runsToQueue:
+                        planBytes += expected_run_size(order, {run: filesByRun[run]}, orderName)
+                elif planModel is not None:
+                    planBytes = round(planFiles * planModel["orderMeanSize"].get(orderName, planModel["meanSize"]))
+                planEntries.append(
+                    {
+                        "order": orderName,
+                        "runs": [runStamp or (run + ("_" + runDate if runDate else "")) for run, runStamp, runDate in runsToQueue],
+                        "files": planFiles,
+                        "bytes": planBytes,
+                        "sized": planSized,
+                    }
+                )
+                continue
+
+            if preallocate:
+                expectedBytes = expected_run_size(order, filesByRun, orderName)
+                if expectedBytes > 0 and not check_disk_space(baseFolder + ROOT_FOLDER, expectedBytes):
+                    print(
+                        "ERROR: Not enough disk space for order "
+                        + orderName
+                        + " - expecting about "
+                        + str(expectedBytes)
+                        + " bytes.  Skipping it."
+                    )
+                    thereWereErrors = True
+                    continue
+
             if saveFileList:
                 filelistFilename = (
                         baseFolder
@@ -1109,10 +4047,33 @@ if __name__ == "__main__":
                 )
                 os.makedirs(os.path.dirname(filelistFilename), exist_ok=True)
                 with open(filelistFilename, "a") as flistFile:
-                    json.dump(order, flistFile, indent=4, sort_keys=True)
+                    json.dump(order_file_list(order), flistFile, indent=4, sort_keys=True)
+
+            latestRun = myModelRuns.get(get_model_from_order(myOrders, orderName), "")
+
+            if orderRuns == "latest":
+                latestStampDate = datetime.strptime(
+                    myModelRuns[modelToGet][3:13] + ":" + myModelRuns[modelToGet][:2], "%Y-%m-%d:%H"
+                )
 
             # Now queue up tasks to down load each file
-            for run in runsToDownload:
+            # All the dates and runs of the order are queued together so they download concurrently
+            for run, runStamp, runDate in runsToQueue:
+                runBackdatedDate = runDate
+                runSuffix = ""
+                if len(backdatedDates) > 1:
+                    runSuffix = "_" + runDate
+                doneFiles = set()
+                if runStamp != "":
+                    # Runs a day or more older than the latest are no longer the latest for their hour
+                    # so have to be fetched by date
+                    if latestStampDate - datetime.strptime(runStamp, "%Y-%m-%d:%H") >= timedelta(hours=24):
+                        runBackdatedDate = runStamp[:10].replace("-", "")
+                        runSuffix = "_" + runBackdatedDate
+                    doneFiles = get_done_files(orderName, runStamp)
+                    if verbose and len(doneFiles) > 0:
+                        print("Resuming run " + runStamp + " with " + str(len(doneFiles)) + " files already done")
+
                 if folderdate == True:
                     folder = (
                             baseFolder
@@ -1124,25 +4085,53 @@ if __name__ == "__main__":
                             + orderName
                             + "_"
                             + run
+                            + runSuffix
                     )
                 else:
-                    folder = baseFolder + ROOT_FOLDER + "/" + orderName + "_" + run
+                    folder = baseFolder + ROOT_FOLDER + "/" + orderName + "_" + run + runSuffix
+
+                # Leases are keyed on the model run each run hour fetches, so every new run is claimed afresh and
+                # two run hours of the same order never share a key
+                cycle = runStamp or expected_cycle(latestRun, run, runDate) or latestRun
+
+                stagingFolder = baseFolder + ROOT_FOLDER + "/.staging/" + os.path.relpath(folder, baseFolder + ROOT_FOLDER)
+                verifiedFolders = [
+                    verifiedRuns.pop(runFolder)
+                    for runFolder in [os.path.realpath(folder), os.path.realpath(stagingFolder)]
+                    if runFolder in verifiedRuns
+                ]
+                if len(verifiedFolders) > 0 and runStamp == "":
+                    # A run fetched by its hour is whichever is current, which must be the one already in the folder
+                    if not verified_run_current(verifiedFolders, folder, expected_cycle(latestRun, run, runDate)):
+                        continue
 
-                os.makedirs(folder, exist_ok=True)
+                if publishRuns:
+                    # Download into a staging folder and only publish the run under its real name when complete
+                    publishFolder = folder
+                    folder = stagingFolder
+                    if fillGaps:
+                        seed_staging(publishFolder, folder)
+                    orderPublish.append([folder, publishFolder, runStamp or (run + runSuffix), filesByRun[run]])
+
+                outputSink.make_folder(folder)
+                remove_refetched_files(verifiedFolders, folder, filesByRun[run], guidFileNames)
+                runContext = {
+                    "baseUrl": baseUrl,
+                    "requestHeaders": requestHeaders,
+                    "orderName": orderName,
+                    "guidFileNames": guidFileNames,
+                    "folder": folder,
+                    "responseLog": responseLog,
+                    "downloadErrorLog": downloadErrorLog,
+                    "backdatedDate": runBackdatedDate,
+                    "dataSpec": dataSpec,
+                    "cycle": cycle,
+                    "stamp": runStamp
+                }
                 for fileId in filesByRun[run]:
-                    downloadTask = {
-                        "baseUrl": baseUrl,
-                        "requestHeaders": requestHeaders,
-                        "orderName": orderName,
-                        "fileId": fileId,
-                        "guidFileNames": guidFileNames,
-                        "folder": folder,
-                        "responseLog": responseLog,
-                        "downloadErrorLog": downloadErrorLog,
-                        "backdatedDate": backdatedDate,
-                        "dataSpec": dataSpec
-                    }
-                    taskQueue.put(downloadTask)
+                    if fileId in doneFiles:
+                        continue
+                    queue_task(DownloadTask(runContext, fileId), resolveQueue if resolveWorkers > 0 else None)
 
         # Start the worker threads
         if ordersfound == False:
@@ -1159,27 +4148,79 @@ if __name__ == "__main__":
             print("PM Download workers starting")
             pmstart = datetime.now()
 
-        workerThreadsWaiting = 0
+        deadlineState = None
+        if orderName in orderDeadlineAt:
+            deadlineState = start_deadline(
+                orderName,
+                orderDeadlineAt[orderName],
+                taskQueue.qsize() + (resolveQueue.qsize() if resolveWorkers > 0 else 0),
+                expected_run_size(order, filesByRun, orderName) if deadlineModel is not None else 0,
+                deadlineModel,
+            )
 
-        for t in taskThreads:
+        for t in taskThreads + resolveThreads:
             t.start()
 
         daemonThread.start()
       
-        # Wait for all the queued scenarios to be processed
+        # Wait for all the queued scenarios to be processed - every file passes through the resolve
+        # stage before it reaches the transfer queue
+        if resolveWorkers > 0:
+            resolveQueue.join()
+            for i in range(resolveWorkers):
+                queue_task(None, resolveQueue)
         taskQueue.join()
 
+        # No more workers can be added for the deadline once the stop has been queued
+        with deadlineLock:
+            if deadlineState is not None:
+                deadlineState["closed"] = True
+                deadlineState["finished"] = time.time()
+                deadlineReport.append(deadlineState)
+
         # Stop all the threads
-        for i in range(numThreads):
-            taskQueue.put(None)
+        for i in range(len(taskThreads)):
+            queue_task(None)
 
         if perfMode:
             pmend = datetime.now()
             delta = round((pmend - pmstart).total_seconds() * 1000)
             print("PM Download workers executed in ", str(delta), "ms")
 
-        for t in taskThreads:
+        for t in taskThreads + resolveThreads:
             t.join()
+        monitorStop.set()
+        wait_for_crops()
+        outputSink.flush()
+        profile_phase("order " + orderName)
+
+        if resolveWorkers > 0:
+            resolveCount = resolveStats["resolved"] + resolveStats["direct"] + resolveStats["failed"]
+            print(
+                "Resolve stage for order "
+                + orderName
+                + ": "
+                + str(resolveStats["resolved"])
+                + " of "
+                + str(resolveCount)
+                + " files resolved in an average of "
+                + str(round(resolveStats["seconds"] * 1000 / max(resolveCount, 1)))
+                + "ms, "
+                + str(resolveStats["direct"])
+                + " served without a redirect, "
+                + str(resolveStats["failed"])
+                + " left to the transfer stage after failing"
+            )
+
+        if hedgeCounts["started"] > 0:
+            print(
+                "Hedged "
+                + str(hedgeCounts["started"])
+                + " slow downloads for order "
+                + orderName
+                + " - the duplicate finished first for "
+                + str(hedgeCounts["won"])
+            )
 
         # Write out the summary CSV file
         summaryFileName = (
@@ -1199,23 +4240,49 @@ if __name__ == "__main__":
             if retry:
                 retryManifest = retryManifest + downloadErrorLog
 
-        write_summary(responseLog, summaryFileName, initTime)
+        write_summary(responseLog, summaryFileName, initTime, get_model_from_order(myOrders, orderName))
         totalFiles = totalFiles + len(responseLog)
 
         if verbose and len(responseLog) > 0:
             print("    Created summary: " + summaryFileName)
             print(" Runs to download", runsToDownload, myModelRuns, orderName)
 
-        # As we've got this far probably safe to update the 'latest' file if we are in latest mode
+        # Record which runs are now complete - anything left pending is resumed next time
         if orderRuns == "latest":
-            latestRun = myModelRuns[modelToGet][:2]
-            latestDate = myModelRuns[modelToGet][3:]
-            stamp = latestDate[:10] + ":" + latestRun
-            rf = open(baseFolder + LATEST_FOLDER + "/" + orderName + ".txt", "w")
-            rf.write(stamp)
-            rf.close()
+            for run, runStamp, runDate in runsToQueue:
+                runStatus = finish_run(orderName, runStamp, filesByRun[run], True)
+                if runStatus[0] == "complete":
+                    if verbose:
+                        print("Run " + runStamp + " of order " + orderName + " is complete")
+                else:
+                    incompleteRuns.append([orderName, runStamp, filesByRun[run]])
+                    print(
+                        "WARNING: Run "
+                        + runStamp
+                        + " of order "
+                        + orderName
+                        + " is missing "
+                        + str(runStatus[1])
+                        + " files"
+                        + (" - giving up on it." if runStatus[0] == "abandoned" else " - it will be resumed next time.")
+                    )
+
+        if publishRuns:
+            for publishEntry in orderPublish:
+                if not publish_run(publishEntry[0], publishEntry[1], orderName, publishEntry[2], publishEntry[3], eventFile):
+                    pendingPublish.append([orderName] + publishEntry)
+
+        if terminate:
+            # Retrying would hit the same wall so stop here with the summaries written
+            print("ERROR: downloads for order " + orderName + " were aborted as every worker was stuck backing off.")
+            sys.exit(11)
 
     # End of order processing loop
+    detailsPool.shutdown()
+
+    if planMode:
+        print_plan(planEntries, planModel, numThreads)
+        sys.exit()
 
     if verbose:
         print("All file downloads have been attempted.")
@@ -1290,7 +4357,7 @@ if __name__ == "__main__":
 
             try:
                 if apikey != "":
-                    requestHeaders = {"apikey": apikey}
+                    requestHeaders = {"apikey": apiKeys[0]["key"]}
 
                 if verbose:
                     print(
@@ -1308,15 +4375,21 @@ if __name__ == "__main__":
                     False,
                     retryFile["folder"],
                     startTime,
-                    backdatedDate,
+                    retryFile["backdatedDate"],
                     retryFile["dataSpec"],
                 )
-                fileSize = os.path.getsize(downloadResp[1])
+                fileSize = outputSink.size(downloadResp[1])
+                if cropPool is not None:
+                    queue_crop(downloadResp[1])
+                record_file_map(retryFile["folder"], retryFile["fileid"], downloadResp[1])
+                if retryFile["stamp"] != "":
+                    mark_file_done(retryFile["ordername"], retryFile["stamp"], retryFile["fileid"])
 
             except Exception as ex:
                 error = True
                 errMsg = ex.args
-                status = ex.args[1]
+                # Only HTTP failures carry a status - connection failures have just their message
+                status = ex.args[1] if len(ex.args) > 1 else ""
 
             if not error:
                 with open(summaryFileName, "a") as sumfile:
@@ -1347,6 +4420,47 @@ if __name__ == "__main__":
                 thereWereErrors = True
                 stillInError.append(retryFile.copy())
 
+        # The retries may have completed runs left pending by the first pass
+        for incompleteRun in incompleteRuns:
+            runStatus = finish_run(incompleteRun[0], incompleteRun[1], incompleteRun[2], False)
+            if runStatus[0] == "complete" and verbose:
+                print("Run " + incompleteRun[1] + " of order " + incompleteRun[0] + " completed on retry")
+
+    wait_for_crops()
+    outputSink.flush()
+    profile_phase("retries")
+
+    # Runs completed by the retries can now be published too
+    for orderName, stagingFolder, publishFolder, runLabel, fileIds in pendingPublish:
+        if not publish_run(stagingFolder, publishFolder, orderName, runLabel, fileIds, eventFile):
+            print("WARNING: Run " + runLabel + " of order " + orderName + " is incomplete so has not been published.")
+
+    # Archives are finished once the retries have had their chance to add to them
+    for archive in runArchives.values():
+        memberCount = close_run_archive(archive)
+        if verbose:
+            print("Archive " + archive["path"] + " written with " + str(memberCount) + " files")
+
+    if len(deadlineReport) > 0:
+        print_deadline_report(deadlineReport, baseFolder + RESULTS_FOLDER + "/deadlines.csv")
+
+    if len(apiKeys) > 1:
+        for apiKey in apiKeys:
+            print(
+                "API key "
+                + apiKey["name"]
+                + ": "
+                + str(apiKey["requests"])
+                + " file requests, "
+                + str(apiKey["throttled"])
+                + " rate limited"
+            )
+
+    # Corrupt files in folders of runs that were not downloaded are never fetched again, so are kept
+    for verified in verifiedRuns.values():
+        for fileName in verified["bad"]:
+            print("WARNING: " + fileName + " is not downloaded again so is left in place")
+
     if thereWereErrors == True:
         print("ERROR: something remains in error.")
         sys.exit(10)
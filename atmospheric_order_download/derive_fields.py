@@ -0,0 +1,272 @@
+# 2023 (C) Crown Copyright, Met Office. All rights reserved.
+#
+# This file is part of Weather DataHub and is released under the
+# BSD 3-Clause license.
+# See LICENSE in the root of the repository for full licensing details.
+# (c) Met Office 2023
+
+import argparse
+import csv
+import importlib.util
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+# Only imported when installed so the check in __main__ can say what is missing
+if importlib.util.find_spec("eccodes") is not None and importlib.util.find_spec("numpy") is not None:
+    import eccodes
+    import numpy
+
+# Example code to compute derived fields once from a run downloaded by cda_download.py, rather than in
+# every program that reads the run
+
+# Pairs of GRIB shortNames the derived fields are made from
+WIND_PAIRS = [["u", "v"], ["10u", "10v"], ["100u", "100v"]]
+HUMIDITY_PAIRS = [["t", "dpt"], ["2t", "2d"]]
+DEFAULT_TOTALS = "tp"
+DERIVED = ["wind", "humidity", "accumulations"]
+
+
+def index_file(fileName, shortNames):
+    # Runs in a worker process - lists where each message that is needed starts without decoding its values
+    messages = []
+    with open(fileName, "rb") as f:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(f)
+            if gid is None:
+                break
+            try:
+                shortName = eccodes.codes_get(gid, "shortName")
+                if shortName in shortNames:
+                    number = eccodes.codes_get(gid, "number") if eccodes.codes_is_defined(gid, "number") else 0
+                    messages.append(
+                        [
+                            shortName,
+                            eccodes.codes_get(gid, "typeOfLevel"),
+                            eccodes.codes_get(gid, "level"),
+                            number or 0,
+                            eccodes.codes_get(gid, "stepType"),
+                            eccodes.codes_get(gid, "startStep", int),
+                            eccodes.codes_get(gid, "endStep", int),
+                            fileName,
+                            eccodes.codes_get(gid, "offset", int),
+                        ]
+                    )
+            finally:
+                eccodes.codes_release(gid)
+    return messages
+
+
+def read_field(fileName, offset):
+    # Decodes one message into a float32 array shaped like its grid, with missing points as NaN
+    with open(fileName, "rb") as f:
+        f.seek(offset)
+        gid = eccodes.codes_grib_new_from_file(f)
+    try:
+        values = eccodes.codes_get_values(gid).astype(numpy.float32)
+        if eccodes.codes_get(gid, "bitmapPresent"):
+            values[values == eccodes.codes_get(gid, "missingValue")] = numpy.nan
+        if eccodes.codes_get(gid, "gridType") in ("regular_ll", "rotated_ll", "lambert", "polar_stereographic"):
+            values = values.reshape(eccodes.codes_get(gid, "Nj"), eccodes.codes_get(gid, "Ni"))
+    finally:
+        eccodes.codes_release(gid)
+    return values
+
+
+def save_field(outFolder, field, typeOfLevel, level, number, step, values):
+    name = field + "_" + typeOfLevel + "_" + str(level) + "_" + str(number) + "_" + str(step)
+    numpy.save(os.path.join(outFolder, name + ".npy"), values)
+    return [name, field, typeOfLevel, level, number, step, "x".join(str(n) for n in values.shape)]
+
+
+def derive_wind(outFolder, key, uRef, vRef):
+    # Speed, and the direction the wind blows from in degrees clockwise from north
+    u = read_field(*uRef)
+    v = read_field(*vRef)
+    speed = numpy.hypot(u, v)
+    direction = numpy.mod(180 + numpy.degrees(numpy.arctan2(u, v)), 360).astype(numpy.float32)
+    return [
+        save_field(outFolder, "windspeed", *key, speed),
+        save_field(outFolder, "winddirection", *key, direction),
+    ]
+
+
+def derive_humidity(outFolder, key, tRef, dRef):
+    # Relative humidity in percent from the temperature and dew point in K, using the Magnus formula
+    t = read_field(*tRef) - numpy.float32(273.15)
+    d = read_field(*dRef) - numpy.float32(273.15)
+    rh = 100 * numpy.exp(17.625 * d / (243.04 + d) - 17.625 * t / (243.04 + t))
+    return [save_field(outFolder, "relativehumidity", *key, numpy.clip(rh, 0, 100).astype(numpy.float32))]
+
+
+def derive_accumulations(outFolder, shortName, typeOfLevel, level, number, steps):
+    # Totals accumulated from the start of the run become the amount in each step - every total is
+    # decoded once and kept only until the next step has been taken from it
+    rows = []
+    previous = None
+    for step, fileName, offset in steps:
+        total = read_field(fileName, offset)
+        interval = total if previous is None else numpy.maximum(total - previous, 0)
+        rows.append(save_field(outFolder, shortName + "interval", typeOfLevel, level, number, step, interval))
+        previous = total
+    return rows
+
+
+def derive_run(runFolder, derived, totals, processes):
+    gribFiles = []
+    for folder, subFolders, names in os.walk(runFolder):
+        subFolders[:] = [name for name in subFolders if name != "derived"]
+        for name in names:
+            if name.endswith(".grib2"):
+                gribFiles.append(os.path.join(folder, name))
+    if len(gribFiles) == 0:
+        print("WARNING: No GRIB2 files found in " + runFolder)
+        return
+
+    shortNames = set()
+    if "wind" in derived:
+        shortNames.update(name for pair in WIND_PAIRS for name in pair)
+    if "humidity" in derived:
+        shortNames.update(name for pair in HUMIDITY_PAIRS for name in pair)
+    if "accumulations" in derived:
+        shortNames.update(totals)
+
+    outFolder = os.path.join(runFolder, "derived")
+    os.makedirs(outFolder, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        # Messages are found by shortName, level, ensemble member and step across all the run's files.  The
+        # step type and start step keep a maximum or a total over one hour apart from the field at that step
+        fields = {}
+        for messages in pool.map(index_file, gribFiles, [shortNames] * len(gribFiles)):
+            for shortName, typeOfLevel, level, number, stepType, startStep, endStep, fileName, offset in messages:
+                fields[(shortName, typeOfLevel, level, number, stepType, startStep, endStep)] = (fileName, offset)
+
+        futures = []
+        for first, second, derive, wanted in [
+            [pair[0], pair[1], derive_wind, "wind"] for pair in WIND_PAIRS
+        ] + [[pair[0], pair[1], derive_humidity, "humidity"] for pair in HUMIDITY_PAIRS]:
+            if wanted not in derived:
+                continue
+            # Only made from the instantaneous fields - a speed from the maximum u and maximum v means nothing
+            for fieldKey, ref in fields.items():
+                if fieldKey[0] == first and fieldKey[4] == "instant" and (second,) + fieldKey[1:] in fields:
+                    key = fieldKey[1:4] + fieldKey[6:]
+                    futures.append(pool.submit(derive, outFolder, key, ref, fields[(second,) + fieldKey[1:]]))
+
+        if "accumulations" in derived:
+            # Only totals since the start of the run - one hour totals or a maximum would give nonsense differences
+            series = {}
+            for fieldKey, ref in fields.items():
+                if fieldKey[0] in totals and fieldKey[4] == "accum" and fieldKey[5] == 0:
+                    series.setdefault(fieldKey[:4], []).append((fieldKey[6],) + ref)
+            for seriesKey, steps in series.items():
+                futures.append(pool.submit(derive_accumulations, outFolder, *seriesKey, sorted(steps)))
+
+        rows = []
+        for future in futures:
+            rows.extend(future.result())
+
+    with open(os.path.join(outFolder, "index.csv"), "w", newline="") as indexFile:
+        writer = csv.writer(indexFile)
+        writer.writerow(["name", "field", "typeoflevel", "level", "number", "step", "shape"])
+        writer.writerows(sorted(rows))
+    print("Derived " + str(len(rows)) + " fields from " + str(len(gribFiles)) + " files in " + runFolder)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compute derived fields once for runs downloaded by cda_download.py."
+    )
+    parser.add_argument(
+        "-l",
+        "--location",
+        action="store",
+        dest="location",
+        default="",
+        help="The base folder the runs were downloaded to.",
+    )
+    parser.add_argument(
+        "-o",
+        "--orders",
+        action="store",
+        dest="orders",
+        default="",
+        help="Comma separated list of orders whose runs are processed.",
+    )
+    parser.add_argument(
+        "-r",
+        "--runs",
+        action="store",
+        dest="runs",
+        default="00,12",
+        help="Comma separated list of runs of each order. Defaults to 00,12.",
+    )
+    parser.add_argument(
+        "-f",
+        "--folders",
+        action="store",
+        dest="folders",
+        default="",
+        help="OPTIONAL: Comma separated list of run folders to process instead of --orders and --runs.",
+    )
+    parser.add_argument(
+        "-d",
+        "--derive",
+        action="store",
+        dest="derive",
+        default=",".join(DERIVED),
+        help="Comma separated list of wind, humidity and accumulations. Defaults to all of them.",
+    )
+    parser.add_argument(
+        "-t",
+        "--totals",
+        action="store",
+        dest="totals",
+        default=DEFAULT_TOTALS,
+        help="Comma separated shortNames of the totals turned into accumulations per step. Defaults to tp.",
+    )
+    parser.add_argument(
+        "-w",
+        "--processes",
+        action="store",
+        dest="processes",
+        default=os.cpu_count() or 1,
+        type=int,
+        help="Number of processes decoding and computing. Defaults to the number of CPUs.",
+    )
+
+    args = parser.parse_args()
+
+    if importlib.util.find_spec("eccodes") is None or importlib.util.find_spec("numpy") is None:
+        print("ERROR: The eccodes and numpy packages are needed to derive fields - pip install eccodes numpy")
+        sys.exit()
+
+    derived = args.derive.lower().split(",")
+    for name in derived:
+        if name not in DERIVED:
+            print("ERROR: " + name + " is not one of " + ", ".join(DERIVED))
+            sys.exit()
+
+    if args.folders != "":
+        runFolders = args.folders.split(",")
+    elif args.orders != "":
+        baseFolder = args.location
+        if baseFolder != "" and baseFolder[-1] != "/":
+            baseFolder = baseFolder + "/"
+        runFolders = [
+            baseFolder + "downloaded/" + order + "_" + run
+            for order in args.orders.lower().split(",")
+            for run in args.runs.split(",")
+        ]
+    else:
+        print("ERROR: You must pass either --folders or --orders.")
+        sys.exit()
+
+    for runFolder in runFolders:
+        if not os.path.isdir(runFolder):
+            print("WARNING: " + runFolder + " does not exist so is skipped.")
+            continue
+        derive_run(runFolder, derived, args.totals.split(","), max(args.processes, 1))
+
+# End of python program.
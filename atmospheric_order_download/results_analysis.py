@@ -0,0 +1,467 @@
+# 2023 (C) Crown Copyright, Met Office. All rights reserved.
+#
+# This file is part of Weather DataHub and is released under the
+# BSD 3-Clause license.
+# See LICENSE in the root of the repository for full licensing details.
+# (c) Met Office 2023
+
+import argparse
+import csv
+import glob
+import os
+import re
+import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+# Example code to analyse the results/ and failures/ summaries written by cda_download.py and map_images_download.py
+
+DIGITS = re.compile(r"\d+")
+PERCENTILES = [50, 90, 99]
+
+
+def new_table():
+    # Columns of the file table are arrays with strings held as codes into a list
+    return {
+        "order": array("l"),
+        "pattern": array("l"),
+        "start": array("d"),
+        "duration": array("d"),
+        "ttfb": array("d"),
+        "fileSize": array("q"),
+        "error": array("b"),
+        "orders": [],
+        "patterns": [],
+        "models": {},
+        "invocations": [],
+        "retryFailures": {},
+    }
+
+
+def code_for(value, values, codes):
+    code = codes.get(value)
+    if code is None:
+        code = len(values)
+        codes[value] = code
+        values.append(value)
+    return code
+
+
+def file_pattern(fileId):
+    # Group files that differ only by their run, date or step
+    return DIGITS.sub("#", fileId)
+
+
+def read_summaries(summaryFiles):
+    # Runs in a worker process - parses whole files with split() and only uses csv for quoted lines
+    table = new_table()
+    orderCodes = {}
+    patternCodes = {}
+    fileIdCodes = {}
+
+    for summaryFile in summaryFiles:
+        with open(summaryFile, "r", newline="") as sumfile:
+            lines = sumfile.read().split("\n")
+        if len(lines) < 4 or lines[2] != "===== Detail Section =====":
+            continue
+
+        # The download of order [x] started at: dd/mm/YYYY HH:MM:SS finished at: dd/mm/YYYY HH:MM:SS
+        header = lines[0]
+        try:
+            orderName = header[header.index("[") + 1:header.index("]")]
+            started = datetime.strptime(header[header.index("started at: ") + 12:][:19], "%d/%m/%Y %H:%M:%S")
+        except ValueError:
+            continue
+        midnight = datetime(started.year, started.month, started.day).timestamp()
+        startSecond = started.hour * 3600 + started.minute * 60 + started.second
+
+        # Total Files: N Total time taken: Xs Total Size: S Workers: W [Model: M]
+        totals = lines[1].split()
+        try:
+            totalTime = float(totals[6][:-1])
+            totalSize = int(totals[9])
+            workers = int(totals[11])
+        except (IndexError, ValueError):
+            continue
+        model = totals[13] if len(totals) > 13 else "unknown"
+        if model != "unknown" or orderName not in table["models"]:
+            table["models"][orderName] = model
+        table["invocations"].append([orderName, started.timestamp(), totalTime, totalSize, workers])
+
+        orderCode = code_for(orderName, table["orders"], orderCodes)
+        for line in lines[4:]:
+            if line == "":
+                continue
+            if '"' in line:
+                fields = next(csv.reader([line]))
+            else:
+                fields = line.split(",")
+            if len(fields) != 9:
+                continue
+            # order,duration,time_to_first_byte,fileSize,fileId,error,errMsg,file,currentTime
+            if fields[6] == "RETRY-OK":
+                continue
+            try:
+                duration = float(fields[1])
+                ttfb = float(fields[2])
+                fileSize = int(fields[3])
+                timeParts = fields[8].split("-")
+                second = int(timeParts[0]) * 3600 + int(timeParts[1]) * 60 + int(timeParts[2])
+            except (ValueError, IndexError):
+                continue
+            # Only the time of day is recorded for each file so allow for runs over midnight
+            if second < startSecond:
+                second += 86400
+
+            table["order"].append(orderCode)
+            # The same fileIds come round in every run so only work out each pattern once
+            patternCode = fileIdCodes.get(fields[4])
+            if patternCode is None:
+                patternCode = code_for(file_pattern(fields[4]), table["patterns"], patternCodes)
+                fileIdCodes[fields[4]] = patternCode
+            table["pattern"].append(patternCode)
+            table["start"].append(midnight + second)
+            table["duration"].append(duration)
+            table["ttfb"].append(ttfb)
+            table["fileSize"].append(fileSize)
+            table["error"].append(1 if fields[5] == "True" else 0)
+
+    return table
+
+
+def read_failures(failureFiles):
+    # Files still failing after a retry are recorded as "File x FAILED on retry..." lines
+    retryFailures = {}
+    for failureFile in failureFiles:
+        with open(failureFile, "r") as errfile:
+            for line in errfile:
+                if line.startswith("File ") and " FAILED on retry" in line:
+                    pattern = file_pattern(line[5:line.index(" FAILED on retry")])
+                    retryFailures[pattern] = retryFailures.get(pattern, 0) + 1
+    return retryFailures
+
+
+def merge_tables(tables):
+    merged = new_table()
+    orderCodes = {}
+    patternCodes = {}
+    for table in tables:
+        orderMap = [code_for(o, merged["orders"], orderCodes) for o in table["orders"]]
+        patternMap = [code_for(p, merged["patterns"], patternCodes) for p in table["patterns"]]
+        merged["order"].extend(array("l", [orderMap[c] for c in table["order"]]))
+        merged["pattern"].extend(array("l", [patternMap[c] for c in table["pattern"]]))
+        for column in ["start", "duration", "ttfb", "fileSize", "error"]:
+            merged[column].extend(table[column])
+        for orderName in table["models"]:
+            if table["models"][orderName] != "unknown" or orderName not in merged["models"]:
+                merged["models"][orderName] = table["models"][orderName]
+        merged["invocations"].extend(table["invocations"])
+    return merged
+
+
+def load_history(baseFolder, processes, since):
+    summaryFiles = sorted(glob.glob(baseFolder + "results/summary-*.txt"))
+    failureFiles = sorted(glob.glob(baseFolder + "failures/summary-*.txt"))
+    if since is not None:
+        summaryFiles = [f for f in summaryFiles if os.path.getmtime(f) >= since.timestamp()]
+        failureFiles = [f for f in failureFiles if os.path.getmtime(f) >= since.timestamp()]
+
+    # Split the files between the processes in interleaved chunks so each gets a similar mix
+    chunks = [summaryFiles[i::processes] for i in range(processes) if len(summaryFiles[i::processes]) > 0]
+    if processes > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            tables = list(executor.map(read_summaries, chunks))
+    else:
+        tables = [read_summaries(summaryFiles)]
+
+    table = merge_tables(tables)
+    table["retryFailures"] = read_failures(failureFiles)
+    if since is not None:
+        table = select_rows(table, since.timestamp(), float("inf"))
+    return table
+
+
+def select_rows(table, fromTime, toTime):
+    # Returns a copy of the table holding only the files started between the two times
+    selected = new_table()
+    selected["orders"] = table["orders"]
+    selected["patterns"] = table["patterns"]
+    selected["models"] = table["models"]
+    selected["retryFailures"] = table["retryFailures"]
+    keep = [i for i, start in enumerate(table["start"]) if fromTime <= start < toTime]
+    for column in ["order", "pattern", "start", "duration", "ttfb", "fileSize", "error"]:
+        values = table[column]
+        selected[column] = array(values.typecode, [values[i] for i in keep])
+    selected["invocations"] = [inv for inv in table["invocations"] if fromTime <= inv[1] < toTime]
+    return selected
+
+
+def percentile(sortedValues, percent):
+    if len(sortedValues) == 0:
+        return 0
+    index = min(len(sortedValues) - 1, int(round(percent / 100 * (len(sortedValues) - 1))))
+    return sortedValues[index]
+
+
+def group_stats(table, keys):
+    # TTFB and duration percentiles of the successful files for each value of the group key
+    groups = {}
+    ttfb = table["ttfb"]
+    duration = table["duration"]
+    error = table["error"]
+    for i in range(len(keys)):
+        if error[i]:
+            continue
+        group = groups.get(keys[i])
+        if group is None:
+            group = [[], []]
+            groups[keys[i]] = group
+        group[0].append(ttfb[i])
+        group[1].append(duration[i])
+
+    stats = {}
+    for key in groups:
+        ttfbs = sorted(groups[key][0])
+        durations = sorted(groups[key][1])
+        stats[key] = {
+            "files": len(ttfbs),
+            "ttfb": [percentile(ttfbs, p) for p in PERCENTILES],
+            "duration": [percentile(durations, p) for p in PERCENTILES],
+        }
+    return stats
+
+
+def print_group_stats(title, stats):
+    print()
+    print(title)
+    print("-" * len(title))
+    columns = " ".join("ttfb_p" + str(p) for p in PERCENTILES) + " " + " ".join("dur_p" + str(p) for p in PERCENTILES)
+    print("{:<40} {:>8} {}".format("", "files", columns))
+    for key in sorted(stats):
+        values = stats[key]["ttfb"] + stats[key]["duration"]
+        print(
+            "{:<40} {:>8} {}".format(
+                str(key), stats[key]["files"], " ".join("{:>8.2f}".format(v) for v in values)
+            )
+        )
+
+
+def print_timeline(table):
+    # Overall rate of the downloads started in each hour
+    hours = {}
+    for orderName, startTime, totalTime, totalSize, workers in table["invocations"]:
+        hour = int(startTime // 3600)
+        bucket = hours.setdefault(hour, [0, 0, 0])
+        bucket[0] += totalSize
+        bucket[1] += totalTime
+        bucket[2] += 1
+
+    print()
+    print("Throughput timeline")
+    print("-------------------")
+    print("{:<20} {:>8} {:>12} {:>10}".format("hour", "orders", "MB", "MB/s"))
+    for hour in sorted(hours):
+        bucket = hours[hour]
+        rate = bucket[0] / bucket[1] / 1024 / 1024 if bucket[1] > 0 else 0
+        print(
+            "{:<20} {:>8} {:>12.1f} {:>10.2f}".format(
+                datetime.fromtimestamp(hour * 3600).strftime("%Y-%m-%d %H:00"),
+                bucket[2],
+                bucket[0] / 1024 / 1024,
+                rate,
+            )
+        )
+
+
+def print_failure_hotspots(table, top):
+    counts = {}
+    for i in range(len(table["pattern"])):
+        count = counts.setdefault(table["pattern"][i], [0, 0])
+        count[0] += 1
+        count[1] += table["error"][i]
+
+    hotspots = []
+    for code in counts:
+        pattern = table["patterns"][code]
+        retried = table["retryFailures"].get(pattern, 0)
+        if counts[code][1] > 0 or retried > 0:
+            hotspots.append([counts[code][1], retried, counts[code][0], pattern])
+    hotspots.sort(reverse=True)
+
+    print()
+    print("Failure hot-spots")
+    print("-----------------")
+    print("{:<60} {:>8} {:>8} {:>8} {:>8}".format("fileId pattern", "files", "failed", "rate%", "retry"))
+    for failed, retried, files, pattern in hotspots[:top]:
+        print(
+            "{:<60} {:>8} {:>8} {:>8.1f} {:>8}".format(
+                pattern, files, failed, failed / files * 100 if files > 0 else 0, retried
+            )
+        )
+
+
+def order_rates(table):
+    rates = {}
+    for orderName, startTime, totalTime, totalSize, workers in table["invocations"]:
+        rate = rates.setdefault(orderName, [0, 0])
+        rate[0] += totalSize
+        rate[1] += totalTime
+    return {o: rates[o][0] / rates[o][1] for o in rates if rates[o][1] > 0}
+
+
+def print_regressions(table, baseline, compare, threshold):
+    # Compare each order between two periods - higher percentiles or a lower rate count as regressions
+    before = select_rows(table, baseline[0], baseline[1])
+    after = select_rows(table, compare[0], compare[1])
+    beforeStats = group_stats(before, [before["orders"][c] for c in before["order"]])
+    afterStats = group_stats(after, [after["orders"][c] for c in after["order"]])
+    beforeRates = order_rates(before)
+    afterRates = order_rates(after)
+
+    print()
+    print("Regressions (more than " + str(threshold) + "% worse)")
+    print("-----------")
+    found = False
+    for orderName in sorted(set(beforeStats) & set(afterStats)):
+        checks = []
+        for measure in ["ttfb", "duration"]:
+            for index in range(len(PERCENTILES)):
+                checks.append(
+                    [
+                        measure + "_p" + str(PERCENTILES[index]),
+                        beforeStats[orderName][measure][index],
+                        afterStats[orderName][measure][index],
+                    ]
+                )
+        for name, old, new in checks:
+            if old > 0 and (new - old) / old * 100 > threshold:
+                found = True
+                print("{:<40} {:<12} {:>10.2f} -> {:>10.2f}".format(orderName, name, old, new))
+        if orderName in beforeRates and orderName in afterRates:
+            old = beforeRates[orderName] / 1024 / 1024
+            new = afterRates[orderName] / 1024 / 1024
+            if old > 0 and (old - new) / old * 100 > threshold:
+                found = True
+                print("{:<40} {:<12} {:>10.2f} -> {:>10.2f}".format(orderName, "MB/s", old, new))
+    if not found:
+        print("None found.")
+
+
+def parse_period(period):
+    # YYYYMMDD-YYYYMMDD inclusive of both days
+    fromDate, toDate = period.split("-")
+    start = datetime.strptime(fromDate, "%Y%m%d").timestamp()
+    end = datetime.strptime(toDate, "%Y%m%d").timestamp() + 86400
+    return [start, end]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Analyse the download performance recorded in the results/ and failures/ folders."
+    )
+    parser.add_argument(
+        "-l",
+        "--location",
+        action="store",
+        dest="location",
+        default="",
+        help="The base folder holding the results/ and failures/ folders.",
+    )
+    parser.add_argument(
+        "-s",
+        "--since",
+        action="store",
+        dest="since",
+        default="",
+        help="OPTIONAL: Only analyse summaries from this date (YYYYMMDD) onwards.",
+    )
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        action="store",
+        dest="baseline",
+        default="",
+        help="OPTIONAL: Period YYYYMMDD-YYYYMMDD to compare against for regressions.",
+    )
+    parser.add_argument(
+        "-c",
+        "--compare",
+        action="store",
+        dest="compare",
+        default="",
+        help="OPTIONAL: Period YYYYMMDD-YYYYMMDD checked for regressions against the baseline.",
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        action="store",
+        dest="threshold",
+        default=20,
+        type=float,
+        help="Percentage change counted as a regression. Defaults to 20.",
+    )
+    parser.add_argument(
+        "-n",
+        "--top",
+        action="store",
+        dest="top",
+        default=20,
+        type=int,
+        help="Number of failure hot-spots to list. Defaults to 20.",
+    )
+    parser.add_argument(
+        "-w",
+        "--processes",
+        action="store",
+        dest="processes",
+        default=os.cpu_count() or 1,
+        type=int,
+        help="Number of processes used to read the summaries. Defaults to the number of CPUs.",
+    )
+
+    args = parser.parse_args()
+
+    baseFolder = args.location
+    if baseFolder != "" and baseFolder[-1] != "/":
+        baseFolder = baseFolder + "/"
+
+    since = None
+    try:
+        if args.since != "":
+            since = datetime.strptime(args.since, "%Y%m%d")
+        baseline = parse_period(args.baseline) if args.baseline != "" else None
+        compare = parse_period(args.compare) if args.compare != "" else None
+    except ValueError:
+        print("ERROR: Dates must be YYYYMMDD and periods YYYYMMDD-YYYYMMDD.")
+        sys.exit()
+
+    if (baseline is None) != (compare is None):
+        print("ERROR: Both --baseline and --compare are needed to look for regressions.")
+        sys.exit()
+
+    table = load_history(baseFolder, max(args.processes, 1), since)
+    if len(table["start"]) == 0:
+        print("WARNING: No summaries found in " + baseFolder + "results/")
+        sys.exit()
+
+    print(
+        "Analysed "
+        + str(len(table["start"]))
+        + " files from "
+        + str(len(table["invocations"]))
+        + " order downloads"
+    )
+
+    print_timeline(table)
+    orderNames = [table["orders"][c] for c in table["order"]]
+    print_group_stats("By model", group_stats(table, [table["models"].get(o, "unknown") for o in orderNames]))
+    print_group_stats("By order", group_stats(table, orderNames))
+    print_group_stats(
+        "By hour of day", group_stats(table, [datetime.fromtimestamp(t).hour for t in table["start"]])
+    )
+    print_failure_hotspots(table, args.top)
+    if baseline is not None:
+        print_regressions(table, baseline, compare, args.threshold)
+
+# End of python program.
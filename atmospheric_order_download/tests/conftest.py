@@ -0,0 +1,124 @@
+# 2023 (C) Crown Copyright, Met Office. All rights reserved.
+#
+# This file is part of Weather DataHub and is released under the
+# BSD 3-Clause license.
+# See LICENSE in the root of the repository for full licensing details.
+# (c) Met Office 2023
+
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+import pytest
+
+# A stand-in for the Weather DataHub API serving one run of one order, which counts how many times each
+# file is sent in full.  The tests run cda_download.py against it as a separate process
+
+CDA_DOWNLOAD = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cda_download.py")
+ORDER = "harness_order"
+MODEL = "mo-global"
+RUN = "12"
+RUN_DATE_TIME = "2024-01-01T12:00:00Z"
+
+
+class WdhStandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body, contentType="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def do_GET(self):
+        wdh = self.server.wdh
+        parts = unquote(urlparse(self.path).path).strip("/").split("/")
+        if parts == ["orders"]:
+            orders = [{"orderId": ORDER, "modelId": MODEL, "requiredLatestRuns": [RUN]}]
+            return self.send(200, json.dumps({"orders": orders}).encode())
+        if parts[0] == "runs":
+            runs = {"completeRuns": [{"run": RUN, "runDateTime": RUN_DATE_TIME}]}
+            return self.send(200, json.dumps(runs).encode())
+        if parts[0] == "orders" and len(parts) == 3:
+            files = [{"fileId": fileId, "fileSize": wdh.file_size(fileId)} for fileId in wdh.file_ids()]
+            return self.send(200, json.dumps({"orderDetails": {"order": {"orderId": ORDER}, "files": files}}).encode())
+        if parts[0] == "orders" and parts[-1] == "data":
+            with wdh.lock:
+                wdh.served += 1
+                hang = 0 <= wdh.hangAfter < wdh.served
+            if hang:
+                # Held until released, then failed - a request that hangs never counts as sent
+                wdh.release.wait(120)
+                try:
+                    self.send(503, b"released", "text/plain")
+                except OSError:
+                    # The process that asked has been killed
+                    pass
+                return
+            self.send(200, parts[3].encode().ljust(wdh.file_size(parts[3]), b"."), "application/x-grib")
+            with wdh.lock:
+                wdh.sent[parts[3]] = wdh.sent.get(parts[3], 0) + 1
+            return
+        self.send(404, b"not found", "text/plain")
+
+
+class Wdh:
+    # What the stand-in serves and what it has sent.  files is the number of files in the run and sizes the
+    # size of any that are not fileSize bytes
+    def __init__(self, port):
+        self.port = port
+        self.files = 0
+        self.fileSize = 1000
+        self.sizes = {}
+        self.lock = threading.Lock()
+        self.release = threading.Event()
+        self.reset()
+
+    def reset(self, hangAfter=-1):
+        # hangAfter is the number of files sent before every further request hangs, or -1 for none
+        with self.lock:
+            self.sent = {}
+            self.served = 0
+            self.hangAfter = hangAfter
+        self.release.clear()
+
+    def file_ids(self):
+        return ["harness_param_" + str(i).zfill(3) + "_+" + RUN for i in range(self.files)]
+
+    def file_size(self, fileId):
+        return self.sizes.get(fileId, self.fileSize)
+
+    def times_sent(self, times):
+        # The files not sent exactly that many times
+        return [fileId for fileId in self.file_ids() if self.sent.get(fileId, 0) != times]
+
+    def command(self, location, *options):
+        return [
+            sys.executable, CDA_DOWNLOAD,
+            "--url", "http://127.0.0.1:" + str(self.port),
+            "--apikey", "harness",
+            "--orders", ORDER,
+            "--runs", RUN,
+            "--location", location,
+        ] + list(options)
+
+
+@pytest.fixture
+def wdh():
+    standIn = ThreadingHTTPServer(("127.0.0.1", 0), WdhStandIn)
+    standIn.daemon_threads = True
+    standIn.wdh = Wdh(standIn.server_port)
+    threading.Thread(target=standIn.serve_forever, daemon=True).start()
+    yield standIn.wdh
+    # Lets any request still hanging finish so the server can stop
+    standIn.wdh.release.set()
+    standIn.shutdown()
+    standIn.server_close()
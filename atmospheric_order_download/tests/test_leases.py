@@ -0,0 +1,105 @@
+# 2023 (C) Crown Copyright, Met Office. All rights reserved.
+#
+# This file is part of Weather DataHub and is released under the
+# BSD 3-Clause license.
+# See LICENSE in the root of the repository for full licensing details.
+# (c) Met Office 2023
+
+import os
+import signal
+import sqlite3
+import subprocess
+import time
+
+from conftest import ORDER, RUN
+
+# Checks the --coordinate leases of cda_download.py with several processes on this machine:
+#   shared - several processes download one run together and every file must be sent exactly once
+#   expiry - a process is killed while it holds leases and another one must take them over once they have
+#            expired, still fetching every file exactly once
+
+FILES = 40
+PROCESSES = 3
+WORKERS = 4
+LEASE_TIME = 3
+
+
+def start_download(wdh, location, leaseFile, workerId, logFile):
+    return subprocess.Popen(
+        wdh.command(
+            location,
+            "--workers", str(WORKERS),
+            "--coordinate", leaseFile,
+            "--leasetime", str(LEASE_TIME),
+            "--workerid", workerId,
+        ),
+        stdout=logFile,
+        stderr=subprocess.STDOUT,
+    )
+
+
+def leases(leaseFile, where, values=()):
+    conn = sqlite3.connect(leaseFile, timeout=10)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM leases WHERE " + where, values).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def leases_held(leaseFile, workerId):
+    try:
+        return leases(leaseFile, "owner=? AND status='leased'", (workerId,))
+    except sqlite3.Error:
+        return 0
+
+
+def check_run(wdh, location, leaseFile, logName):
+    # Every file sent once, in the run folder and marked done in the lease file
+    with open(logName) as logFile:
+        log = logFile.read()[-3000:]
+    assert wdh.times_sent(1) == [], log
+    missing = [
+        fileId for fileId in wdh.file_ids()
+        if not os.path.exists(os.path.join(location, "downloaded", ORDER + "_" + RUN, fileId + ".grib2"))
+    ]
+    assert missing == [], log
+    assert leases(leaseFile, "status != 'done'") == 0, log
+
+
+def test_shared_run(wdh, tmp_path):
+    wdh.files = FILES
+    location = str(tmp_path / "shared")
+    leaseFile = str(tmp_path / "leases.db")
+    logName = str(tmp_path / "shared.log")
+    with open(logName, "w") as logFile:
+        downloads = [start_download(wdh, location, leaseFile, "worker" + str(i), logFile) for i in range(PROCESSES)]
+        for download in downloads:
+            download.wait(300)
+    check_run(wdh, location, leaseFile, logName)
+
+
+def test_expired_leases_taken_over(wdh, tmp_path):
+    # The first process gets some files then hangs on its next requests - it is killed holding those leases
+    wdh.files = FILES
+    completeFirst = FILES // 4
+    wdh.reset(completeFirst)
+    location = str(tmp_path / "expiry")
+    leaseFile = str(tmp_path / "leases.db")
+    logName = str(tmp_path / "expiry.log")
+    with open(logName, "w") as logFile:
+        first = start_download(wdh, location, leaseFile, "crashed", logFile)
+        waitUntil = time.time() + 60
+        while leases_held(leaseFile, "crashed") < WORKERS and time.time() < waitUntil:
+            time.sleep(0.2)
+        held = leases_held(leaseFile, "crashed")
+        first.send_signal(signal.SIGKILL)
+        first.wait()
+        wdh.release.set()
+        with wdh.lock:
+            wdh.hangAfter = -1
+        assert held > 0, "The first process never held a lease"
+
+        second = start_download(wdh, location, leaseFile, "takeover", logFile)
+        second.wait(300)
+    check_run(wdh, location, leaseFile, logName)
+    assert len(wdh.sent) > completeFirst, "The second process fetched nothing"
@@ -0,0 +1,169 @@
+# 2023 (C) Crown Copyright, Met Office. All rights reserved.
+#
+# This file is part of Weather DataHub and is released under the
+# BSD 3-Clause license.
+# See LICENSE in the root of the repository for full licensing details.
+# (c) Met Office 2023
+
+import csv
+import hashlib
+import io
+import logging
+import os
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from conftest import ORDER, RUN
+
+# Checks the --s3url output of cda_download.py against a local stand-in for an S3 compatible store (moto's
+# server, used the way MinIO would be):
+#   upload  - every file of a run becomes an object of the right size, including one big enough to be sent
+#             as a multipart upload, and with --fillgaps a second download fetches nothing
+#   layout  - with --layout hash the objects are sharded, the file map is kept in the bucket beside them and
+#             no folders are made on disk
+#   denied  - a store that refuses every request must not be taken to be empty, so with --fillgaps nothing
+#             is fetched and the failures are reported
+
+BUCKET = "harness-bucket"
+PREFIX = "wdh"
+FILES = 20
+LARGE_SIZE = 6 * 1024 * 1024
+CREDENTIALS = {"AWS_ACCESS_KEY_ID": "harness", "AWS_SECRET_ACCESS_KEY": "harness", "AWS_DEFAULT_REGION": "us-east-1"}
+
+
+class DeniedStore(BaseHTTPRequestHandler):
+    # Answers everything the way a store does when the credentials are wrong
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def refuse(self):
+        body = b"<?xml version='1.0' encoding='UTF-8'?><Error><Code>AccessDenied</Code><Message>Access Denied</Message></Error>"
+        self.send_response(403)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body) if self.command != "HEAD" else 0))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    do_HEAD = do_GET = do_PUT = do_POST = do_DELETE = refuse
+
+
+@pytest.fixture
+def store():
+    # A fresh bucket in a stand-in store - yields its endpoint and a client for it
+    boto3 = pytest.importorskip("boto3")
+    motoServer = pytest.importorskip("moto.server")
+    # The stand-in store logs every request otherwise
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = motoServer.ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+    server.start()
+    endpoint = "http://127.0.0.1:" + str(server.get_host_and_port()[1])
+    client = boto3.client(
+        "s3",
+        endpoint_url=endpoint,
+        aws_access_key_id="harness",
+        aws_secret_access_key="harness",
+        region_name="us-east-1",
+    )
+    client.create_bucket(Bucket=BUCKET)
+    yield endpoint, client
+    server.stop()
+
+
+@pytest.fixture
+def run(wdh):
+    # The first file is over the 5MB part size so goes up in several parts
+    wdh.files = FILES
+    wdh.sizes = {wdh.file_ids()[0]: LARGE_SIZE}
+    return wdh
+
+
+def download(wdh, location, endpoint, *options):
+    command = wdh.command(
+        location,
+        "--s3url", "s3://" + BUCKET + "/" + PREFIX,
+        "--s3endpoint", endpoint,
+        "--partsize", "5",
+    ) + list(options)
+    result = subprocess.run(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env=dict(os.environ, **CREDENTIALS),
+        timeout=300,
+    )
+    return result.stdout.decode(errors="replace")
+
+
+def run_prefix():
+    return PREFIX + "/downloaded/" + ORDER + "_" + RUN + "/"
+
+
+def object_sizes(client):
+    sizes = {}
+    for page in client.get_paginator("list_objects_v2").paginate(Bucket=BUCKET, Prefix=PREFIX + "/"):
+        for item in page.get("Contents", []):
+            sizes[item["Key"]] = item["Size"]
+    return sizes
+
+
+def check_objects(wdh, client, log, names):
+    # Every file is an object of the size that was sent, and no multipart upload is left unfinished
+    sizes = object_sizes(client)
+    for fileId in wdh.file_ids():
+        assert sizes.get(run_prefix() + names[fileId]) == wdh.file_size(fileId), fileId + "\n" + log
+    assert client.list_multipart_uploads(Bucket=BUCKET).get("Uploads", []) == [], log
+    return sizes
+
+
+def test_upload_and_refill(run, store, tmp_path):
+    endpoint, client = store
+    names = {fileId: fileId + ".grib2" for fileId in run.file_ids()}
+
+    log = download(run, str(tmp_path / "upload"), endpoint)
+    assert run.times_sent(1) == [], log
+    assert len(check_objects(run, client, log, names)) == FILES, log
+
+    run.reset()
+    log = download(run, str(tmp_path / "refill"), endpoint, "--fillgaps")
+    assert run.times_sent(0) == [], log
+    assert len(check_objects(run, client, log, names)) == FILES, log
+
+
+def test_hash_layout_keeps_file_map_in_bucket(run, store, tmp_path):
+    endpoint, client = store
+    names = {fileId: hashlib.sha256(fileId.encode()).hexdigest()[:2] + "/" + fileId + ".grib2" for fileId in run.file_ids()}
+    location = tmp_path / "layout"
+
+    log = download(run, str(location), endpoint, "--layout", "hash")
+    assert run.times_sent(1) == [], log
+    check_objects(run, client, log, names)
+    fileMap = client.get_object(Bucket=BUCKET, Key=run_prefix() + "filemap.csv")["Body"].read().decode()
+    assert sorted(csv.reader(io.StringIO(fileMap))) == sorted([fileId, name] for fileId, name in names.items()), log
+    assert not (location / "downloaded" / (ORDER + "_" + RUN)).exists(), log
+
+    # Files found again are already in the map so are not added twice
+    run.reset()
+    log = download(run, str(location), endpoint, "--layout", "hash", "--fillgaps")
+    assert run.times_sent(0) == [], log
+    fileMap = client.get_object(Bucket=BUCKET, Key=run_prefix() + "filemap.csv")["Body"].read().decode()
+    assert len(fileMap.splitlines()) == FILES, log
+
+
+def test_denied_store_is_not_taken_to_be_empty(run, tmp_path):
+    pytest.importorskip("boto3")
+    denied = ThreadingHTTPServer(("127.0.0.1", 0), DeniedStore)
+    denied.daemon_threads = True
+    threading.Thread(target=denied.serve_forever, daemon=True).start()
+    try:
+        log = download(run, str(tmp_path / "denied"), "http://127.0.0.1:" + str(denied.server_port), "--fillgaps")
+    finally:
+        denied.shutdown()
+        denied.server_close()
+    assert run.times_sent(0) == [], log
+    assert "detected download failures" in log, log[-3000:]
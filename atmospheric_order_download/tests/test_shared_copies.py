@@ -0,0 +1,37 @@
+# 2023 (C) Crown Copyright, Met Office. All rights reserved.
+#
+# This file is part of Weather DataHub and is released under the
+# BSD 3-Clause license.
+# See LICENSE in the root of the repository for full licensing details.
+# (c) Met Office 2023
+
+import os
+
+import pytest
+
+# Modules copied into each download folder that uses them so every folder stands on its own.  The copy in
+# atmospheric_order_download is the one that is changed - the others must be the same, byte for byte, so
+# after a change copy it over them
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SOURCE_FOLDER = "atmospheric_order_download"
+COPIES = {
+    "profiler.py": ["map_images_download", "site_specific_download", "bpf_download"],
+    "faults.py": ["map_images_download"],
+    "cassette.py": ["map_images_download"],
+}
+
+
+@pytest.mark.parametrize(
+    "moduleName, folder",
+    [[moduleName, folder] for moduleName, folders in COPIES.items() for folder in folders],
+)
+def test_copy_matches_source(moduleName, folder):
+    with open(os.path.join(REPOSITORY, SOURCE_FOLDER, moduleName), "rb") as f:
+        source = f.read()
+    with open(os.path.join(REPOSITORY, folder, moduleName), "rb") as f:
+        copy = f.read()
+    assert copy == source, (
+        folder + "/" + moduleName + " differs from " + SOURCE_FOLDER + "/" + moduleName
+        + " - make the change there and copy it over the others"
+    )
@@ -10,6 +10,7 @@ import argparse
 import time
 import sys
 import logging as log
+from profiler import PROFILE_MODES, profile_phase, start_profile
 
 log.basicConfig(filename='bpf_feature_collections.log', filemode='w',
                 format='%(asctime)s - %(levelname)s - %(message)s')
@@ -36,6 +37,7 @@ def retrieve_collections(base_url, request_headers):
                 log.error("Retries exceeded", exc_info=True)
                 sys.exit()
 
+    profile_phase("response")
     req.encoding = 'utf-8'
 
     print(req.text)
@@ -54,6 +56,15 @@ if __name__ == "__main__":
         default="",
         help="REQUIRED: Your WDH API Credentials."
     )
+    parser.add_argument(
+        "-pf",
+        "--profile",
+        action="store",
+        dest="profile",
+        default="",
+        choices=PROFILE_MODES,
+        help="OPTIONAL: Profile the program - cpu, wall or mem - writing the report to the current folder."
+    )
 
     args = parser.parse_args()
     apikey = args.apikey
@@ -65,4 +76,7 @@ if __name__ == "__main__":
     else:
         requestHeaders = {"apikey": apikey}
 
+    if args.profile != "":
+        start_profile(args.profile, "profile-bpf_feature_collections-" + time.strftime("%d-%b-%Y-%H-%M-%S"))
+
     retrieve_collections(base_url, requestHeaders)
@@ -10,6 +10,7 @@ import argparse
 import time
 import sys
 import logging as log
+from profiler import PROFILE_MODES, profile_phase, start_profile
 
 log.basicConfig(filename='bpf_feature_data_download.log',
                 filemode='w', format='%(asctime)s - %(levelname)s - %(message)s')
@@ -42,6 +43,7 @@ def retrieve_forecast(base_url, collection_id, request_headers, location_id):
                 log.error("Retries exceeded", exc_info=True)
                 sys.exit()
 
+    profile_phase("response")
     req.encoding = 'utf-8'
 
     if req.status_code != 200:
@@ -86,6 +88,15 @@ if __name__ == "__main__":
         default="",
         help="REQUIRED: Your WDH API Credentials."
     )
+    parser.add_argument(
+        "-pf",
+        "--profile",
+        action="store",
+        dest="profile",
+        default="",
+        choices=PROFILE_MODES,
+        help="OPTIONAL: Profile the program - cpu, wall or mem - writing the report to the current folder."
+    )
 
     args = parser.parse_args()
 
@@ -105,4 +116,7 @@ if __name__ == "__main__":
         print(*allowed_collection_ids, sep="\n")
         sys.exit()
 
+    if args.profile != "":
+        start_profile(args.profile, "profile-bpf_feature_data_download-" + time.strftime("%d-%b-%Y-%H-%M-%S"))
+
     retrieve_forecast(base_url, collection_id, requestHeaders, location_id)
@@ -0,0 +1,194 @@
+# 2023 (C) Crown Copyright, Met Office. All rights reserved.
+#
+# This file is part of Weather DataHub and is released under the
+# BSD 3-Clause license.
+# See LICENSE in the root of the repository for full licensing details.
+# (c) Met Office 2023
+
+import atexit
+import cProfile
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+# Profiling used by the --profile option.  cpu - cProfile of the main thread and every worker thread,
+# wall - a sampling profiler of all the threads, mem - tracemalloc snapshots at the end of each phase
+
+PROFILE_MODES = ["cpu", "wall", "mem"]
+SAMPLE_INTERVAL = 0.005
+TOP_ENTRIES = 40
+THREAD_NUMBER = re.compile(r"^Thread-\d+ ?")
+
+activeProfile = None
+
+
+def thread_group(name):
+    # Worker threads are reported together, for example Thread-3 (download_worker) as (download_worker)
+    return THREAD_NUMBER.sub("", name) or name
+
+
+def start_thread_profile(*args):
+    # Installed with threading.setprofile so runs first thing in each new thread, where it swaps itself for
+    # a cProfile of that thread
+    profile = cProfile.Profile()
+    with activeProfile["lock"]:
+        activeProfile["profiles"].append(profile)
+    profile.enable()
+
+
+def sample_threads(state):
+    # Counts the functions on every thread's stack each interval - a function is counted once per sample
+    # in "total" and, when it is the one running, in "self"
+    me = threading.get_ident()
+    while not state["stop"].wait(SAMPLE_INTERVAL):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            group = thread_group(names.get(ident, "unknown"))
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(code.co_name + " (" + os.path.basename(code.co_filename) + ":" + str(code.co_firstlineno) + ")")
+                frame = frame.f_back
+            state["samples"] += 1
+            state["groups"][group] = state["groups"].get(group, 0) + 1
+            key = (group, stack[0])
+            state["self"][key] = state["self"].get(key, 0) + 1
+            for function in set(stack):
+                key = (group, function)
+                state["total"][key] = state["total"].get(key, 0) + 1
+            collapsed = ";".join([group] + stack[::-1])
+            state["stacks"][collapsed] = state["stacks"].get(collapsed, 0) + 1
+
+
+def start_profile(mode, reportPrefix):
+    # Call before any worker threads are started.  The reports are written when the program exits
+    global activeProfile
+    activeProfile = {"mode": mode, "prefix": reportPrefix, "started": time.time(), "lock": threading.Lock()}
+    atexit.register(stop_profile)
+    if mode == "cpu":
+        activeProfile["profiles"] = []
+        main = cProfile.Profile()
+        activeProfile["main"] = main
+        # From Python 3.12 one profile sees every thread, before that each thread needs its own
+        if sys.version_info < (3, 12):
+            threading.setprofile(start_thread_profile)
+        main.enable()
+    elif mode == "wall":
+        activeProfile.update({"stop": threading.Event(), "samples": 0, "groups": {}, "self": {}, "total": {}, "stacks": {}})
+        sampler = threading.Thread(target=sample_threads, args=(activeProfile,), name="profiler", daemon=True)
+        activeProfile["sampler"] = sampler
+        sampler.start()
+    elif mode == "mem":
+        activeProfile["snapshots"] = []
+        tracemalloc.start()
+
+
+def profile_phase(name):
+    # Marks the end of a phase of the program - only the mem mode does anything with it
+    if activeProfile is None or activeProfile["mode"] != "mem":
+        return
+    activeProfile["snapshots"].append([name, time.time(), tracemalloc.take_snapshot()])
+
+
+def write_cpu_report(state):
+    state["main"].disable()
+    threading.setprofile(None)
+    stats = pstats.Stats(state["main"])
+    with state["lock"]:
+        profiles = state["profiles"][:]
+    for profile in profiles:
+        profile.create_stats()
+        if len(profile.stats) > 0:
+            stats.add(profile)
+    stats.dump_stats(state["prefix"] + "-cpu.prof")
+
+    report = io.StringIO()
+    report.write("CPU profile of the main thread and " + str(len(profiles)) + " other threads\n\n")
+    stats.stream = report
+    stats.sort_stats("cumulative").print_stats(TOP_ENTRIES)
+    stats.sort_stats("tottime").print_stats(TOP_ENTRIES)
+    with open(state["prefix"] + "-cpu.txt", "w") as reportFile:
+        reportFile.write(report.getvalue())
+    return [state["prefix"] + "-cpu.txt", state["prefix"] + "-cpu.prof"]
+
+
+def write_wall_report(state):
+    state["stop"].set()
+    state["sampler"].join()
+    groups = state["groups"]
+    with open(state["prefix"] + "-wall.txt", "w") as reportFile:
+        reportFile.write(
+            "Wall clock samples every "
+            + str(SAMPLE_INTERVAL * 1000)
+            + "ms for "
+            + str(round(time.time() - state["started"], 1))
+            + "s - "
+            + str(state["samples"])
+            + " thread samples\n"
+        )
+        for group in sorted(groups, key=groups.get, reverse=True):
+            reportFile.write("\nThreads: " + group + " (" + str(groups[group]) + " samples)\n")
+            reportFile.write("    self   total  function\n")
+            # Every function on the sampled stacks, so callers such as main that spend their time in others show
+            functions = [
+                [count, state["self"].get(key, 0), key[1]] for key, count in state["total"].items() if key[0] == group
+            ]
+            for totalCount, selfCount, function in sorted(functions, reverse=True)[:TOP_ENTRIES]:
+                reportFile.write(str(selfCount).rjust(8) + str(totalCount).rjust(8) + "  " + function + "\n")
+
+    # One line per distinct stack with its count, the format flame graph tools read
+    with open(state["prefix"] + "-wall.collapsed", "w") as stackFile:
+        for stack, count in sorted(state["stacks"].items()):
+            stackFile.write(stack.replace(" ", "_") + " " + str(count) + "\n")
+    return [state["prefix"] + "-wall.txt", state["prefix"] + "-wall.collapsed"]
+
+
+def write_mem_report(state):
+    state["snapshots"].append(["end", time.time(), tracemalloc.take_snapshot()])
+    tracemalloc.stop()
+    with open(state["prefix"] + "-mem.txt", "w") as reportFile:
+        previous = None
+        for name, when, snapshot in state["snapshots"]:
+            total = sum(stat.size for stat in snapshot.statistics("filename"))
+            reportFile.write(
+                "\nPhase: "
+                + name
+                + " at "
+                + str(round(when - state["started"], 1))
+                + "s - "
+                + str(round(total / 1024 / 1024, 2))
+                + "MB allocated\n"
+            )
+            reportFile.write("Top allocations:\n")
+            for stat in snapshot.statistics("lineno")[:TOP_ENTRIES // 2]:
+                reportFile.write("    " + str(stat) + "\n")
+            if previous is not None:
+                reportFile.write("Largest changes since the previous phase:\n")
+                for stat in snapshot.compare_to(previous, "lineno")[:TOP_ENTRIES // 2]:
+                    reportFile.write("    " + str(stat) + "\n")
+            previous = snapshot
+    return [state["prefix"] + "-mem.txt"]
+
+
+def stop_profile():
+    # Writes the reports - returns the names of the files written
+    global activeProfile
+    if activeProfile is None:
+        return []
+    state = activeProfile
+    activeProfile = None
+    if state["mode"] == "cpu":
+        reports = write_cpu_report(state)
+    elif state["mode"] == "wall":
+        reports = write_wall_report(state)
+    else:
+        reports = write_mem_report(state)
+    print("Profile written to " + ", ".join(reports))
+    return reports
@@ -0,0 +1,382 @@
+# 2023 (C) Crown Copyright, Met Office. All rights reserved.
+#
+# This file is part of Weather DataHub and is released under the
+# BSD 3-Clause license.
+# See LICENSE in the root of the repository for full licensing details.
+# (c) Met Office 2023
+
+import atexit
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from urllib.parse import urljoin
+
+import requests
+
+# Record and replay used by the --record and --replay options.  Every request goes through http_get, which
+# either makes it as usual, makes it and keeps the answer and its timings in a cassette folder, or answers
+# it from the cassette without going near the service
+
+CASSETTE_FILE = "requests.jsonl"
+BODIES_FOLDER = "bodies"
+CHUNK_SIZE = 1024 * 1024
+MAX_REDIRECTS = 5
+# Headers that describe the body as it was sent, which no longer apply once it has been decoded
+DROPPED_HEADERS = ["Content-Encoding", "Transfer-Encoding", "Content-Length"]
+# Bodies of these types are always kept, as replaying needs the order and run details
+KEPT_TYPES = ["application/json", "text/"]
+
+activeCassette = None
+
+
+def request_key(url, params, allowRedirects):
+    # A redirect followed and the same redirect returned are different answers to the same URL
+    return ("follow " if allowRedirects else "nofollow ") + requests.Request("GET", url, params=params).prepare().url
+
+
+def start_recording(folder, keepFiles=True):
+    # Without keepFiles only the size, hash and timings of file bodies are kept - they are replayed as zeros
+    global activeCassette
+    os.makedirs(os.path.join(folder, BODIES_FOLDER), exist_ok=True)
+    activeCassette = {
+        "mode": "record",
+        "folder": folder,
+        "keepFiles": keepFiles,
+        "started": time.time(),
+        "lock": threading.Lock(),
+        "file": open(os.path.join(folder, CASSETTE_FILE), "a"),
+        "requests": 0,
+        "bodies": 0,
+        "bytes": 0,
+    }
+    atexit.register(stop_cassette)
+
+
+def start_replay(folder, latencyScale):
+    # Repeated requests for the same URL are answered in the order they were recorded, then with the last
+    global activeCassette
+    entries = {}
+    with open(os.path.join(folder, CASSETTE_FILE), "r") as cassetteFile:
+        for line in cassetteFile:
+            entry = json.loads(line)
+            entries.setdefault(entry["key"], []).append(entry)
+    activeCassette = {
+        "mode": "replay",
+        "folder": folder,
+        "scale": latencyScale,
+        "lock": threading.Lock(),
+        "entries": entries,
+        "next": dict.fromkeys(entries, 0),
+        "requests": 0,
+        "missing": 0,
+    }
+    atexit.register(stop_cassette)
+
+
+def body_file(hash):
+    return os.path.join(activeCassette["folder"], BODIES_FOLDER, hash)
+
+
+class PacedBody:
+    # Stands in for the raw body of a response and gives it out no faster than it originally arrived.
+    # Closing it from another thread wakes a read that is waiting, as shutting down a socket would
+
+    def __init__(self, raw, size, duration):
+        self.raw = raw
+        self.size = size
+        self.duration = duration
+        self.given = 0
+        self.start = time.time()
+        self.closed = threading.Event()
+
+    @property
+    def connection(self):
+        return getattr(self.raw, "connection", None)
+
+    def read(self, amt=None, decode_content=True):
+        if self.closed.is_set():
+            raise requests.exceptions.ConnectionError("Connection closed while reading the body")
+        try:
+            data = self.raw.read(-1 if amt is None else amt)
+        except ValueError:
+            # Closed by another thread during the read
+            raise requests.exceptions.ConnectionError("Connection closed while reading the body")
+        self.given += len(data)
+        if self.duration > 0 and self.size > 0:
+            wait = self.start + self.duration * self.given / self.size - time.time()
+            if wait > 0 and self.closed.wait(wait):
+                raise requests.exceptions.ConnectionError("Connection closed while reading the body")
+        return data
+
+    def close(self):
+        self.closed.set()
+        self.raw.close()
+
+
+class ZeroBody:
+    # Stands in for a file body that was recorded without being kept
+
+    def __init__(self, size):
+        self.remaining = size
+
+    def read(self, amt=-1):
+        data = bytes(self.remaining if amt < 0 else min(amt, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.remaining = 0
+
+
+class RecordedBody:
+    # Stands in for the raw body of a response while it is recorded.  The caller reads it as it arrives, so
+    # time to first byte, stalls and throughput are seen as usual, and each piece is kept on its way through.
+    # The entry is written once the body has been read to the end, or with the error if that fails
+
+    def __init__(self, r, entry, startTime, keepBody):
+        self.response = r
+        self.entry = entry
+        self.startTime = startTime
+        self.chunks = None
+        self.pending = b""
+        self.offset = 0
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.spool = None
+        if keepBody:
+            self.spool = tempfile.NamedTemporaryFile(dir=os.path.join(activeCassette["folder"], BODIES_FOLDER), delete=False)
+        self.lock = threading.Lock()
+        self.finished = False
+
+    @property
+    def connection(self):
+        return getattr(self.response.raw, "connection", None)
+
+    def read(self, amt=None, decode_content=True):
+        if amt is None or amt < 0:
+            return b"".join(iter(lambda: self.read(CHUNK_SIZE), b""))
+        if self.offset >= len(self.pending):
+            if self.finished:
+                if self.entry.get("error") is not None:
+                    raise requests.exceptions.ConnectionError("Connection closed while reading the body")
+                return b""
+            if self.chunks is None:
+                # The pieces are the size the caller asks for so it sees them as soon as they arrive
+                self.chunks = self.response.iter_content(chunk_size=amt)
+            try:
+                chunk = next(self.chunks, b"")
+            except BaseException as exc:
+                self.finish(exc)
+                raise
+            if chunk == b"":
+                self.finish(None)
+                return b""
+            with self.lock:
+                if self.finished:
+                    raise requests.exceptions.ConnectionError("Connection closed while reading the body")
+                self.digest.update(chunk)
+                self.size += len(chunk)
+                if self.spool is not None:
+                    self.spool.write(chunk)
+            self.pending = chunk
+            self.offset = 0
+        data = self.pending[self.offset:self.offset + amt]
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        # Redirects and error pages are often closed without being read but are needed to replay the run,
+        # so they are read to the end here.  A file closed part way was abandoned and is recorded as failed
+        if not self.finished and self.entry["status"] != 200:
+            try:
+                while self.read(CHUNK_SIZE) != b"":
+                    pass
+            except Exception:
+                pass
+        self.finish(requests.exceptions.ConnectionError("Closed before the body was read to the end"))
+
+    def finish(self, exc):
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+        self.response.close()
+        entry = self.entry
+        if self.spool is not None:
+            self.spool.close()
+        if exc is not None:
+            if self.spool is not None:
+                os.remove(self.spool.name)
+            entry["error"] = [type(exc).__name__, str(exc)]
+            write_entry(entry)
+            return
+        entry["duration"] = round(time.time() - self.startTime - entry["ttfb"], 6)
+        entry["size"] = self.size
+        entry["body"] = self.digest.hexdigest()
+        if self.spool is None:
+            entry["stored"] = False
+        # Identical bodies, such as the same file in several orders, are only kept once
+        elif os.path.exists(body_file(entry["body"])):
+            os.remove(self.spool.name)
+        else:
+            os.replace(self.spool.name, body_file(entry["body"]))
+            with activeCassette["lock"]:
+                activeCassette["bodies"] += 1
+                activeCassette["bytes"] += self.size
+        write_entry(entry)
+
+
+def cassette_response(entry, raw, size):
+    r = requests.models.Response()
+    r.status_code = entry["status"]
+    r.reason = entry["reason"]
+    r.url = entry["url"]
+    r.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+    if size is not None:
+        r.headers["Content-Length"] = str(size)
+    r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+    r.raw = raw
+    r.elapsed = timedelta(seconds=entry["ttfb"])
+    return r
+
+
+def finish_response(r, stream):
+    # Without stream the body is read straight away, as requests.get does
+    if not stream:
+        r.content
+        r.raw.close()
+    return r
+
+
+def record_get(url, params, allowRedirects, stream, kwargs):
+    # The body is passed on to the caller as it arrives and written to the cassette on the way
+    startTime = time.time()
+    entry = {"key": request_key(url, params, allowRedirects), "started": round(startTime - activeCassette["started"], 3)}
+    try:
+        r = requests.get(url, params=params, allow_redirects=allowRedirects, stream=True, **kwargs)
+    except requests.exceptions.RequestException as exc:
+        entry["error"] = [type(exc).__name__, str(exc)]
+        entry["ttfb"] = round(time.time() - startTime, 6)
+        write_entry(entry)
+        raise
+    entry.update(
+        {
+            "url": r.url,
+            "status": r.status_code,
+            "reason": r.reason,
+            "headers": {name: value for name, value in r.headers.items() if name not in DROPPED_HEADERS},
+            "ttfb": r.elapsed.total_seconds(),
+        }
+    )
+    contentType = r.headers.get("Content-Type", "")
+    keepBody = activeCassette["keepFiles"] or any(contentType.startswith(kept) for kept in KEPT_TYPES)
+    # The length sent only matches the body given back when it was not compressed
+    size = None
+    if "Content-Encoding" not in r.headers and "Content-Length" in r.headers:
+        size = int(r.headers["Content-Length"])
+    return finish_response(cassette_response(entry, RecordedBody(r, entry, startTime, keepBody), size), stream)
+
+
+def write_entry(entry):
+    with activeCassette["lock"]:
+        activeCassette["requests"] += 1
+        activeCassette["file"].write(json.dumps(entry) + "\n")
+        activeCassette["file"].flush()
+
+
+def next_entry(key):
+    # Call with the lock held
+    if key not in activeCassette["entries"]:
+        return None
+    entries = activeCassette["entries"][key]
+    entry = entries[min(activeCassette["next"][key], len(entries) - 1)]
+    activeCassette["next"][key] += 1
+    return entry
+
+
+def find_entry(url, params, allowRedirects):
+    # A run can be replayed with or without the resolve stage whichever way it was recorded - a redirect
+    # that was followed is answered straight away with where it led, and one that was not is followed
+    # through the recording
+    key = request_key(url, params, allowRedirects)
+    with activeCassette["lock"]:
+        activeCassette["requests"] += 1
+        entry = next_entry(key)
+        if entry is None and not allowRedirects:
+            entry = next_entry(request_key(url, params, True))
+        redirects = 0
+        while entry is None and allowRedirects and redirects < MAX_REDIRECTS:
+            entry = next_entry("nofollow " + key[len("follow "):])
+            if entry is None or "Location" not in entry.get("headers", {}):
+                entry = None
+                break
+            key = request_key(urljoin(entry["url"], entry["headers"]["Location"]), None, True)
+            entry = next_entry(key)
+            redirects += 1
+        if entry is None:
+            activeCassette["missing"] += 1
+    if entry is None:
+        raise requests.exceptions.ConnectionError("Not recorded in the cassette: " + key)
+    return entry
+
+
+def replay_get(url, params, allowRedirects, stream):
+    entry = find_entry(url, params, allowRedirects)
+
+    scale = activeCassette["scale"]
+    if "error" in entry:
+        time.sleep(entry.get("ttfb", 0) * scale)
+        raise getattr(requests.exceptions, entry["error"][0], requests.exceptions.ConnectionError)(entry["error"][1])
+    time.sleep(entry["ttfb"] * scale)
+    if entry.get("stored", True):
+        body = open(body_file(entry["body"]), "rb")
+    else:
+        body = ZeroBody(entry["size"])
+    raw = PacedBody(body, entry["size"], entry["duration"] * scale)
+    return finish_response(cassette_response(entry, raw, entry["size"]), stream)
+
+
+def http_get(url, params=None, **kwargs):
+    # Used in place of requests.get - with no cassette it is exactly requests.get
+    if activeCassette is None:
+        return requests.get(url, params=params, **kwargs)
+    allowRedirects = kwargs.pop("allow_redirects", True)
+    stream = kwargs.pop("stream", False)
+    if activeCassette["mode"] == "record":
+        return record_get(url, params, allowRedirects, stream, kwargs)
+    return replay_get(url, params, allowRedirects, stream)
+
+
+def stop_cassette():
+    global activeCassette
+    if activeCassette is None:
+        return
+    cassette = activeCassette
+    activeCassette = None
+    if cassette["mode"] == "record":
+        cassette["file"].close()
+        print(
+            "Recorded "
+            + str(cassette["requests"])
+            + " requests to "
+            + cassette["folder"]
+            + " with "
+            + str(cassette["bodies"])
+            + " new bodies of "
+            + str(cassette["bytes"])
+            + " bytes"
+        )
+    else:
+        print(
+            "Replayed "
+            + str(cassette["requests"] - cassette["missing"])
+            + " requests from "
+            + cassette["folder"]
+            + " - "
+            + str(cassette["missing"])
+            + " were not recorded"
+        )
@@ -0,0 +1,148 @@
+# 2023 (C) Crown Copyright, Met Office. All rights reserved.
+#
+# This file is part of Weather DataHub and is released under the
+# BSD 3-Clause license.
+# See LICENSE in the root of the repository for full licensing details.
+# (c) Met Office 2023
+
+import atexit
+import errno
+import io
+import random
+import threading
+import time
+from datetime import timedelta
+
+import requests
+
+from cassette import http_get
+
+# Fault injection used by the --faults option.  File requests go through faulty_get, which fails a share of
+# them the way the API and the network do, so the backoff, retries and the monitor can be exercised with
+# every worker running
+
+FAULT_TYPES = ["429", "5xx", "reset", "slow", "truncate", "redirect"]
+DEBUG_FAULTS = "5xx=0.1"
+SERVER_ERRORS = [[500, "Internal Server Error"], [502, "Bad Gateway"], [503, "Service Unavailable"], [504, "Gateway Timeout"]]
+
+activeFaults = None
+
+
+def parse_faults(spec):
+    # fault=probability,fault=probability - raises ValueError if the list is not valid
+    probabilities = {}
+    for part in spec.split(","):
+        fault, _, probability = part.partition("=")
+        fault = fault.strip().lower()
+        if fault not in FAULT_TYPES:
+            raise ValueError(fault + " is not one of " + ", ".join(FAULT_TYPES))
+        probabilities[fault] = float(probability)
+        if not 0 <= probabilities[fault] <= 1:
+            raise ValueError("The probability of " + fault + " must be between 0 and 1")
+    if sum(probabilities.values()) > 1:
+        raise ValueError("The probabilities add up to more than 1")
+    return probabilities
+
+
+def start_faults(probabilities, delay, seed=None):
+    # A summary of what was injected is printed when the program exits
+    global activeFaults
+    activeFaults = {
+        "probabilities": probabilities,
+        "delay": delay,
+        "random": random.Random(seed),
+        "lock": threading.Lock(),
+        "counts": dict.fromkeys(["requests"] + FAULT_TYPES, 0),
+    }
+    atexit.register(print_fault_report)
+
+
+def choose_fault():
+    # One draw per request picks at most one fault
+    with activeFaults["lock"]:
+        activeFaults["counts"]["requests"] += 1
+        draw = activeFaults["random"].random()
+        for fault in FAULT_TYPES:
+            draw -= activeFaults["probabilities"].get(fault, 0)
+            if draw < 0:
+                activeFaults["counts"][fault] += 1
+                return fault, activeFaults["random"].random()
+    return None, 0
+
+
+def fault_response(url, params, status, reason, body, headers=None):
+    # A response as requests would have built it for the status, without anything being sent
+    r = requests.models.Response()
+    r.status_code = status
+    r.reason = reason
+    r.url = requests.Request("GET", url, params=params).prepare().url
+    r.headers = requests.structures.CaseInsensitiveDict(headers or {})
+    r.headers["Content-Type"] = "text/plain"
+    r.headers["Content-Length"] = str(len(body))
+    r.raw = io.BytesIO(body)
+    r.encoding = "utf-8"
+    r.elapsed = timedelta(0)
+    return r
+
+
+class TruncatedBody:
+    # Stands in for the raw body of a response and breaks off part way through, as a dropped connection does
+
+    def __init__(self, raw, limit):
+        self.raw = raw
+        self.remaining = limit
+
+    @property
+    def connection(self):
+        return getattr(self.raw, "connection", None)
+
+    def read(self, amt=None, decode_content=True):
+        if self.remaining <= 0:
+            raise requests.exceptions.ChunkedEncodingError("Connection broken: IncompleteRead (injected fault)")
+        data = self.raw.read(self.remaining if amt is None else min(amt, self.remaining), decode_content=decode_content)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.raw.close()
+
+
+def faulty_get(url, params=None, **kwargs):
+    # Used in place of http_get for file requests - with no faults active it is exactly http_get
+    if activeFaults is None:
+        return http_get(url, params=params, **kwargs)
+    fault, fraction = choose_fault()
+    if fault == "429":
+        return fault_response(url, params, 429, "Too Many Requests", b"Too many requests", {"Retry-After": "1"})
+    if fault == "5xx":
+        status, reason = SERVER_ERRORS[int(fraction * len(SERVER_ERRORS))]
+        return fault_response(url, params, status, reason, reason.encode())
+    if fault == "reset":
+        raise requests.exceptions.ConnectionError(
+            ConnectionResetError(errno.ECONNRESET, "Connection reset by peer (injected fault)")
+        )
+    if fault == "redirect":
+        # The redirect to the file's storage location leads nowhere, as when a signed URL has expired
+        return fault_response(url, params, 403, "Forbidden", b"Request has expired")
+    if fault == "slow":
+        time.sleep(activeFaults["delay"])
+    r = http_get(url, params=params, **kwargs)
+    if fault == "slow":
+        r.elapsed += timedelta(seconds=activeFaults["delay"])
+    elif fault == "truncate" and r.status_code == 200:
+        # Somewhere in the first half of the body, or straight away when the length is not known
+        r.raw = TruncatedBody(r.raw, int(int(r.headers.get("Content-Length", 0)) * fraction / 2))
+    return r
+
+
+def print_fault_report():
+    if activeFaults is None:
+        return
+    with activeFaults["lock"]:
+        counts = dict(activeFaults["counts"])
+    print(
+        "Faults injected in "
+        + str(counts["requests"])
+        + " file requests: "
+        + ", ".join(fault + " " + str(counts[fault]) for fault in FAULT_TYPES if fault in activeFaults["probabilities"])
+    )
@@ -11,10 +11,15 @@ import csv, os
 import requests
 import argparse
 import time
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import concurrent.futures
+import multiprocessing
+import hashlib
 import queue
 import threading
-import uuid
+from cassette import CASSETTE_FILE, http_get, start_recording, start_replay
+from faults import DEBUG_FAULTS, faulty_get, parse_faults, start_faults
+from profiler import PROFILE_MODES, profile_phase, start_profile
 
 # Example code to download PNG data files from the Met Office Weather DataHub via API calls
 
@@ -23,6 +28,17 @@ BASE_URL = "https://data.hub.api.metoffice.gov.uk/map-images/1.0.0"
 debugMode = False
 printUrl = False
 retryCount = 3
+bandwidthLimit = 0
+orderWeights = {}
+activeTransfers = {}
+bandwidthBuckets = {}
+bandwidthLock = threading.Lock()
+apiKeys = []
+apiKeyLock = threading.Lock()
+skipExisting = False
+outputSink = None
+partSize = 8 * 1024 * 1024
+uploadParallelism = 4
 
 
 def get_order_details(
@@ -39,7 +55,7 @@ def get_order_details(
         if len(runsToDownload) == 1:
             url = url + "&runfilter=" + runsToDownload[0]
 
-    req = requests.get(url, headers=actualHeaders)
+    req = http_get(url, headers=actualHeaders)
 
     if printUrl == True:
         print("get_order_details: ", url)
@@ -62,70 +78,474 @@ def get_order_details(
 def get_order_file(
         baseUrl, requestHeaders, orderName, fileId, guidFileNames, landLayer, folder, start
 ):
-    # If file id is too long or random file names required generate a uuid for the file name
-
-    urlMod = ""
-    global debugMode
-
-    if len(fileId) > 100 or guidFileNames:
-        local_filename = folder + "/" + str(uuid.uuid4()) + ".png"
-    else:
-        local_filename = folder + "/" + fileId + ".png"
+    local_filename = local_file_name(folder, fileId, guidFileNames)
 
     ttfb = 0
 
+    # After --verify only the files deleted as corrupt are fetched again
+    if skipExisting and outputSink.exists(local_filename):
+        return [start, local_filename]
+
     url = requests.utils.quote(baseUrl + "/orders/" + orderName + "/latest/" + fileId + "/data", safe=': /')
     if landLayer:
         url = url + "?includeLand=true"
 
-    if debugMode == True:
-        urlMod = input(
-            "Order: "
-            + orderName
-            + " File:"
-            + fileId
-            + "\n"
-            + "Enter y to mimic a receive failure on file - 'go' to run to end> "
-        )
-        # If you put go all further runs will automatically go through
-        if urlMod == "go":
-            debugMode = False
-        if debugMode == True and urlMod == "y":
-            url = (
-                    baseUrl
-                    + "/orders/"
-                    + orderName
-                    + "/latest/"
-                    + fileId
-                    + urlMod
-                    + "/data"
-            )
-
     actualHeaders = {"Accept": "image/png"}
     actualHeaders.update(requestHeaders)
 
-    with requests.get(
-            url, headers=actualHeaders, allow_redirects=True, stream=True
-    ) as r:
-
-        if printUrl == True:
-            print("get_order_file: ", url)
-            if url != r.url:
-                print("redirected to: ", r.url)
+    # A 429 on one of several keys is retried straight away with another
+    rateLimited = 0
+    while True:
+        apiKey = acquire_api_key()
+        actualHeaders["apikey"] = apiKey["key"]
+        try:
+            with faulty_get(
+                    url, headers=actualHeaders, allow_redirects=True, stream=True
+            ) as r:
+
+                if printUrl == True:
+                    print("get_order_file: ", url)
+                    if url != r.url:
+                        print("redirected to: ", r.url)
+
+                if r.status_code == 429 and len(apiKeys) > 1 and rateLimited < retryCount * len(apiKeys):
+                    rateLimited += 1
+                    pause_api_key(apiKey, r.headers.get("Retry-After"), 5)
+                    continue
 
-        if r.status_code != 200:
-            raise Exception("HTTP Reason and Status: " + r.reason, r.status_code)
+                if r.status_code != 200:
+                    raise Exception("HTTP Reason and Status: " + r.reason, r.status_code)
 
-        # Record time to first byte
-        ttfb = start + r.elapsed.total_seconds()
+                # Record time to first byte
+                ttfb = start + r.elapsed.total_seconds()
 
-        with open(local_filename, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
+                staged = outputSink.write(r, local_filename, orderName)
+                outputSink.publish(staged, local_filename)
+        finally:
+            release_api_key(apiKey)
+        break
 
     return [ttfb, local_filename]
 
 
+def response_chunks(r, orderName):
+    # The image a chunk at a time, within the bandwidth cap
+    for chunk in r.iter_content(chunk_size=8192):
+        if bandwidthLimit > 0:
+            throttle_bandwidth(orderName, len(chunk))
+        yield chunk
+
+
+def check_received(r, received):
+    # Content-Length is the encoded size so can only be checked when the body is not compressed
+    if "Content-Encoding" not in r.headers and int(r.headers.get("Content-Length", received)) != received:
+        raise Exception(
+            "Incomplete download: received " + str(received) + " of " + r.headers.get("Content-Length") + " bytes",
+            r.status_code,
+        )
+
+
+class LocalSink:
+    # Where downloaded images go.  Every sink has the same operations - exists and size of a finished image,
+    # write one somewhere it cannot be mistaken for a finished image, then publish it under its name or
+    # discard it.  This one is the folder under --location
+
+    def exists(self, fileName):
+        return os.path.exists(fileName)
+
+    def size(self, fileName):
+        return os.path.getsize(fileName)
+
+    def write(self, r, fileName, orderName):
+        tempFilename = fileName + ".part"
+        received = 0
+        try:
+            with open(tempFilename, "wb") as f:
+                for chunk in response_chunks(r, orderName):
+                    f.write(chunk)
+                    received += len(chunk)
+            check_received(r, received)
+        except BaseException:
+            # Never leave a partial image behind
+            if os.path.exists(tempFilename):
+                os.remove(tempFilename)
+            raise
+        return tempFilename
+
+    def publish(self, staged, fileName):
+        os.replace(staged, fileName)
+
+    def discard(self, staged):
+        os.remove(staged)
+
+
+class S3Sink:
+    # Images are streamed to an S3 compatible object store instead of the local folder, as objects named by
+    # the path the image would have had under --location
+
+    def __init__(self, client, bucket, prefix, clientError, numThreads):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.clientError = clientError
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=numThreads * uploadParallelism)
+
+    def key(self, fileName):
+        return self.prefix + os.path.relpath(fileName, baseFolder).replace(os.sep, "/")
+
+    def head(self, fileName):
+        # None only when there is no such object - failures such as bad credentials are raised instead
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(fileName))
+        except self.clientError as exc:
+            if exc.response.get("Error", {}).get("Code") in ["404", "NoSuchKey", "NotFound"]:
+                return None
+            raise
+
+    def exists(self, fileName):
+        return self.head(fileName) is not None
+
+    def size(self, fileName):
+        response = self.head(fileName)
+        if response is None:
+            raise FileNotFoundError("No object " + self.key(fileName) + " in bucket " + self.bucket)
+        return response["ContentLength"]
+
+    def upload_part(self, key, uploadId, partNumber, body):
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=key, UploadId=uploadId, PartNumber=partNumber, Body=body
+        )
+        return {"ETag": response["ETag"], "PartNumber": partNumber}
+
+    def write(self, r, fileName, orderName):
+        # Streams the image into a multipart upload a part at a time - most images fit in one part so are
+        # held back and sent in a single request by publish
+        staged = {"key": self.key(fileName), "uploadId": None, "parts": [], "buffer": bytearray()}
+        buffer = staged["buffer"]
+        parts = staged["parts"]
+        received = 0
+        try:
+            for chunk in response_chunks(r, orderName):
+                buffer += chunk
+                received += len(chunk)
+                if len(buffer) >= partSize:
+                    if staged["uploadId"] is None:
+                        staged["uploadId"] = self.client.create_multipart_upload(
+                            Bucket=self.bucket, Key=staged["key"], ContentType="image/png"
+                        )["UploadId"]
+                    parts.append(
+                        self.pool.submit(
+                            self.upload_part, staged["key"], staged["uploadId"], len(parts) + 1, bytes(buffer[:partSize])
+                        )
+                    )
+                    del buffer[:partSize]
+                    if len(parts) > uploadParallelism:
+                        parts[-uploadParallelism - 1].result()
+            check_received(r, received)
+        except BaseException:
+            self.discard(staged)
+            raise
+        return staged
+
+    def publish(self, staged, fileName):
+        try:
+            if staged["uploadId"] is None:
+                self.client.put_object(
+                    Bucket=self.bucket, Key=staged["key"], Body=bytes(staged["buffer"]), ContentType="image/png"
+                )
+                return
+            parts = staged["parts"]
+            if len(staged["buffer"]) > 0:
+                parts.append(
+                    self.pool.submit(
+                        self.upload_part, staged["key"], staged["uploadId"], len(parts) + 1, bytes(staged["buffer"])
+                    )
+                )
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=staged["key"],
+                UploadId=staged["uploadId"],
+                MultipartUpload={"Parts": [part.result() for part in parts]},
+            )
+        except BaseException:
+            self.discard(staged)
+            raise
+
+    def discard(self, staged):
+        # Nothing is left behind in the bucket for an unfinished image
+        if staged["uploadId"] is None:
+            return
+        for part in staged["parts"]:
+            part.cancel()
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=staged["key"], UploadId=staged["uploadId"])
+        except Exception as exc:
+            print("WARNING: Could not abort the upload of " + staged["key"] + ": " + str(exc))
+
+
+def local_file_name(folder, fileId, guidFileNames):
+    # If file id is too long or random file names required use a hash of it so the name is always the same
+    if len(fileId) > 100 or guidFileNames:
+        return folder + "/" + hashlib.sha256(fileId.encode()).hexdigest()[:32] + ".png"
+    return folder + "/" + fileId + ".png"
+
+
+def open_s3_sink(s3Url, endpoint, numThreads):
+    # boto3 is only needed when an object store is used; credentials come from the usual AWS environment
+    # variables or files
+    try:
+        import boto3
+        from botocore.config import Config
+        from botocore.exceptions import ClientError
+    except ImportError:
+        print("ERROR: The boto3 package is needed to write to an object store - pip install boto3")
+        exit()
+    if not s3Url.startswith("s3://"):
+        print("ERROR: The object store location must be given as s3://bucket/prefix")
+        exit()
+    bucket, _, prefix = s3Url[len("s3://"):].partition("/")
+    if prefix != "" and not prefix.endswith("/"):
+        prefix = prefix + "/"
+    client = boto3.client(
+        "s3",
+        endpoint_url=endpoint or None,
+        config=Config(max_pool_connections=numThreads * (uploadParallelism + 1)),
+    )
+    return S3Sink(client, bucket, prefix, ClientError, numThreads)
+
+
+def check_png(fileName):
+    # Returns None if the file has the PNG signature and ends with the IEND chunk, otherwise what is wrong
+    try:
+        with open(fileName, "rb") as f:
+            if f.read(8) != b"\x89PNG\r\n\x1a\n":
+                return "no PNG signature"
+            f.seek(0, os.SEEK_END)
+            if f.tell() < 20:
+                return "truncated"
+            f.seek(-12, os.SEEK_END)
+            if f.read(12) != b"\x00\x00\x00\x00IEND\xaeB`\x82":
+                return "no IEND chunk at the end - truncated"
+    except OSError as exc:
+        return "unreadable - " + str(exc)
+    return None
+
+
+def run_of_folder(name, orderNames):
+    # The order and run of a run folder's name, or None if it is not one
+    for orderName in sorted(orderNames, key=len, reverse=True):
+        if name.startswith(orderName + "_"):
+            return [orderName, name[len(orderName) + 1:]]
+    return None
+
+
+def verify_tree(rootFolder, wantedRuns):
+    # Checks the PNG files of the run folders that may be filled again across all the CPUs - wantedRuns gives
+    # the runs of each order, or None for all of them.  Nothing is deleted here.  Returns what was found for
+    # each run folder, keyed on its real path: its corrupt files and when the oldest sound one was written
+    runFolders = {}
+    fileNames = []
+    fileRuns = []
+    for name in sorted(os.listdir(rootFolder)):
+        orderRun = run_of_folder(name, wantedRuns)
+        if orderRun is None or not os.path.isdir(os.path.join(rootFolder, name)):
+            continue
+        if wantedRuns[orderRun[0]] is not None and orderRun[1] not in wantedRuns[orderRun[0]]:
+            continue
+        runFolder = os.path.realpath(os.path.join(rootFolder, name))
+        runFolders[runFolder] = {"folder": runFolder, "bad": [], "oldest": None}
+        for folder, subFolders, names in os.walk(runFolder):
+            for fileName in names:
+                if fileName.endswith(".png"):
+                    fileNames.append(os.path.join(folder, fileName))
+                    fileRuns.append(runFolders[runFolder])
+    print("Verifying " + str(len(fileNames)) + " files in " + str(len(runFolders)) + " run folders under " + rootFolder)
+
+    badCount = 0
+    # Spawned rather than forked as the download threads may already be running
+    with concurrent.futures.ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn")) as pool:
+        for fileName, runFolder, problem in zip(fileNames, fileRuns, pool.map(check_png, fileNames, chunksize=256)):
+            if problem is not None:
+                print("WARNING: " + fileName + " is corrupt (" + problem + ")")
+                runFolder["bad"].append(fileName)
+                badCount += 1
+            else:
+                written = os.path.getmtime(fileName)
+                if runFolder["oldest"] is None or written < runFolder["oldest"]:
+                    runFolder["oldest"] = written
+    print(str(badCount) + " corrupt files found")
+    return runFolders
+
+
+def expected_cycle(latestRun, run):
+    # The YYYY-MM-DD:HH of the most recent model run with the run hour.  latestRun is the model's latest run
+    # as held in myModelRuns
+    if latestRun == "" or not run.isdigit():
+        return ""
+    latest = datetime.strptime(latestRun[3:13] + ":" + latestRun[:2], "%Y-%m-%d:%H")
+    cycle = latest.replace(hour=int(run))
+    if cycle > latest:
+        cycle -= timedelta(days=1)
+    return cycle.strftime("%Y-%m-%d:%H")
+
+
+def verified_run_current(verifiedFolder, folder, cycle):
+    # An image cannot be downloaded before its model run, so a folder holding one written earlier than the
+    # current run has images of an older run and filling its gaps would mix the two
+    if cycle == "" or verifiedFolder["oldest"] is None:
+        return True
+    cycleTime = datetime.strptime(cycle, "%Y-%m-%d:%H").replace(tzinfo=timezone.utc).timestamp()
+    if verifiedFolder["oldest"] >= cycleTime:
+        return True
+    print(
+        "WARNING: "
+        + folder
+        + " holds images written before model run "
+        + cycle
+        + " so it is not filled again - run without --verify to download the run afresh"
+    )
+    for fileName in verifiedFolder["bad"]:
+        print("WARNING: " + fileName + " is not downloaded again so is left in place")
+    return False
+
+
+def remove_refetched_files(verifiedFolder, folder, fileIds, guidFileNames):
+    # Deletes the corrupt files of a checked run folder that are about to be downloaded again - images no
+    # longer in the order are left where they are
+    wanted = set(local_file_name(folder, fileId, guidFileNames) for fileId in fileIds)
+    for fileName in verifiedFolder["bad"]:
+        if os.path.join(folder, os.path.relpath(fileName, verifiedFolder["folder"])) not in wanted:
+            print("WARNING: " + fileName + " is not downloaded again so is left in place")
+            continue
+        os.remove(fileName)
+        if verbose:
+            print("Deleted " + fileName + " to download it again")
+
+
+def parse_api_keys(apikey, keyRates):
+    # One or more comma separated keys, each optionally held to a number of requests a second
+    keys = [key.strip() for key in apikey.split(",") if key.strip() != ""]
+    rates = [float(rate) for rate in keyRates.split(",")] if keyRates != "" else [0]
+    if len(rates) == 1:
+        rates = rates * len(keys)
+    if len(rates) != len(keys):
+        raise ValueError("one rate is needed for each key")
+    if min(rates, default=0) < 0:
+        raise ValueError("rates cannot be negative")
+    now = time.time()
+    return [
+        {
+            "key": key,
+            "name": "..." + key[-4:],
+            "rate": rate,
+            "tokens": rate,
+            "stamp": now,
+            "pausedUntil": 0,
+            "inflight": 0,
+            "requests": 0,
+            "throttled": 0,
+        }
+        for key, rate in zip(keys, rates)
+    ]
+
+
+def acquire_api_key():
+    # Spread requests over the keys - a key resting after a 429 or short of its rate is passed over
+    while True:
+        with apiKeyLock:
+            now = time.time()
+            best = None
+            bestScore = None
+            earliest = None
+            for apiKey in apiKeys:
+                if apiKey["pausedUntil"] > now:
+                    if earliest is None or apiKey["pausedUntil"] < earliest:
+                        earliest = apiKey["pausedUntil"]
+                    continue
+                wait = 0
+                if apiKey["rate"] > 0:
+                    tokens = min(apiKey["tokens"] + (now - apiKey["stamp"]) * apiKey["rate"], apiKey["rate"])
+                    wait = max(0, (1 - tokens) / apiKey["rate"])
+                if best is None or (wait, apiKey["inflight"]) < bestScore:
+                    best = apiKey
+                    bestScore = (wait, apiKey["inflight"])
+            if best is not None:
+                wait = 0
+                if best["rate"] > 0:
+                    best["tokens"] = min(best["tokens"] + (now - best["stamp"]) * best["rate"], best["rate"]) - 1
+                    best["stamp"] = now
+                    if best["tokens"] < 0:
+                        wait = -best["tokens"] / best["rate"]
+                best["inflight"] += 1
+                best["requests"] += 1
+        if best is not None:
+            if wait > 0:
+                time.sleep(wait)
+            return best
+        # Every key is resting
+        time.sleep(max(earliest - now, 0.1))
+
+
+def release_api_key(apiKey):
+    with apiKeyLock:
+        apiKey["inflight"] -= 1
+
+
+def pause_api_key(apiKey, retryAfter, defaultWait):
+    # Honour Retry-After when it is given in seconds
+    wait = defaultWait
+    if retryAfter is not None and retryAfter.isdigit():
+        wait = int(retryAfter)
+    with apiKeyLock:
+        apiKey["pausedUntil"] = max(apiKey["pausedUntil"], time.time() + wait)
+        apiKey["throttled"] += 1
+    if verbose:
+        print("API key " + apiKey["name"] + " rate limited - resting it for " + str(wait) + "s")
+
+
+def take_bandwidth(bucketName, rate, numBytes, now):
+    # Token bucket allowed to go into debt - returns how long the caller must wait to pay it back
+    bucket = bandwidthBuckets.get(bucketName)
+    if bucket is None:
+        bucket = [rate, now]
+        bandwidthBuckets[bucketName] = bucket
+    # Allow at most one second of burst
+    bucket[0] = min(bucket[0] + (now - bucket[1]) * rate, rate)
+    bucket[1] = now
+    bucket[0] -= numBytes
+    if bucket[0] < 0:
+        return -bucket[0] / rate
+    return 0
+
+
+def throttle_bandwidth(orderName, numBytes):
+    # Shared by all workers - a global cap split between the orders currently transferring by weight
+    with bandwidthLock:
+        now = time.time()
+        wait = take_bandwidth("", bandwidthLimit, numBytes, now)
+        if len(orderWeights) > 0:
+            totalWeight = 0
+            for activeOrder in activeTransfers:
+                totalWeight += orderWeights.get(activeOrder, 1)
+            if totalWeight > 0:
+                share = bandwidthLimit * orderWeights.get(orderName, 1) / totalWeight
+                wait = max(wait, take_bandwidth(orderName, share, numBytes, now))
+    if wait > 0:
+        time.sleep(wait)
+
+
+def start_transfer(orderName):
+    with bandwidthLock:
+        activeTransfers[orderName] = activeTransfers.get(orderName, 0) + 1
+
+
+def end_transfer(orderName):
+    with bandwidthLock:
+        activeTransfers[orderName] -= 1
+        if activeTransfers[orderName] == 0:
+            del activeTransfers[orderName]
+
+
 def get_files_by_run(order, runsToDownload, numFilesPerOrder):
     # Break down the files in to those needed for each run
     filesByRun = {}
@@ -159,6 +579,7 @@ def download_worker():
             error = False
             timeToFirstByte = 0
             startTime = time.time()
+            start_transfer(downloadTask["orderName"])
             try:
                 downloadResp = get_order_file(
                     downloadTask["baseUrl"],
@@ -172,12 +593,13 @@ def download_worker():
                 )
                 timeToFirstByte = round((downloadResp[0] - startTime), 2)
                 downloadedFile = downloadResp[1]
-                fileSize = os.path.getsize(downloadedFile)
+                fileSize = outputSink.size(downloadedFile)
 
             except Exception as ex:
                 error = True
                 errMsg = ex.args
 
+            end_transfer(downloadTask["orderName"])
             completeTime = time.time()
             completeDuration = round((completeTime - startTime), 2)
 
@@ -320,7 +742,7 @@ def get_my_orders(baseUrl, requestHeaders):
     ordHeaders.update(requestHeaders)
 
     ordurl = baseUrl + "/orders"
-    ordr = requests.get(ordurl, headers=ordHeaders)
+    ordr = http_get(ordurl, headers=ordHeaders)
     if printUrl == True:
         print("get_my_orders: ", ordurl)
         if ordurl != ordr.url:
@@ -367,7 +789,7 @@ def get_model_runs(baseUrl, requestHeaders, model):
     requrl = baseUrl + "/runs?sort=RUNDATETIME"
 
     for loop in range(retryCount):
-        reqr = requests.get(requrl, headers=runHeaders)
+        reqr = http_get(requrl, headers=runHeaders)
 
         if printUrl == True:
             print("get_model_runs: ", requrl)
@@ -528,7 +950,7 @@ if __name__ == "__main__":
         action="store_true",
         dest="debugmode",
         default=False,
-        help="Switch to debug mode.",
+        help="Switch to debug mode - fails some file requests as --faults " + DEBUG_FAULTS + " does.",
     )
     parser.add_argument(
         "-k",
@@ -536,7 +958,15 @@ if __name__ == "__main__":
         action="store",
         dest="apikey",
         default="",
-        help="REQUIRED: Your WDH API Credentials.",
+        help="REQUIRED: Your WDH API Credentials. Several keys can be given separated by commas.",
+    )
+    parser.add_argument(
+        "-kr",
+        "--keyrates",
+        action="store",
+        dest="keyRates",
+        default="",
+        help="Maximum requests per second for each API key, separated by commas, or one value for all. Defaults to no limit.",
     )
     parser.add_argument(
         "-ll",
@@ -546,6 +976,133 @@ if __name__ == "__main__":
         default=False,
         help="Includes the land layer in the returned images.",
     )
+    parser.add_argument(
+        "-vf",
+        "--verify",
+        action="store_true",
+        dest="verify",
+        default=False,
+        help="Check every downloaded PNG file first, delete corrupt ones and download only those again.",
+    )
+    parser.add_argument(
+        "-s3",
+        "--s3url",
+        action="store",
+        dest="s3Url",
+        default="",
+        help="Stream the images to an S3 compatible object store, given as s3://bucket/prefix, instead of --location.",
+    )
+    parser.add_argument(
+        "-se",
+        "--s3endpoint",
+        action="store",
+        dest="s3Endpoint",
+        default="",
+        help="Endpoint URL of the object store when it is not AWS S3, for example http://localhost:9000 for MinIO.",
+    )
+    parser.add_argument(
+        "-ps",
+        "--partsize",
+        action="store",
+        dest="partSize",
+        default=8,
+        type=int,
+        help="Size in MB of each part of an object store upload. Defaults to 8.",
+    )
+    parser.add_argument(
+        "-up",
+        "--uploadparallelism",
+        action="store",
+        dest="uploadParallelism",
+        default=4,
+        type=int,
+        help="Number of parts of each image uploaded at once. Defaults to 4.",
+    )
+    parser.add_argument(
+        "-pf",
+        "--profile",
+        action="store",
+        dest="profile",
+        default="",
+        choices=PROFILE_MODES,
+        help="OPTIONAL: Profile the program - cpu, wall or mem - writing the report to the results folder.",
+    )
+    parser.add_argument(
+        "-fi",
+        "--faults",
+        action="store",
+        dest="faults",
+        default="",
+        help="OPTIONAL: Fail file requests on purpose, given as fault=probability for 429, 5xx, reset, slow, truncate and redirect.",
+    )
+    parser.add_argument(
+        "-fd",
+        "--faultdelay",
+        action="store",
+        dest="faultDelay",
+        default=10,
+        type=float,
+        help="Seconds added before the first byte of a slow fault. Defaults to 10.",
+    )
+    parser.add_argument(
+        "-fe",
+        "--faultseed",
+        action="store",
+        dest="faultSeed",
+        default=None,
+        type=int,
+        help="OPTIONAL: Seed for the faults so a run can be repeated with the same ones.",
+    )
+    parser.add_argument(
+        "-rc",
+        "--record",
+        action="store",
+        dest="record",
+        default="",
+        help="OPTIONAL: Record every request and answer, with its timings, into this cassette folder.",
+    )
+    parser.add_argument(
+        "-rh",
+        "--recordhashes",
+        action="store_true",
+        dest="recordHashes",
+        default=False,
+        help="With --record keep only the size, hash and timings of each file rather than the file itself.",
+    )
+    parser.add_argument(
+        "-rp",
+        "--replay",
+        action="store",
+        dest="replay",
+        default="",
+        help="OPTIONAL: Answer every request from this cassette folder instead of the service.",
+    )
+    parser.add_argument(
+        "-rl",
+        "--replaylatency",
+        action="store",
+        dest="replayLatency",
+        default=1,
+        type=float,
+        help="Multiplies the recorded times when replaying - 0 answers straight away. Defaults to 1.",
+    )
+    parser.add_argument(
+        "-mb",
+        "--maxbandwidth",
+        action="store",
+        dest="maxBandwidth",
+        default=0,
+        type=float,
+        help="Maximum download rate in MB/s shared by all workers. Defaults to 0 (unlimited).",
+    )
+    parser.add_argument(
+        "-ow",
+        "--orderweights",
+        action="store",
+        dest="orderWeights",
+        default="",
+        help="OPTIONAL: Comma separated order:weight list used to share --maxbandwidth between orders.",
+    )
 
     args = parser.parse_args()
 
@@ -562,12 +1119,43 @@ if __name__ == "__main__":
     baseFolder = args.location
     apikey = args.apikey
     landLayer = args.landLayer
+    bandwidthLimit = args.maxBandwidth * 1024 * 1024
+    partSize = args.partSize * 1024 * 1024
+    uploadParallelism = args.uploadParallelism
 
     printUrl = args.printurl
 
-    if debugMode == True:
-        print("WARNING: As we are in debug mode setting workers to one.")
-        numThreads = 1
+    faultSpec = args.faults
+    if faultSpec == "" and debugMode:
+        faultSpec = DEBUG_FAULTS
+    if faultSpec != "":
+        try:
+            faultProbabilities = parse_faults(faultSpec)
+        except ValueError as exc:
+            print("ERROR: The faults must be given as fault=probability,fault=probability - " + str(exc))
+            exit()
+        if args.faultDelay < 0:
+            print("ERROR: The fault delay cannot be negative.")
+            exit()
+        print("WARNING: Injecting faults into file requests - " + faultSpec)
+        start_faults(faultProbabilities, args.faultDelay, args.faultSeed)
+
+    if args.record != "" and args.replay != "":
+        print("ERROR: A run can be recorded or replayed but not both.")
+        exit()
+    if args.replay != "":
+        if not os.path.exists(os.path.join(args.replay, CASSETTE_FILE)):
+            print("ERROR: There is no recording in " + args.replay)
+            exit()
+        if args.replayLatency < 0:
+            print("ERROR: The replay latency cannot be negative.")
+            exit()
+        print("WARNING: Replaying the requests recorded in " + args.replay + " - the service is not used.")
+        start_replay(args.replay, args.replayLatency)
+    elif args.record != "":
+        start_recording(args.record, not args.recordHashes)
+    if args.recordHashes and args.record == "":
+        print("WARNING: --recordhashes only applies with --record so is ignored.")
 
     if args.ordersToDownload == "":
         print("ERROR: You must pass an orders list to download.")
@@ -575,6 +1163,20 @@ if __name__ == "__main__":
     else:
         ordersToDownload = args.ordersToDownload.lower().split(",")
 
+    if args.orderWeights != "":
+        try:
+            for orderWeight in args.orderWeights.lower().split(","):
+                weightOrder, weight = orderWeight.split(":")
+                orderWeights[weightOrder] = float(weight)
+        except ValueError:
+            print("ERROR: Order weights must be given as order:weight,order:weight")
+            exit()
+        if min(orderWeights.values()) <= 0:
+            print("ERROR: Order weights must be greater than 0.")
+            exit()
+        if bandwidthLimit == 0:
+            print("WARNING: Order weights only apply when --maxbandwidth is set.")
+
     numFilesPerOrder = 0
     guidFileNames = False
 
@@ -583,7 +1185,16 @@ if __name__ == "__main__":
         print("ERROR: API credentials must be supplied.")
         exit()
     else:
-        requestHeaders = {"apikey": apikey}
+        try:
+            apiKeys = parse_api_keys(apikey, args.keyRates)
+        except ValueError as error:
+            print("ERROR: API key rates must be numbers of 0 or more with one for each key or one for all:", error)
+            exit()
+        if len(apiKeys) == 0:
+            print("ERROR: API credentials must be supplied.")
+            exit()
+        # Order and run lookups use the first key - file requests are spread over them all
+        requestHeaders = {"apikey": apiKeys[0]["key"]}
 
     if baseFolder != "":
         try:
@@ -597,6 +1208,26 @@ if __name__ == "__main__":
     os.makedirs(baseFolder + ROOT_FOLDER, exist_ok=True)
     os.makedirs(baseFolder + LATEST_FOLDER, exist_ok=True)
     os.makedirs(baseFolder + RESULTS_FOLDER, exist_ok=True)
+    if args.profile != "":
+        start_profile(
+            args.profile, baseFolder + RESULTS_FOLDER + "/profile-" + datetime.now().strftime("%d-%b-%Y-%H-%M-%S")
+        )
+
+    outputSink = LocalSink()
+    if args.s3Url != "":
+        if args.partSize < 5 or uploadParallelism < 1:
+            print("ERROR: Object store parts must be at least 5MB and at least one must upload at a time.")
+            exit()
+        if args.verify:
+            print("ERROR: --verify works on the local folder so cannot be used with --s3url.")
+            exit()
+        outputSink = open_s3_sink(args.s3Url, args.s3Endpoint, numThreads)
+
+    if args.verify:
+        # The run folders are checked once the orders are known - only the missing files are downloaded
+        skipExisting = True
+        if folderdate:
+            print("WARNING: With --folderdate every call downloads into new folders so --verify has nothing to check.")
     os.makedirs(baseFolder + FAILURES_FOLDER, exist_ok=True)
 
     if verbose:
@@ -636,6 +1267,16 @@ if __name__ == "__main__":
     # set the model back to 'myModelList'
     myModelRuns = get_model_runs(baseUrl, requestHeaders, myModelList[0])
 
+    verifiedRuns = {}
+    if args.verify and not folderdate:
+        # Only the folders of the runs this call downloads are checked, as only they are filled again
+        if orderRuns == "latest":
+            verifyRuns = dict.fromkeys(ordersToDownload)
+        else:
+            runNames = ["00", "12"] if orderRuns == "" else orderRuns.split(",")
+            verifyRuns = {orderName: set(runNames) for orderName in ordersToDownload}
+        verifiedRuns = verify_tree(baseFolder + ROOT_FOLDER, verifyRuns)
+
     retryManifest = []
 
     # Total number of files downloaded
@@ -664,6 +1305,10 @@ if __name__ == "__main__":
                     print("ERROR: No idea what model: " + modelToGet + " is so terminating!")
                     exit()
                 runsToDownload = get_latest_run(modelToGet, orderName, myModelRuns)
+                latestFolder = os.path.realpath(baseFolder + ROOT_FOLDER + "/" + orderName + "_" + runsToDownload[5:])
+                if runsToDownload[:4] == "done" and latestFolder in verifiedRuns and len(verifiedRuns[latestFolder]["bad"]) > 0:
+                    # Fetched again so the corrupt images --verify found are replaced
+                    runsToDownload = runsToDownload[5:]
                 if runsToDownload[:4] == "done":
                     if verbose:
                         print("We have done this latest run " + runsToDownload[5:] + " already!")
@@ -730,6 +1375,15 @@ if __name__ == "__main__":
                 else:
                     folder = baseFolder + ROOT_FOLDER + "/" + orderName + "_" + run
 
+                verifiedFolder = verifiedRuns.pop(os.path.realpath(folder), None)
+                if verifiedFolder is not None:
+                    # A run is fetched by its hour so must be the current one, which must be the one already there
+                    modelToGet = get_model_from_order(myOrders, orderName)
+                    verifyCycle = expected_cycle(myModelRuns.get(modelToGet, ""), run)
+                    if not verified_run_current(verifiedFolder, folder, verifyCycle):
+                        continue
+                    remove_refetched_files(verifiedFolder, folder, filesByRun[run], guidFileNames)
+
                 os.makedirs(folder, exist_ok=True)
                 for fileId in filesByRun[run]:
                     downloadTask = {
@@ -767,6 +1421,7 @@ if __name__ == "__main__":
 
         for t in taskThreads:
             t.join()
+        profile_phase("order " + orderName)
 
         # Write out the summary CSV file
         summaryFileName = (
@@ -794,6 +1449,23 @@ if __name__ == "__main__":
 
     # End of order processing loop
 
+    # Corrupt images in folders of runs that were not downloaded are never fetched again, so are kept
+    for verified in verifiedRuns.values():
+        for fileName in verified["bad"]:
+            print("WARNING: " + fileName + " is not downloaded again so is left in place")
+
+    if len(apiKeys) > 1:
+        for apiKey in apiKeys:
+            print(
+                "API key "
+                + apiKey["name"]
+                + ": "
+                + str(apiKey["requests"])
+                + " file requests, "
+                + str(apiKey["throttled"])
+                + " rate limited"
+            )
+
     if verbose:
         print("All file downloads have been attempted.")
 
@@ -866,7 +1538,7 @@ if __name__ == "__main__":
 
             try:
                 if apikey != "":
-                    requestHeaders = {"apikey": apikey}
+                    requestHeaders = {"apikey": apiKeys[0]["key"]}
 
                 if verbose:
                     print(
@@ -886,12 +1558,13 @@ if __name__ == "__main__":
                     retryFile["folder"],
                     startTime,
                 )
-                fileSize = os.path.getsize(downloadResp[1])
+                fileSize = outputSink.size(downloadResp[1])
 
             except Exception as ex:
                 error = True
                 errMsg = ex.args
-                status = ex.args[1]
+                # Only HTTP failures carry a status - connection failures have just their message
+                status = ex.args[1] if len(ex.args) > 1 else ""
 
             if not error:
                 with open(summaryFileName, "a") as sumfile:
@@ -10,6 +10,7 @@ import argparse
 import time
 import sys
 import logging as log
+from profiler import PROFILE_MODES, profile_phase, start_profile
 
 log.basicConfig(filename='ss_download.log', filemode='w', format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -43,6 +44,7 @@ def retrieve_forecast(baseUrl, timesteps, requestHeaders, latitude, longitude, e
                 log.error("Retries exceeded", exc_info=True)
                 sys.exit()
 
+    profile_phase("response")
     req.encoding = 'utf-8'
 
     print(req.text)
@@ -100,6 +102,15 @@ if __name__ == "__main__":
         default="",
         help="REQUIRED: Your WDH API Credentials."
     )
+    parser.add_argument(
+        "-pf",
+        "--profile",
+        action="store",
+        dest="profile",
+        default="",
+        choices=PROFILE_MODES,
+        help="OPTIONAL: Profile the program - cpu, wall or mem - writing the report to the current folder."
+    )
 
     args = parser.parse_args()
 
@@ -125,6 +136,9 @@ if __name__ == "__main__":
         print("ERROR: The available frequencies for timesteps are hourly, three-hourly or daily.")
         sys.exit() 
     
+    if args.profile != "":
+        start_profile(args.profile, "profile-ss_download-" + time.strftime("%d-%b-%Y-%H-%M-%S"))
+
     retrieve_forecast(base_url, timesteps, requestHeaders, latitude, longitude, excludeMetadata, includeLocation)
 
 